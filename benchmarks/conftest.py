@@ -0,0 +1,49 @@
+"""
+
+Fixtures for the map benchmarks: synthetic GeoTIFFs of several sizes, and reporting of latency percentiles and
+throughput alongside pytest-benchmark's own table.
+
+Run with `make benchmark`, or `py.test benchmarks` with pytest-benchmark installed; pass `--benchmark-json` to keep the
+results (p50, p99 and throughput are stored in each benchmark's `extra_info`) and `--benchmark-compare` to compare
+against a previous run.
+
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import numpy as np
+import pytest
+import rasterio
+from affine import Affine
+
+from benchmarks.helpers import BLOCK, ORIGIN_LAT, ORIGIN_LON, RESOLUTION, SIZES, results
+
+
+@pytest.fixture(scope='session', params=SIZES, ids=lambda size: '%dpx' % size)
+def raster(request, tmpdir_factory):
+    """
+
+    A square, tiled WGS84 GeoTIFF of rolling synthetic terrain, written one strip of blocks at a time
+
+    """
+    size = request.param
+    file_name = str(tmpdir_factory.mktemp('rasters').join('synthetic_%d.tif' % size))
+    profile = dict(driver='GTiff', height=size, width=size, count=1, dtype='float32', crs='EPSG:4326', nodata=-9999,
+                   transform=Affine(RESOLUTION, 0, ORIGIN_LON, 0, -RESOLUTION, ORIGIN_LAT),
+                   tiled=True, blockxsize=BLOCK, blockysize=BLOCK)
+    cols = np.arange(size)
+    with rasterio.open(file_name, 'w', **profile) as ds:
+        for row in range(0, size, BLOCK):
+            rows = np.arange(row, min(row + BLOCK, size))[:, None]
+            strip = 500 + 200 * np.sin(rows / 97.) * np.cos(cols / 131.) + 50 * np.sin((rows + cols) / 17.)
+            ds.write(strip.astype('float32'), 1, window=((row, row + len(rows)), (0, size)))
+    return file_name
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not results:
+        return
+    write = terminalreporter.write_line
+    terminalreporter.section('map benchmark latencies')
+    width = max(len(name) for name, _, _, _ in results)
+    write('%-*s %12s %12s %16s' % (width, 'benchmark', 'p50 (us)', 'p99 (us)', 'items/s'))
+    for name, p50, p99, throughput in results:
+        write('%-*s %12.1f %12.1f %16.0f' % (width, name, p50 * 1e6, p99 * 1e6, throughput))
@@ -0,0 +1,61 @@
+"""
+
+Helpers shared by the map benchmarks: the layout of the synthetic rasters, random coordinates over them, and the
+measurement of latency percentiles and throughput reported by `conftest`.
+
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import os
+
+import numpy as np
+import rasterio
+
+ORIGIN_LON, ORIGIN_LAT, RESOLUTION = -122.5, 37.5, 1. / 3600  # one arc-second pixels
+BLOCK = 256
+# raster widths, in pixels; override with e.g. TOWER_BENCHMARK_SIZES=1024,8192
+SIZES = [int(size) for size in os.environ.get('TOWER_BENCHMARK_SIZES', '1024,4096').split(',')]
+
+results = []  # (name, p50, p99, throughput) of every benchmark run, for the terminal summary
+
+
+def extent(file_name):
+    """
+
+    :return: tuple of (west, south, east, north) of a synthetic raster
+
+    """
+    with rasterio.open(file_name) as ds:
+        return tuple(ds.bounds)
+
+
+def random_coordinates(file_name, n, seed=0):
+    """
+
+    :return: tuple of (lons, lats) arrays of `n` coordinates drawn uniformly over a raster
+
+    """
+    west, south, east, north = extent(file_name)
+    rng = np.random.RandomState(seed)
+    return rng.uniform(west, east, n), rng.uniform(south, north, n)
+
+
+def measure(benchmark, function, items=1, rounds=100, warmup_rounds=1):
+    """
+
+    Time `function` with one call per round, so that the recorded timings are per-call latencies, and record the
+    median and 99th percentile latencies and the throughput in `items` per second in the benchmark's extra_info
+
+    :param benchmark: the pytest-benchmark fixture
+    :param function: callable taking no arguments
+    :param items: number of items (points, pairs, samples) processed by each call
+    :param rounds: number of calls timed
+    :return: the function's last result
+
+    """
+    result = benchmark.pedantic(function, rounds=rounds, iterations=1, warmup_rounds=warmup_rounds)
+    if benchmark.stats is not None:  # None under --benchmark-disable
+        timings = np.asarray(benchmark.stats.stats.data)
+        p50, p99 = np.percentile(timings, 50), np.percentile(timings, 99)
+        benchmark.extra_info.update(p50=p50, p99=p99, throughput=items / p50, items=items)
+        results.append((benchmark.fullname.split('::')[-1], p50, p99, items / p50))
+    return result
@@ -0,0 +1,92 @@
+"""
+
+Benchmarks for map module. Batch benchmarks process BATCH items per call; single-item benchmarks cycle through
+pre-drawn coordinates, so that successive calls touch different blocks of the raster.
+
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import itertools
+
+import numpy as np
+import pytest
+
+from benchmarks.helpers import measure, random_coordinates, RESOLUTION
+from tower.map.map import Map
+
+pytest.importorskip('pytest_benchmark')
+
+BATCH = 100000
+
+
+@pytest.fixture
+def map_(raster):
+    return Map(raster)
+
+
+def coordinates(map_, n, seed=0):
+    """
+
+    :return: an endless iterator over `n` random Coordinates on the map's raster
+
+    """
+    lons, lats = random_coordinates(map_.file_name, n, seed)
+    point = map_.point()
+    return itertools.cycle([point(lon, lat, map_.units) for lon, lat in zip(lons, lats)])
+
+
+def test_point_elevation(benchmark, map_):
+    points = coordinates(map_, 1000)
+    measure(benchmark, lambda: map_.get_point_elevation(next(points)), rounds=2000)
+
+
+@pytest.mark.parametrize('interpolation', ['nearest', 'bilinear'])
+def test_point_elevations(benchmark, map_, interpolation):
+    lons, lats = random_coordinates(map_.file_name, BATCH)
+    measure(benchmark, lambda: map_.get_point_elevations(lons, lats, interpolation=interpolation), BATCH, rounds=20)
+
+
+@pytest.mark.parametrize('window', [8, 64])
+def test_surrounding_elevation(benchmark, map_, window):
+    points = coordinates(map_, 1000)
+    measure(benchmark, lambda: map_.get_surrounding_elevation(next(points), window=window), window * window,
+            rounds=1000)
+
+
+def test_surrounding_elevations(benchmark, map_):
+    lons, lats = random_coordinates(map_.file_name, BATCH // 64)
+    measure(benchmark, lambda: map_.get_surrounding_elevations(lons, lats, window=8), BATCH, rounds=20)
+
+
+def test_coordinates_along_path(benchmark, map_):
+    lons, lats = random_coordinates(map_.file_name, 20)
+    vertices = np.column_stack((lons, lats))
+    spacing = RESOLUTION * map_.semimajor * np.pi / 180  # about one pixel
+    samples = len(map_.get_coordinates_along_path(vertices, spacing)['lon'])
+    measure(benchmark, lambda: map_.get_coordinates_along_path(vertices, spacing), samples, rounds=20)
+
+
+def test_vincenty_inverse(benchmark, map_):
+    points = coordinates(map_, 1000)
+    measure(benchmark, lambda: map_.vincenty_inverse(next(points), next(points)), rounds=2000)
+
+
+def test_vincenty_inverse_array(benchmark, map_):
+    lons1, lats1 = random_coordinates(map_.file_name, BATCH, seed=1)
+    lons2, lats2 = random_coordinates(map_.file_name, BATCH, seed=2)
+    measure(benchmark, lambda: map_.vincenty_inverse_array(lons1, lats1, lons2, lats2), BATCH, rounds=20)
+
+
+def test_distance_on_unit_sphere(benchmark, map_):
+    points = coordinates(map_, 1000)
+    measure(benchmark, lambda: map_.distance_on_unit_sphere(next(points), next(points)), rounds=2000)
+
+
+def test_distance_on_unit_sphere_array(benchmark, map_):
+    lons1, lats1 = random_coordinates(map_.file_name, BATCH, seed=1)
+    lons2, lats2 = random_coordinates(map_.file_name, BATCH, seed=2)
+    measure(benchmark, lambda: map_.distance_on_unit_sphere_array(lons1, lats1, lons2, lats2), BATCH, rounds=50)
+
+
+def test_lat_lon_to_pixel(benchmark, map_):
+    points = coordinates(map_, 1000)
+    measure(benchmark, lambda: map_.lat_lon_to_pixel(next(points)), rounds=5000)
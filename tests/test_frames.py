@@ -0,0 +1,54 @@
+"""
+
+Tests for the frame history of the feedback loop.
+
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+
+import numpy as np
+import pytest
+from scipy import signal
+
+from tower.controllers.feedback.frames import FrameHistory, RingBuffer
+
+
+def test_ring_buffer():
+    """
+
+    Test that the ring buffer keeps the latest samples, oldest first, in a view that does not copy them
+    :return:
+
+    """
+    buffer = RingBuffer(4, 2)
+    assert len(buffer) == 0 and buffer.view().shape == (0, 2)
+    for i in range(3):
+        buffer.append((i, -i))
+    assert not buffer.full and buffer.view()[:, 0].tolist() == [0, 1, 2]
+    for i in range(3, 10):
+        buffer.append((i, -i))
+        view = buffer.view()
+        assert buffer.full and view[:, 0].tolist() == list(range(i - 3, i + 1))
+        assert view[:, 1].tolist() == [-x for x in range(i - 3, i + 1)]
+        assert np.shares_memory(view, buffer.view())
+    with pytest.raises(ValueError):
+        view[0, 0] = 1
+    buffer.clear()
+    assert len(buffer) == 0
+    with pytest.raises(ValueError):
+        RingBuffer(0, 2)
+
+
+def test_filter_history():
+    """
+
+    Test that the filter waits for a full history, of configurable length, and filters each state variable over it
+    :return:
+
+    """
+    history = FrameHistory(filtering=True, history_length=50)
+    states = np.random.RandomState(0).normal(size=(60, 6))
+    for i, state in enumerate(states):
+        filtered = history.filter(state)
+        assert (filtered is None) == (i < 49)
+    expected = [signal.lfilter(history._b, history._a, states[-50:, column])[-1] for column in range(6)]
+    assert np.allclose(filtered, expected)
@@ -1,7 +1,16 @@
 from __future__ import (absolute_import, division, print_function, unicode_literals)
+import collections
+import os
+import threading
+
 import mock
+import numpy as np
 import pytest
 import tower
+from tower.map.landmarks import Landmarks
+from tower.map.multiagent import conflicts, cooperative_a_star
+from tower.map.replanning import DStarLite
+from tower.map.trajectory import Cycle, Path
 
 # logger.basicConfig(level=logger.DEBUG)
 mockVertex = mock.MagicMock()
@@ -81,6 +90,455 @@ def test_shortest_path():
     #assert (g.shortest_path('a', 'b') == ['a', 'b'])
     assert (g.shortest_path('a', 'd') == ['a', 'b', 'c', 'd'])
 
+
+def test_compact_graph():
+    """
+
+    Test that a compact graph built from a Graph answers the same queries through its dictionary facade
+    :return:
+
+    """
+    g = tower.Graph(G)
+    c = g.compact()
+    assert isinstance(c, tower.CompactGraph)
+    assert c.num_vertices == 5 and c.num_edges == 4
+    assert set(c) == set(['a', 'b', 'c', 'd', 'x'])
+    assert c['b']['c'] == 3 and dict(c['b']) == {'c': 3, 'x': 2} and len(c['d']) == 0
+    assert 'x' in c and 'y' not in c
+    assert sorted(c.get_edges()) == sorted(g.get_edges())
+    assert c.dijkstra('a', 'd') == g.dijkstra('a', 'd')
+    assert c.shortest_path('a', 'd') == g.shortest_path('a', 'd')
+
+
+def test_compact_graph_from_edges():
+    """
+
+    Test bulk construction from edge arrays, merging of parallel edges, and in-place edge updates
+    :return:
+
+    """
+    n = 1000
+    chain = np.arange(n - 1)
+    sources = np.concatenate((chain, chain, [0]))
+    targets = np.concatenate((chain + 1, chain + 1, [n - 1]))
+    weights = np.concatenate((np.ones(n - 1), np.full(n - 1, 5.), [2000.]))
+    c = tower.CompactGraph.from_edges(sources, targets, weights, directed=False)
+    assert c.num_vertices == n and c.num_edges == 2 * n
+    assert c[1][0] == 1 and c[n - 1][0] == 2000
+    assert c.shortest_path(0, n - 1) == list(range(n))
+    assert len(c.get_edges()) == n
+
+    version = c.version
+    c.set_weight(0, n - 1, 10.)
+    assert c.version > version
+    assert c.shortest_path(0, n - 1) == [0, n - 1]
+    with pytest.raises(KeyError):
+        c.set_weight(0, 2, 1.)
+
+    c.add_edges([0], [2], [.5])
+    assert c.num_edges == 2 * n + 1
+    assert c.dijkstra(0, 2)[0][2] == .5
+    c.add_edges([0], [2], [.25])
+    assert c.num_edges == 2 * n + 1 and c[0][2] == .25
+
+
+def grid_graph(n, spacing=.001):
+    """
+
+    An 8-connected n by n grid of geographic vertices, with edge weights the great-circle distances between them
+
+    """
+    from tower.map.geodesy import haversine
+    index = np.arange(n * n).reshape(n, n)
+    lons, lats = np.meshgrid(-122 + spacing * np.arange(n), 37 - spacing * np.arange(n))
+    pairs = [(index[:, :-1], index[:, 1:]), (index[:-1], index[1:]),
+             (index[:-1, :-1], index[1:, 1:]), (index[:-1, 1:], index[1:, :-1])]
+    sources = np.concatenate([a.ravel() for a, _ in pairs])
+    targets = np.concatenate([b.ravel() for _, b in pairs])
+    weights = haversine(lons.ravel()[sources], lats.ravel()[sources], lons.ravel()[targets], lats.ravel()[targets],
+                        6378137.) * (1 + .1 * np.random.RandomState(0).rand(len(sources)))
+    return tower.CompactGraph.from_edges(sources, targets, weights, directed=False, lons=lons.ravel(),
+                                         lats=lats.ravel())
+
+
+def test_a_star():
+    """
+
+    Test that A* finds paths as short as Dijkstra's while expanding far fewer vertices
+    :return:
+
+    """
+    n = 150
+    c = grid_graph(n)
+    start, end = n * (n // 2) + 5, n * (n // 2) + n - 5
+    d_dijkstra, _ = c.dijkstra(start, end)
+    d_a_star, p_a_star = c.a_star(start, end)
+    assert d_a_star[end] == pytest.approx(d_dijkstra[end])
+    assert len(d_a_star) < len(d_dijkstra) / 5
+    path = c.shortest_path(start, end)
+    assert path[0] == start and path[-1] == end
+    assert sum(c[u][v] for u, v in zip(path[:-1], path[1:])) == pytest.approx(d_dijkstra[end])
+    assert c.a_star(start, end, heuristic=lambda u, v: 0.)[0] == d_dijkstra
+
+    Coord = collections.namedtuple('Coord', ['lon', 'lat', 'units'])
+    coords = [Coord(-122 + .001 * i, 37., 'degrees') for i in range(4)]
+    g = tower.Graph({coords[0]: {coords[1]: 100., coords[3]: 500.}, coords[1]: {coords[2]: 100.},
+                     coords[2]: {coords[3]: 100.}})
+    d, p = g.a_star(coords[0], coords[3])
+    assert d[coords[3]] == 300. and p[coords[3]] == coords[2]
+    assert g.find_path(coords[0], coords[3])[-1] == coords[3]
+
+
+def test_landmarks(tmpdir):
+    """
+
+    Test that ALT landmarks give the same path lengths as Dijkstra's with fewer expansions, survive a round trip to
+    disk, and are ignored once the graph changes
+    :return:
+
+    """
+    n = 60
+    c = grid_graph(n)
+    c.weights[::7] *= 3  # uneven costs, which the great-circle distance bounds poorly
+    c.version += 1
+    landmarks = c.preprocess(landmarks=6, file_name=str(tmpdir.join('landmarks.npz')))
+    assert len(landmarks) == 6 and landmarks.version == c.version
+    rng = np.random.RandomState(1)
+    for start, end in rng.randint(n * n, size=(10, 2)):
+        d_dijkstra, _ = c.dijkstra(start, end)
+        d_alt, _ = c.a_star(start, end)
+        assert d_alt[end] == pytest.approx(d_dijkstra[end])
+        assert len(d_alt) <= len(d_dijkstra)
+        assert landmarks.bounds(start, end).max() <= d_dijkstra[end] + 1e-6
+    assert all(not isinstance(row, list) for row in landmarks._rows.values())  # views of the tables, not copies
+
+    loaded = c.preprocess(file_name=str(tmpdir.join('landmarks.npz')))
+    assert loaded is not landmarks and np.array_equal(loaded.forward, landmarks.forward)
+
+    path = c.shortest_path(0, n * n - 1)
+    c.set_weight(path[0], path[1], 0.)  # the landmark bounds may now overestimate
+    d_dijkstra, _ = c.dijkstra(0, n * n - 1)
+    assert c.a_star(0, n * n - 1)[0][n * n - 1] == pytest.approx(d_dijkstra[n * n - 1])
+    with pytest.raises(ValueError):
+        Landmarks.load(str(tmpdir.join('landmarks.npz')), tower.CompactGraph.from_edges([0], [1]))
+
+
+def test_d_star_lite():
+    """
+
+    Test that D* Lite repairs its path after edges close, open and the start moves, matching fresh Dijkstra searches
+    while expanding only part of the graph
+    :return:
+
+    """
+    n = 80
+    c = grid_graph(n)
+    start, goal = n * (n // 2) + 5, n * (n // 2) + n - 5
+    planner = DStarLite(c, start, goal)
+    path = planner.plan()
+    assert path[0] == start and path[-1] == goal
+    assert planner.distance == pytest.approx(c.dijkstra(start, goal)[0][goal])
+
+    closed = [edge for u, v in zip(path[10:14], path[11:15]) for edge in ((u, v), (v, u))]
+    for u, v in closed:  # a vehicle blocks a stretch of the corridor
+        c.remove_edge(u, v)
+    assert c.changes_since(planner.version) == closed
+    path = planner.plan()
+    assert planner.distance == pytest.approx(c.dijkstra(start, goal)[0][goal])
+    assert 0 < planner.expanded < n * n / 4
+    assert all(np.isfinite(c[u][v]) for u, v in zip(path[:-1], path[1:]))
+
+    planner.move_to(path[5])
+    c.set_weight(path[8], path[9], 0.)
+    path = planner.plan()
+    assert path[0] == planner.start and planner.distance == pytest.approx(c.dijkstra(path[0], goal)[0][goal])
+
+    c.add_edges([path[0]], [goal], [1.])
+    assert c.changes_since(planner.version) is None
+    assert planner.plan() == [path[0], goal]
+
+    c = tower.CompactGraph.from_edges([0, 1], [1, 2])
+    planner = DStarLite(c, 0, 2)
+    assert planner.plan() == [0, 1, 2]
+    c.remove_edge(1, 2)
+    with pytest.raises(KeyError):
+        planner.plan()
+
+
+def test_d_star_lite_zero_weights():
+    """
+
+    Test that D* Lite finds its path through ties of zero-length edges, including cycles and self-loops, where
+    following the first best successor of each vertex would go round in circles
+    :return:
+
+    """
+    edges = [(0, 3, 1.), (1, 3, 0.), (1, 4, 2.), (2, 3, 2.), (2, 4, 2.), (3, 4, 0.), (3, 5, 0.), (4, 0, 0.), (4, 1, 0.),
+             (4, 5, 0.), (5, 0, 0.)]
+    sources, targets, weights = zip(*edges)
+    planner = DStarLite(tower.CompactGraph.from_edges(sources, targets, weights), 0, 5)
+    path = planner.plan()
+    assert planner.distance == 1. and path[0] == 0 and path[-1] == 5
+    assert sum(dict(((u, v), w) for u, v, w in edges)[edge] for edge in zip(path[:-1], path[1:])) == 1.
+
+    planner = DStarLite(tower.CompactGraph.from_edges([0, 0, 1], [0, 1, 2], [0., 0., 0.]), 0, 2)
+    assert planner.plan() == [0, 1, 2]
+
+
+def test_distance_matrix():
+    """
+
+    Test one-to-many and many-to-many queries against single-pair searches, and the cache of trees behind them
+    :return:
+
+    """
+    n = 40
+    c = grid_graph(n)
+    c.weights[::5] *= 2  # make the graph directed
+    c.version += 1
+    rng = np.random.RandomState(2)
+    starts, ends = rng.randint(n * n, size=5).tolist(), rng.randint(n * n, size=3).tolist()
+    expected = np.array([[c.dijkstra(s, e)[0][e] for e in ends] for s in starts])
+    assert np.allclose(c.distance_matrix(starts, ends), expected)  # one reverse search per end
+    assert np.allclose(c.distance_matrix(ends, starts), np.array([[c.dijkstra(e, s)[0][s] for s in starts]
+                                                                    for e in ends]))
+    assert np.allclose(c.distances(starts[0], ends), expected[0])
+    paths = c.shortest_paths(starts[0], ends)
+    assert sorted(paths) == sorted(ends)
+    for end in ends:
+        path = paths[end]
+        assert path[0] == starts[0] and path[-1] == end
+        assert sum(c[u][v] for u, v in zip(path[:-1], path[1:])) == pytest.approx(expected[0, ends.index(end)])
+
+    hits = c.trees.hits
+    assert np.allclose(c.distance_matrix(starts, ends), expected)
+    assert c.shortest_path(starts[0], ends[0]) == paths[ends[0]]
+    assert c.trees.hits == hits + len(ends) + 1
+    c.set_weight(paths[ends[0]][0], paths[ends[0]][1], 1e9)
+    assert c.distances(starts[0], [ends[0]])[0] > expected[0, 0]
+    assert len(c.trees) == 1
+
+    c = tower.CompactGraph.from_edges(['a', 'b'], ['b', 'c'], ids=['a', 'b', 'c'])
+    assert c.shortest_paths('b', ['a', 'c']) == {'c': ['b', 'c']}
+    assert c.distance_matrix(['a', 'c'], ['c', 'a']).tolist() == [[2., 0.], [0., np.inf]]
+
+
+def test_trajectory():
+    """
+
+    Test arc length, lookups by distance and time, slicing, resampling and editing of an array-backed path
+    :return:
+
+    """
+    from tower.map.geodesy import vincenty_inverse
+    from tower.map.trajectory import WGS84_FLATTENING, WGS84_SEMIMAJOR
+    lons, lats = np.array([-122., -121.99, -121.99, -121.97]), np.array([37., 37., 37.01, 37.01])
+    path = Path(lons, lats, alts=[100., 200., 200., 100.], times=[0., 10., 20., 40.])
+    legs = vincenty_inverse(lons[:-1], lats[:-1], lons[1:], lats[1:], WGS84_SEMIMAJOR, WGS84_FLATTENING)[0]
+    assert np.allclose(path.distances, np.concatenate(([0.], np.cumsum(legs))))
+    assert path.length == pytest.approx(legs.sum()) and path.duration == 40.
+
+    lon, lat, alt = path.at_distance(legs[0] / 2)
+    assert lon == pytest.approx(-121.995) and lat == pytest.approx(37., abs=1e-6) and alt == pytest.approx(150.)
+    lon, lat, alt = path.at_time([5., 15., 50.])
+    assert np.allclose(lon, [-121.995, -121.99, -121.97]) and np.allclose(alt, [150., 200., 100.])
+    lon, lat, _ = path.at_distance(path.distances)
+    assert np.allclose(lon, lons) and np.allclose(lat, lats)
+
+    sliced = path[1:3]
+    assert len(sliced) == 2 and sliced.origin == path[1] and sliced.length == pytest.approx(legs[1])
+    part = path.between(legs[0] / 2, legs[0] + legs[1] / 2)
+    assert len(part) == 3 and part.length == pytest.approx(legs[0] / 2 + legs[1] / 2)
+    assert part.times[0] == pytest.approx(5.) and part.times[-1] == pytest.approx(15.)
+
+    resampled = path.resample(spacing=10.)
+    assert np.all(np.diff(resampled.distances) <= 10. + 1e-6)  # chords, shorter than 10 m across the corners
+    assert resampled.length == pytest.approx(path.length, rel=1e-3)
+    assert len(path.resample(interval=1.)) == 41 and len(path.resample(count=5)) == 5
+    assert path.retime(10.).duration == pytest.approx(path.length / 10.)
+
+    path.insert(1, -121.995, 37., 150., 5.)
+    assert len(path) == 5 and path.length == pytest.approx(legs.sum())
+    path.remove(1)
+    assert len(path) == 4 and np.allclose(path.distances[1:], np.cumsum(legs))
+    with pytest.raises(ValueError):
+        path.insert(1, -121.995, 37.)
+
+    Coord = collections.namedtuple('Coord', ['lon', 'lat'])
+    walk = Path([Coord(-122., 37.), Coord(-121.99, 37.)])
+    assert walk.next() == walk.origin and walk.has_next() and walk.next().lon == -121.99
+    assert not walk.has_next() and walk.previous() == walk.origin
+    with pytest.raises(ValueError):
+        Path(lons, lats).at_time(1.)
+
+
+def test_cycle():
+    """
+
+    Test that a cycle closes itself and wraps distances, times and traversal around
+    :return:
+
+    """
+    cycle = Cycle([(-122., 37.), (-121.99, 37.), (-121.99, 37.01)])
+    assert len(cycle) == 4 and cycle.destination == cycle.origin
+    lon, lat, _ = cycle.at_distance(cycle.length + cycle.distances[1])
+    assert lon == pytest.approx(-121.99) and lat == pytest.approx(37.)
+    timed = cycle.retime(10.)
+    assert isinstance(timed, Cycle) and len(timed) == 4
+    assert timed.distance_at_time(2 * timed.duration + 1.) == pytest.approx(2 * cycle.length + 10.)
+    assert [cycle.next().lon for _ in range(4)] == [-122., -121.99, -121.99, -122.]
+    with pytest.raises(ValueError):
+        Cycle([-122., -121.99], [37., 37.], times=[0., 1.])
+
+
+def simple_paths(graph, u, end, path=None):
+    """
+
+    Every loopless path from u to the end of a small graph, by exhaustive search
+
+    """
+    path = path or [u]
+    if u == end:
+        yield list(path)
+        return
+    for v in graph[u]:
+        if v not in path:
+            path.append(v)
+            for found in simple_paths(graph, v, end, path):
+                yield found
+            path.pop()
+
+
+def test_k_shortest_paths():
+    """
+
+    Test Yen's algorithm against an exhaustive enumeration of the loopless paths of small random graphs
+    :return:
+
+    """
+    rng = np.random.RandomState(3)
+    for _ in range(50):
+        sources, targets = rng.randint(8, size=(2, 25))
+        c = tower.CompactGraph.from_edges(sources, targets, rng.randint(1, 5, size=25), num_vertices=8)
+        lengths = sorted(sum(c[u][v] for u, v in zip(p[:-1], p[1:])) for p in simple_paths(c, 0, 7) if len(p) > 1)
+        found = c.k_shortest_paths(0, 7, 5)
+        assert [length for length, _ in found] == pytest.approx(lengths[:5])
+        assert len(set(tuple(path) for _, path in found)) == len(found)
+        for length, path in found:
+            assert path[0] == 0 and path[-1] == 7 and len(set(path)) == len(path)
+            assert sum(c[u][v] for u, v in zip(path[:-1], path[1:])) == pytest.approx(length)
+
+    g = tower.Graph(G)
+    assert g.k_shortest_paths('a', 'd', 3) == [(17, ['a', 'b', 'c', 'd'])]
+    assert g.k_shortest_paths('a', 'x', 0) == []
+
+
+def test_save_load(tmpdir):
+    """
+
+    Test that graphs round-trip through their on-disk layout, mapped read-only or copy-on-write
+    :return:
+
+    """
+    c = grid_graph(20)
+    directory = str(tmpdir.join('grid.graph'))
+    c.save(directory)
+    mapped = tower.CompactGraph.load(directory)
+    assert not mapped.weights.flags.writeable and np.array_equal(mapped.weights, c.weights)
+    assert np.array_equal(mapped.lons, c.lons) and mapped.radius == c.radius
+    assert mapped.shortest_path(0, 399) == c.shortest_path(0, 399)
+    with pytest.raises(ValueError):
+        mapped.set_weight(0, 1, 1.)
+
+    private = tower.CompactGraph.load(directory, mmap_mode='c')
+    private.set_weight(0, 1, 1.)
+    assert private[0][1] == 1. and tower.CompactGraph.load(directory)[0][1] == c[0][1]
+
+    for ids in (['a', 'b', 'c'], [10, 20, 30], [('a', 1), ('b', 2), ('c', 3)]):
+        tower.CompactGraph.from_edges(ids[:2], ids[1:], [1., 2.], ids=ids).save(directory)  # replaces the grid
+        loaded = tower.CompactGraph.load(directory)
+        assert list(loaded) == ids and loaded.shortest_path(ids[0], ids[2]) == ids
+    tower.Graph(G).save(directory)
+    assert tower.CompactGraph.load(directory).shortest_path('a', 'd') == ['a', 'b', 'c', 'd']
+    tower.CompactGraph.from_edges([True], [False], ids=[True, False]).save(directory)
+    assert list(tower.CompactGraph.load(directory)) == [True, False]
+
+    saved = tmpdir.listdir(lambda path: path.basename.endswith('.data'))
+    unrelated = tmpdir.mkdir('unrelated')
+    unrelated.join('notes.txt').write('keep me')
+    with pytest.raises(ValueError):
+        c.save(str(unrelated))
+    assert unrelated.join('notes.txt').read() == 'keep me'
+    if hasattr(os, 'symlink'):
+        os.symlink(str(unrelated), str(tmpdir.join('pointer')))
+        with pytest.raises(ValueError):
+            c.save(str(tmpdir.join('pointer')))
+        assert unrelated.join('notes.txt').read() == 'keep me'
+    assert tmpdir.listdir(lambda path: path.basename.endswith('.data')) == saved  # nothing left behind
+
+
+def test_concurrent_save(tmpdir):
+    """
+
+    Test that concurrent saves of a graph to one directory neither fail nor leave temporary directories behind, and
+    that saving without `replace` keeps the graph already there
+    :return:
+
+    """
+    c = grid_graph(10)
+    directory = str(tmpdir.join('grid.graph'))
+    errors = []
+
+    def save(replace):
+        try:
+            for _ in range(10):
+                c.save(directory, replace)
+                assert tower.CompactGraph.load(directory, mmap_mode=None).num_vertices == 100
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=save, args=(i % 2 == 0,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    data = os.path.basename(os.path.realpath(directory))
+    assert set(os.listdir(str(tmpdir))) == set(['grid.graph', 'grid.graph.lock', data])
+
+    tower.Graph(G).save(directory, replace=False)
+    assert tower.CompactGraph.load(directory).num_vertices == 100
+
+
+def test_cooperative_a_star():
+    """
+
+    Test that Cooperative A* returns time-indexed paths free of vertex and edge conflicts, including vehicles that
+    must give way to each other in a corridor
+    :return:
+
+    """
+    n = 6
+    index = np.arange(n * n).reshape(n, n)
+    grid = tower.CompactGraph.from_edges(np.concatenate((index[:, :-1].ravel(), index[:-1].ravel())),
+                                         np.concatenate((index[:, 1:].ravel(), index[1:].ravel())), directed=False)
+    corners = [0, n - 1, n * n - 1, n * (n - 1)]
+    agents = list(zip(corners, corners[2:] + corners[:2])) + [(n + 1, 2 * n - 2), (2 * n - 2, n + 1)]
+    paths = cooperative_a_star(grid, agents)
+    assert conflicts(paths) == []
+    for (start, goal), path in zip(agents, paths):
+        assert path[0] == start and path[-1] == goal
+        assert all(u == v or v in grid[u] for u, v in zip(path[:-1], path[1:]))
+    assert len(paths[0]) == 2 * (n - 1) + 1  # the first vehicle is not held up
+
+    corridor = tower.CompactGraph.from_edges([0, 1, 2, 3, 4, 4], [1, 2, 3, 4, 5, 6], directed=False)  # siding at 4
+    paths = cooperative_a_star(corridor, {'cf1': (0, 5), 'cf2': (5, 0)})
+    assert paths['cf1'] == [0, 1, 2, 3, 4, 5] and 6 in paths['cf2'] and paths['cf2'][-1] == 0
+    assert conflicts([paths['cf1'], paths['cf2']]) == []
+    assert conflicts([[0, 1, 2], [2, 1, 0]]) == [(0, 1, 1, 'vertex')]
+    assert conflicts([[0, 1], [1, 0]]) == [(0, 1, 0, 'edge')]
+    with pytest.raises(ValueError):
+        cooperative_a_star(corridor, [(0, 4), (0, 3)])
+
 '''
 
 def test_edge_exception():
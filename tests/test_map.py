@@ -0,0 +1,585 @@
+"""
+
+Tests for map module.
+
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import os
+import threading
+
+import numpy as np
+import pytest
+import rasterio
+from affine import Affine
+
+from tower.map.map import Map, RetrievePointException
+
+ORIGIN_LON, ORIGIN_LAT, RESOLUTION = -122.5, 37.5, 0.001
+NROW, NCOL, BLOCK = 600, 500, 256
+
+
+@pytest.fixture
+def raster(tmpdir):
+    """
+
+    A tiled, north-up WGS84 GeoTIFF whose pixel values encode their own position: value = row * NCOL + col
+
+    """
+    file_name = str(tmpdir.join('synthetic.tif'))
+    profile = dict(driver='GTiff', height=NROW, width=NCOL, count=1, dtype='float32', crs='EPSG:4326',
+                   transform=Affine(RESOLUTION, 0, ORIGIN_LON, 0, -RESOLUTION, ORIGIN_LAT), nodata=-9999,
+                   tiled=True, blockxsize=BLOCK, blockysize=BLOCK)
+    with rasterio.open(file_name, 'w', **profile) as ds:
+        ds.write(np.arange(NROW * NCOL, dtype='float32').reshape(NROW, NCOL), 1)
+    return file_name
+
+
+def coordinate(map_, col, row):
+    """
+
+    Coordinate at the centre of pixel (col, row)
+
+    """
+    return map_.pixel_to_lat_lon(col + .5, row + .5)
+
+
+def test_point_elevation(raster):
+    """
+
+    Test that point queries return the pixel containing the coordinate, and that both the block cache and the open
+    dataset are reused between neighbouring queries
+
+    """
+    map_ = Map(raster)
+    assert map_.block_shape == (BLOCK, BLOCK)
+    assert map_.get_point_elevation(coordinate(map_, 10, 20)) == 20 * NCOL + 10
+    assert map_.get_point_elevation(None, px=11, py=20) == 20 * NCOL + 11
+    assert map_.block_cache.misses == 1 and map_.block_cache.hits == 1
+    assert len(map_._handles) == 1
+    with pytest.raises(RetrievePointException):
+        map_.get_point_elevation(None, px=NCOL, py=0)
+
+
+def test_surrounding_elevation_spans_blocks(raster):
+    """
+
+    Test that a window straddling block boundaries is assembled from the four blocks it touches
+
+    """
+    map_ = Map(raster)
+    window = map_.get_surrounding_elevation(None, window=4, px=BLOCK, py=BLOCK)
+    expected = np.arange(NROW * NCOL, dtype='float32').reshape(NROW, NCOL)[BLOCK - 2:BLOCK + 2, BLOCK - 2:BLOCK + 2]
+    assert np.array_equal(window, expected)
+    assert len(map_.block_cache) == 4
+
+
+def test_block_cache_cap(raster):
+    """
+
+    Test that the block cache evicts least recently used blocks to stay under its memory cap
+
+    """
+    block_bytes = BLOCK * BLOCK * 4
+    map_ = Map(raster, cache_bytes=2 * block_bytes)
+    map_.get_point_elevation(None, px=0, py=0)
+    map_.get_point_elevation(None, px=BLOCK, py=0)
+    map_.get_point_elevation(None, px=0, py=BLOCK)
+    assert len(map_.block_cache) == 2
+    assert map_.block_cache.nbytes <= 2 * block_bytes
+    assert (1, 0, 0) not in map_.block_cache
+
+
+def test_dataset_per_thread(raster):
+    """
+
+    Test that each thread reading from the map gets its own open dataset
+
+    """
+    map_ = Map(raster)
+    datasets = []
+    threads = [threading.Thread(target=lambda: datasets.append(map_.dataset)) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(id(ds) for ds in datasets)) == 3
+    map_.close()
+    assert all(ds.closed for ds in datasets)
+
+
+def test_dataset_closed_with_thread(raster):
+    """
+
+    Test that the datasets of short-lived threads are closed when the threads exit, rather than kept until `close`
+
+    """
+    map_ = Map(raster)
+    fds = len(os.listdir('/proc/self/fd')) if os.path.isdir('/proc/self/fd') else None
+    for _ in range(100):
+        thread = threading.Thread(target=lambda: map_.dataset.read(1, window=((0, 4), (0, 4))))
+        thread.start()
+        thread.join()
+    assert len(map_._handles) == 0
+    if fds is not None:
+        assert len(os.listdir('/proc/self/fd')) <= fds + 2
+
+
+def test_point_elevations(raster):
+    """
+
+    Test that batch queries agree with the raster, read each block once, and mask coordinates off the raster
+
+    """
+    map_ = Map(raster)
+    rng = np.random.RandomState(0)
+    cols, rows = rng.randint(0, NCOL, 1000), rng.randint(0, NROW, 1000)
+    lons = ORIGIN_LON + (cols + .5) * RESOLUTION
+    lats = ORIGIN_LAT - (rows + .5) * RESOLUTION
+    elevations = map_.get_point_elevations(lons, lats)
+    assert np.array_equal(elevations, rows * NCOL + cols)
+    assert not elevations.mask.any()
+    assert map_.block_cache.misses == 6  # every block of the raster, once
+
+    pairs = np.array([[lons[0], lats[0]], [ORIGIN_LON - 1, ORIGIN_LAT]])
+    elevations = map_.get_point_elevations(pairs)
+    assert elevations[0] == rows[0] * NCOL + cols[0]
+    assert list(elevations.mask) == [False, True]
+
+
+@pytest.mark.parametrize('mode', ['memory', 'memmap'])
+def test_grid_modes(raster, mode):
+    """
+
+    Test that queries against an in-memory or memory-mapped grid match the raster without touching the block cache
+
+    """
+    map_ = Map(raster, grid=mode)
+    assert map_.get_point_elevation(None, px=10, py=20) == 20 * NCOL + 10
+    window = map_.get_surrounding_elevation(None, window=4, px=BLOCK, py=BLOCK)
+    assert window[0, 0] == (BLOCK - 2) * NCOL + BLOCK - 2
+    elevations = map_.get_point_elevations([ORIGIN_LON + .0005, ORIGIN_LON - 1], [ORIGIN_LAT - .0005, ORIGIN_LAT])
+    assert elevations[0] == 0 and list(elevations.mask) == [False, True]
+    assert map_.block_cache.misses == 0
+    if mode == 'memmap':
+        assert isinstance(map_.grid, np.memmap)
+        assert Map(raster, grid=mode).grid.filename == map_.grid.filename
+
+
+@pytest.mark.parametrize('interpolation', ['bilinear', 'bicubic'])
+def test_interpolation(raster, interpolation):
+    """
+
+    Test that interpolated sampling reproduces the raster's linear ramp between pixel centres, for single and batch
+    queries, and masks points off the raster
+
+    """
+    map_ = Map(raster)
+    value = map_.get_point_elevation(None, px=10.75, py=20.5, interpolation=interpolation)
+    assert value == pytest.approx(20 * NCOL + 10.25)
+
+    cols, rows = np.array([100.25, 300.5, 10.0]), np.array([200.5, 400.75, 3.0])
+    lons, lats = ORIGIN_LON + cols * RESOLUTION, ORIGIN_LAT - rows * RESOLUTION
+    elevations = map_.get_point_elevations(np.append(lons, ORIGIN_LON - 1), np.append(lats, ORIGIN_LAT),
+                                           interpolation=interpolation)
+    assert np.allclose(elevations[:3], (rows - .5) * NCOL + cols - .5)
+    assert list(elevations.mask) == [False, False, False, True]
+
+
+def test_geodesic_arrays(raster):
+    """
+
+    Test the array geodesic kernels against geographiclib on the map's spheroid, and against the scalar versions
+
+    """
+    from geographiclib.geodesic import Geodesic
+    map_ = Map(raster)
+    geod = Geodesic(map_.semimajor, map_.flattening)
+    rng = np.random.RandomState(1)
+    lons1, lats1 = rng.uniform(-180, 180, 50), rng.uniform(-80, 80, 50)
+    lons2, lats2 = rng.uniform(-180, 180, 50), rng.uniform(-80, 80, 50)
+
+    inverse = map_.vincenty_inverse_array(lons1, lats1, lons2, lats2)
+    for i in range(50):
+        expected = geod.Inverse(lats1[i], lons1[i], lats2[i], lons2[i])
+        assert inverse['distance'][i] == pytest.approx(expected['s12'], rel=1e-6)
+        assert np.degrees(inverse['forward_azimuth'][i]) == pytest.approx(expected['azi1'] % 360, abs=1e-5)
+
+    lons, lats, _ = map_.vincenty_direct_array(lons1, lats1, np.degrees(inverse['forward_azimuth']),
+                                               inverse['distance'])
+    assert np.allclose(lats, lats2, atol=1e-7)
+    assert np.allclose((lons - lons2 + 180) % 360 - 180, 0, atol=1e-7)
+
+    point = map_.point()
+    a, b = point(lon=lons1[0], lat=lats1[0], units='degrees'), point(lon=lons2[0], lat=lats2[0], units='degrees')
+    assert map_.vincenty_inverse(a, b)['distance'] == pytest.approx(inverse['distance'][0])
+    assert map_.distance_on_unit_sphere_array(lons1[0], lats1[0], lons2[0], lats2[0]) == \
+        pytest.approx(map_.distance_on_unit_sphere(a, b))
+    separations = map_.vincenty_inverse_array(lons1[:, None], lats1[:, None], lons1, lats1)['distance']
+    assert separations.shape == (50, 50) and np.allclose(np.diag(separations), 0)
+
+    # eastwards across the antimeridian, longitudes wrap around rather than run past 180
+    lons, lats, _ = map_.vincenty_direct_array(179.9, 0., 90., [0., 10000., 30000.])
+    assert lons[0] == pytest.approx(179.9) and -180 <= lons[2] < -179.6
+    assert np.all(lons >= -180) and np.all(lons < 180)
+    lons, lats = map_.get_coordinates_in_segment(point(lon=179.95, lat=10., units='degrees'),
+                                                 point(lon=-179.95, lat=10., units='degrees'), returnStyle='numpy')
+    assert np.all(np.abs(lons) >= 179.95 - 1e-9) and np.all(lons < 180)
+
+
+def test_coordinates_along_path(raster):
+    """
+
+    Test that a path is densified to the requested spacing, passes through its vertices, and streams in chunks that
+    match the single-shot result
+
+    """
+    map_ = Map(raster)
+    vertices = np.array([[-122.45, 37.45], [-122.10, 37.20], [-122.10, 37.20], [-122.30, 37.00]])
+    path = map_.get_coordinates_along_path(vertices, spacing=25.)
+    steps = map_.vincenty_inverse_array(path['lon'][:-1], path['lat'][:-1], path['lon'][1:], path['lat'][1:])
+    assert steps['distance'].max() <= 25. + 1e-6
+    assert np.allclose(np.diff(path['distance']), steps['distance'], atol=1e-6)
+    assert np.allclose([path['lon'][-1], path['lat'][-1]], vertices[-1])
+    assert not path['elevation'].mask.any()
+
+    chunks = list(map_.iter_coordinates_along_path(vertices, spacing=25., chunk_size=1000))
+    assert len(chunks) > 1 and all(len(chunk['lon']) <= 1000 for chunk in chunks)
+    assert np.array_equal(np.concatenate([chunk['elevation'] for chunk in chunks]), path['elevation'])
+
+    point = map_.point()
+    segment = map_.get_coordinates_in_segment(point(*vertices[0], units='degrees'),
+                                              point(*vertices[1], units='degrees'), numSamples=4)
+    assert len(segment) == 5 and segment[-1].lon == pytest.approx(vertices[1][0])
+
+    streamed = map_.get_coordinates_along_path((point(*vertex, units='degrees') for vertex in vertices), spacing=25.)
+    assert np.array_equal(streamed['lon'], path['lon'])  # a generator keeps its first vertex
+
+
+def test_overviews(raster):
+    """
+
+    Test that coarse queries pick a decimated level from the requested resolution or window size, that built levels
+    reduce the pixels they cover, and that native overviews are used when the raster has them
+
+    """
+    ramp = np.arange(NROW * NCOL, dtype='float32').reshape(NROW, NCOL)
+    map_ = Map(raster)
+    assert map_.overview_factors == []
+    assert map_.select_overview(resolution=RESOLUTION / 2) == 1
+    assert map_.select_overview(resolution=5 * RESOLUTION) == 4
+    assert map_.select_overview(window=2000, max_window=512) == 4
+
+    level = map_.get_overview(4, 'max')
+    assert level.shape == (NROW // 4, NCOL // 4)
+    assert np.array_equal(level, ramp.reshape(NROW // 4, 4, NCOL // 4, 4).max(axis=(1, 3)))
+    assert np.array_equal(Map(raster).get_overview(4, 'max'), level)  # reloaded from the sidecar
+
+    window = map_.get_surrounding_elevation(None, window=400, max_window=128, px=250, py=300, reduction='mean')
+    assert window.shape == (100, 100)
+    assert window[0, 0] == pytest.approx(ramp[100:104, 48:52].mean())
+    elevations = map_.get_point_elevations([ORIGIN_LON + .0025], [ORIGIN_LAT - .0025], resolution=4 * RESOLUTION)
+    assert elevations[0] == pytest.approx(ramp[:4, :4].mean())
+
+    with rasterio.open(raster, 'r+') as ds:
+        ds.build_overviews([2, 4], rasterio.enums.Resampling.average)
+    map_ = Map(raster)
+    assert map_.overview_factors == [2, 4]
+    assert map_.select_overview(resolution=5 * RESOLUTION) == 4
+    assert map_.get_overview(2).shape == (NROW // 2, NCOL // 2)
+    assert map_.get_overview(2)[0, 0] == pytest.approx(ramp[:2, :2].mean())
+
+
+def test_terrain(raster, tmpdir):
+    """
+
+    Test that slope, aspect and max elevation are computed for the tiles queried only, match the raster's ramp, and
+    are found on disk by a later Map on the same raster
+
+    """
+    map_ = Map(raster, terrain_tile=128, terrain_cell=16)
+    lons, lats = ORIGIN_LON + np.array([.0105, .2005]), ORIGIN_LAT - np.array([.0205, .3005])
+    slopes = map_.get_slopes(lons, lats)
+    assert map_.terrain.computed.sum() == 2
+
+    dx, dy = map_.terrain.pixel_size(np.array([20]))
+    rise_east, rise_north = 1 / dx[0], -NCOL / dy
+    assert slopes[0] == pytest.approx(np.degrees(np.arctan(np.hypot(rise_east, rise_north))), rel=1e-5)
+    assert map_.get_aspects(lons, lats)[0] == pytest.approx(np.degrees(np.arctan2(-rise_east, -rise_north)) % 360,
+                                                            rel=1e-5)
+    assert map_.get_max_elevations(lons, lats)[0] == 31 * NCOL + 15
+    assert map_.get_slopes([ORIGIN_LON - 1], [ORIGIN_LAT]).mask.all()
+
+    later = Map(raster, terrain_tile=128, terrain_cell=16)
+    assert later.terrain.directory == map_.terrain.directory
+    assert later.terrain.computed.sum() == 2
+    assert later.get_slopes(lons, lats)[1] == slopes[1]
+
+
+@pytest.mark.parametrize('prune', [True, False])
+def test_line_of_sight(raster, prune):
+    """
+
+    Test that a segment over the raster's ramp reports its first violation and minimum clearance exactly, with and
+    without pruning on the terrain max elevation grid, and that the batch form agrees with single queries
+
+    """
+    map_ = Map(raster, terrain_tile=128, terrain_cell=16)
+    lon = ORIGIN_LON + 100.5 * RESOLUTION
+    start, end = (lon, ORIGIN_LAT - 100.5 * RESOLUTION, 60000.), (lon, ORIGIN_LAT - 200.5 * RESOLUTION, 60000.)
+    sight = map_.get_line_of_sight(start, end, prune=prune)
+    assert not sight['clear']
+    assert sight['min_clearance'] == pytest.approx(60000 - (200 * NCOL + 100))
+    assert sight['first_violation'][1] == pytest.approx(ORIGIN_LAT - 120 * RESOLUTION)
+
+    high = (start[0], start[1], 200000.), (end[0], end[1], 200000.)
+    sights = map_.get_lines_of_sight([start, high[0]], [end, high[1]], clearance=100., prune=prune)
+    assert list(sights['clear']) == [False, True]
+    assert sights['min_clearance'][1] == pytest.approx(200000 - (200 * NCOL + 100))
+    assert np.isnan(sights['first_violation'][1]).all()
+
+
+def test_parallel_point_elevations(raster):
+    """
+
+    Test that sharding a batch query across a process or thread pool returns the serial result, in input order, and
+    that thread pools sample with the Map itself rather than a copy of it
+
+    """
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    from tower.map import map as map_module
+    map_ = Map(raster)
+    rng = np.random.RandomState(2)
+    lons = rng.uniform(ORIGIN_LON - .01, ORIGIN_LON + NCOL * RESOLUTION, 5000)
+    lats = rng.uniform(ORIGIN_LAT - NROW * RESOLUTION, ORIGIN_LAT + .01, 5000)
+    for pool in (ProcessPoolExecutor, ThreadPoolExecutor):
+        with pool(2) as executor:
+            for interpolation in ('nearest', 'bilinear'):
+                parallel = map_.get_point_elevations(lons, lats, interpolation=interpolation, executor=executor)
+                serial = map_.get_point_elevations(lons, lats, interpolation=interpolation)
+                assert np.array_equal(parallel.mask, serial.mask)
+                assert np.array_equal(parallel.compressed(), serial.compressed())
+    assert len(map_module._worker_maps) == 0
+
+
+def test_worker_maps_bounded(raster, tmpdir):
+    """
+
+    Test that an executor worker keeps a bounded number of Maps open, closing the least recently used
+
+    """
+    from tower.map import map as map_module
+    from tower.map.map import MAX_WORKER_MAPS, _sample_shard
+    opened = []
+    for i in range(MAX_WORKER_MAPS + 2):
+        file_name = str(tmpdir.join('copy%d.tif' % i))
+        with open(raster, 'rb') as src, open(file_name, 'wb') as dst:
+            dst.write(src.read())
+        elevations, mask = _sample_shard(file_name, {}, np.array([ORIGIN_LON + .0005]), np.array([ORIGIN_LAT - .0005]),
+                                         {})
+        assert elevations[0] == 0 and not mask[0]
+        opened.append(map_module._worker_maps[(file_name, repr([]))])
+    try:
+        assert len(map_module._worker_maps) == MAX_WORKER_MAPS
+        assert all(len(m._handles) == 0 and len(m.block_cache) == 0 for m in opened[:2])
+    finally:
+        for m in map_module._worker_maps.values():
+            m.close()
+        map_module._worker_maps.clear()
+
+
+def test_boundless_windows(raster):
+    """
+
+    Test that windows reaching past the raster are padded, singly and in batches, instead of raising
+
+    """
+    map_ = Map(raster)
+    ramp = np.arange(NROW * NCOL, dtype='float32').reshape(NROW, NCOL)
+    window = map_.get_surrounding_elevation(None, window=4, px=0, py=0)
+    assert window.dtype == np.float32
+    assert np.all(window[:2] == -9999) and np.all(window[:, :2] == -9999)
+    assert np.array_equal(window[2:, 2:], ramp[:2, :2])
+    assert np.isnan(map_.read_window(-10, -5, 0, 4, boundless=True, fill_value=np.nan)).all()
+    assert map_.read_window(NROW - 1, NROW + 1, 0, 1, boundless=True, fill_value=.5).dtype == np.float32
+    with pytest.raises(RetrievePointException):
+        map_.get_surrounding_elevation(None, window=4, px=0, py=0, boundless=False)
+
+    assert map_.get_point_elevation(None, px=-1, py=0, fill_value=-1) == -1
+    with pytest.raises(RetrievePointException):
+        map_.get_point_elevation(None, px=-1, py=0)
+
+    pixels = [(0, 0), (NCOL - 1, NROW - 1), (BLOCK, BLOCK), (-50, 10)]
+    coordinates = [coordinate(map_, col, row) for col, row in pixels]
+    windows = map_.get_surrounding_elevations([c[0] for c in coordinates], [c[1] for c in coordinates], window=5)
+    assert windows.shape == (4, 5, 5)
+    for (col, row), batch in zip(pixels, windows):
+        assert np.array_equal(batch, map_.get_surrounding_elevation(None, window=5, px=col + .5, py=row + .5))
+    assert np.all(windows[3] == -9999)
+
+
+@pytest.fixture
+def tiles(tmpdir):
+    """
+
+    A directory of four tiles cut from the synthetic raster, in quadrants of 300 rows by 250 columns
+
+    """
+    ramp = np.arange(NROW * NCOL, dtype='float32').reshape(NROW, NCOL)
+    tiles = tmpdir.mkdir('tiles')
+    for r0, c0 in [(0, 0), (0, 250), (300, 0), (300, 250)]:
+        data = ramp[r0:r0 + 300, c0:c0 + 250]
+        profile = dict(driver='GTiff', height=300, width=250, count=1, dtype='float32', crs='EPSG:4326', nodata=-9999,
+                       transform=Affine(RESOLUTION, 0, ORIGIN_LON + c0 * RESOLUTION, 0, -RESOLUTION,
+                                        ORIGIN_LAT - r0 * RESOLUTION))
+        with rasterio.open(str(tiles.join('tile_%d_%d.tif' % (r0, c0))), 'w', **profile) as ds:
+            ds.write(data, 1)
+    return str(tiles)
+
+
+def test_mosaic(raster, tiles, tmpdir):
+    """
+
+    Test that a directory of tiles answers queries like the raster they were cut from, with a bounded number of open
+    tiles, and that overlapping tiles fall back to one another on no-data
+
+    """
+    from tower.map.mosaic import Mosaic
+    mosaic = Map(tiles, max_open=2)
+    assert isinstance(mosaic, Mosaic) and len(mosaic) == 4
+    map_ = Map(raster)
+    rng = np.random.RandomState(3)
+    lons = rng.uniform(ORIGIN_LON - .01, ORIGIN_LON + NCOL * RESOLUTION + .01, 2000)
+    lats = rng.uniform(ORIGIN_LAT - NROW * RESOLUTION - .01, ORIGIN_LAT + .01, 2000)
+    elevations, expected = mosaic.get_point_elevations(lons, lats), map_.get_point_elevations(lons, lats)
+    assert np.array_equal(elevations.mask, expected.mask)
+    assert np.array_equal(elevations.compressed(), expected.compressed())
+    assert len(mosaic.open_tiles) <= 2
+    assert mosaic.get_point_elevation(coordinate(map_, 260, 310)) == 310 * NCOL + 260
+    centres = [coordinate(map_, 100, 100), coordinate(map_, 400, 500), (ORIGIN_LON - 1, ORIGIN_LAT)]
+    windows = mosaic.get_surrounding_elevations([c[0] for c in centres], [c[1] for c in centres], window=3)
+    assert np.array_equal(windows[:2], map_.get_surrounding_elevations([c[0] for c in centres[:2]],
+                                                                       [c[1] for c in centres[:2]], window=3))
+    assert np.all(windows[2] == -9999)
+    assert np.array_equal(mosaic.get_surrounding_elevation(centres[1], 3), windows[1])
+
+    holes = str(tmpdir.join('holes.tif'))
+    with rasterio.open(raster) as src, rasterio.open(holes, 'w', **src.profile) as ds:
+        data = src.read(1)
+        data[:, :100] = -9999
+        ds.write(data, 1)
+    overlapping = Map([holes, raster])
+    assert overlapping.get_point_elevation(coordinate(map_, 50, 10)) == 10 * NCOL + 50
+    assert overlapping.get_point_elevations(*coordinate(map_, 50, 10)[:2])[()] == 10 * NCOL + 50
+
+
+@pytest.mark.parametrize('prune', [True, False])
+def test_mosaic_routing(raster, tiles, prune):
+    """
+
+    Test that terrain and line of sight queries on a mosaic agree with the raster its tiles were cut from, lines of
+    sight crossing tiles included, and that pixel-level operations point to the tiles
+
+    """
+    options = dict(terrain_tile=128, terrain_cell=16)
+    mosaic, map_ = Map(tiles, **options), Map(raster, **options)
+    points = [coordinate(map_, 100, 100), coordinate(map_, 400, 100), coordinate(map_, 120, 450),
+              coordinate(map_, 420, 520), (ORIGIN_LON - 1, ORIGIN_LAT)]
+    lons, lats = [p[0] for p in points], [p[1] for p in points]
+    for query in ('get_slopes', 'get_aspects'):
+        values, expected = getattr(mosaic, query)(lons, lats), getattr(map_, query)(lons, lats)
+        assert np.array_equal(values.mask, expected.mask)
+        assert np.allclose(values.compressed(), expected.compressed())
+    assert mosaic.get_max_elevations(lons[:1], lats[:1])[0] == map_.get_max_elevations(lons[:1], lats[:1])[0]
+    assert mosaic.get_slopes(lons, lats).mask[-1]
+
+    corner = coordinate(map_, 100, 100)[:2], coordinate(map_, 400, 500)[:2]
+    starts = [corner[0] + (100000.,), corner[1] + (200000.,), corner[1] + (260000.,), (ORIGIN_LON - 1, ORIGIN_LAT, 0.)]
+    ends = [corner[1] + (180000.,), corner[0] + (60000.,), corner[0] + (260000.,), (ORIGIN_LON - 2, ORIGIN_LAT, 0.)]
+    sights, expected = (m.get_lines_of_sight(starts, ends, clearance=10., prune=prune) for m in (mosaic, map_))
+    assert list(sights['clear']) == list(expected['clear']) == [False, False, True, True]
+    assert np.allclose(sights['min_clearance'], expected['min_clearance'])
+    assert np.allclose(sights['first_violation'], expected['first_violation'], equal_nan=True)
+    sight = mosaic.get_line_of_sight(starts[1], ends[1], prune=prune)
+    assert not sight['clear'] and sight['first_violation'] == pytest.approx(tuple(expected['first_violation'][1]))
+
+    # terrain is derived per tile: on a tile's last column the aspect replicates its edge, unlike the whole raster
+    seam, inner = coordinate(map_, 249, 100)[:2], coordinate(map_, 248, 100)[:2]
+    assert mosaic.get_aspects(*seam) == mosaic.tile(mosaic.tile_at(seam)).get_aspects(*seam)
+    assert mosaic.get_aspects(*seam) != pytest.approx(map_.get_aspects(*seam), abs=1e-3)
+    assert mosaic.get_aspects(*inner) == pytest.approx(map_.get_aspects(*inner), abs=1e-6)
+
+    boxes, overlapped = mosaic.index.overlapping([ORIGIN_LON, ORIGIN_LON - 1], [ORIGIN_LAT - .1, 0.],
+                                                 [ORIGIN_LON + 250 * RESOLUTION, ORIGIN_LON - .5], [ORIGIN_LAT, 1.])
+    assert sorted(zip(boxes, overlapped)) == [(0, 0), (0, 1)]  # touching the second column of tiles at its edge
+
+    calls = [lambda: mosaic.dataset, lambda: mosaic.terrain, lambda: mosaic.lat_lon_to_pixel(mosaic.point()),
+             lambda: mosaic.lat_lon_to_pixel_array(lons, lats), lambda: mosaic.read_window(0, 4, 0, 4),
+             lambda: mosaic.build_graph(), lambda: mosaic.get_overview(2)]
+    for call in calls:
+        with pytest.raises(TypeError):
+            call()
+    tile = mosaic.tile(mosaic.tile_at(points[0]))
+    assert tile.lat_lon_to_pixel_array(lons[0], lats[0]) == (pytest.approx(100.5), pytest.approx(100.5))
+
+
+def test_pixel_transforms(raster):
+    """
+
+    Test that the array transforms match the scalar ones, and that the point type and inverse geotransform are reused
+
+    """
+    map_ = Map(raster)
+    assert map_.point() is map_.point()
+    assert type(map_.pixel_to_lat_lon(0, 0)) is map_.point()
+    assert map_.inverse_affine is map_.inverse_affine
+
+    cols, rows = np.array([0, 10.5, NCOL - .25]), np.array([0, 20.25, NROW - .5])
+    lons, lats = map_.pixel_to_lat_lon_array(cols, rows)
+    for col, row, lon, lat in zip(cols, rows, lons, lats):
+        coord = map_.pixel_to_lat_lon(col, row)
+        assert (coord.lon, coord.lat) == pytest.approx((lon, lat))
+        assert map_.lat_lon_to_pixel(coord) == pytest.approx((col, row))
+    px, py = map_.lat_lon_to_pixel_array(lons, lats)
+    assert np.allclose(px, cols) and np.allclose(py, rows)
+
+    map_.affine = map_.affine * map_.affine.translation(1, 0)  # a replaced geotransform is inverted anew
+    assert map_.lat_lon_to_pixel(map_.pixel_to_lat_lon(0, 0)) == pytest.approx((0, 0))
+    assert map_.lat_lon_to_pixel(coordinate(Map(raster), 0, 0))[0] == pytest.approx(-.5)
+
+
+def test_build_graph(raster, tmpdir):
+    """
+
+    Test the grid graph of a decimated region: edge costs, obstacles, coordinates and the on-disk cache
+
+    """
+    map_ = Map(raster)
+    cache_dir = str(tmpdir.join('graphs'))
+    graph = map_.build_graph(factor=4, cache_dir=cache_dir)
+    rows, cols = NROW // 4, NCOL // 4
+    assert map_.graph is graph and graph.shape == (rows, cols) and graph.num_vertices == rows * cols
+    assert graph.num_edges == 2 * (rows * (cols - 1) + (rows - 1) * cols) + 4 * (rows - 1) * (cols - 1)
+    assert len(graph[cols + 1]) == 8
+
+    # the max-reduced ramp climbs 4 per pixel eastwards and 4 * NCOL per pixel southwards
+    east = map_.vincenty_inverse_array(graph.lons[0], graph.lats[0], graph.lons[1], graph.lats[1])['distance']
+    assert graph[0][1] == pytest.approx(east + 4) and graph[1][0] == pytest.approx(east)
+    assert graph[0][cols] > graph[cols][0] + 4 * NCOL - 1
+    assert graph.vertex_at(*coordinate(map_, 9, 13)[:2]) == (13 // 4) * cols + 9 // 4
+    assert graph.vertex_at(ORIGIN_LON - 1, ORIGIN_LAT) == -1
+    assert len([name for name in os.listdir(cache_dir) if name.endswith('.graph')]) == 1
+    cached = map_.build_graph(factor=4, cache_dir=cache_dir)
+    assert cached is not graph and np.array_equal(cached.weights, graph.weights)
+    assert np.array_equal(cached.lons, graph.lons) and cached.transform == graph.transform
+
+    obstacles = np.zeros((rows, cols), dtype=bool)
+    obstacles[:-1, cols // 2] = True
+    walled = map_.build_graph(factor=4, obstacles=obstacles, climb_penalty=0., cache=False)
+    path = walled.shortest_path(0, cols - 1)
+    assert (rows - 1) * cols + cols // 2 in path
+    assert not any(obstacles.ravel()[path])
+
+    region = map_.build_graph(bounds=(ORIGIN_LON, ORIGIN_LAT - .1, ORIGIN_LON + .05, ORIGIN_LAT), cache=False,
+                              ceiling=50 * NCOL, clearance=0.)
+    assert region.shape == (100, 50)
+    assert len(region[49 * 50]) > 0 and len(region[51 * 50]) == 0  # rows from 50 on are above the ceiling
@@ -3,7 +3,7 @@ from __future__ import (absolute_import, division, print_function, unicode_liter
 
 from tower.units.units import Speed, Weight
 
-from tower.map.graph import Graph
+from tower.map.graph import Graph, CompactGraph
 from tower.controllers.vehicle_controller_plugins.quadrotor_plugins.quadrotor_pid_plugin import QuadrotorPID
 from tower.tower import Tower
 from tower.units.units import Speed, Weight
@@ -22,6 +22,63 @@ def butter_lowpass_filter(b, a, data):
     return y
 
 
+class RingBuffer(object):
+    """
+
+    Fixed-capacity history of equally sized samples, e.g. vehicle states, preallocated once. Each sample is written
+    twice, at its slot and at the same slot in a mirrored second half, so that the samples held always sit in
+    contiguous rows, oldest first: appending is O(1) and `view` returns them without copying.
+
+    """
+
+    def __init__(self, capacity, width, dtype=np.float64):
+        """
+
+        :param capacity: number of samples kept, older samples being overwritten
+        :param width: number of values in each sample
+        :param dtype: type of the values
+
+        """
+        if capacity < 1:
+            raise ValueError("capacity must be positive")
+        self.capacity = int(capacity)
+        self._data = np.zeros((2 * self.capacity, width), dtype=dtype)
+        self._next = 0  # slot of the next sample
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def full(self):
+        return self._count == self.capacity
+
+    def append(self, sample):
+        """
+
+        :param sample: sequence of `width` values, replacing the oldest sample once the buffer is full
+
+        """
+        self._data[self._next] = self._data[self._next + self.capacity] = sample
+        self._next = (self._next + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def view(self):
+        """
+
+        :return: read-only (samples, width) view of the samples held, oldest first; it follows later appends, so copy
+        it to keep it
+
+        """
+        start = self._next + self.capacity - self._count
+        view = self._data[start:start + self._count]
+        view.flags.writeable = False
+        return view
+
+    def clear(self):
+        self._next = self._count = 0
+
+
 class Frame(object):
 
     def __init__(self, value=None):
@@ -60,7 +117,7 @@ class FrameHistory(object):
     def __init__(self, extrapolating=False, filtering=False, **kwargs):
         self.extrapolation_max = kwargs.get('extrapolation_max', 5)
         self._cutoff, self._fs, self._order = kwargs.get('cutoff', 20), kwargs.get('fs', 120), kwargs.get('order', 4)
-        self.smooth_operator = np.array([0, 0, 0, 0, 0, 0])  # no need to ask...
+        self.smooth_operator = RingBuffer(kwargs.get('history_length', 250), 6)  # states fed to the filter
         self.current_frame = None
         self.l_frame = None
         self.ll_frame = None
@@ -132,17 +189,11 @@ class FrameHistory(object):
 
         """
         if state is not None:  # not None if frame is valid, or we could extrapolate
-            self.smooth_operator = np.vstack((self.smooth_operator, state))
+            self.smooth_operator.append(state)
             self.prev_time = time.time()
-            filtered = []
-            if self.smooth_operator.shape[0] > 250:
-                self.smooth_operator = np.delete(self.smooth_operator, 0, 0)
-                # Filter
-                for column in range(len(self.current_frame.state + 1)):
-                    filt = butter_lowpass_filter(self._b, self._a, self.smooth_operator[:, column])
-                    #print("Last", filt[-1])
-                    filtered.append(filt[-1])
-                return filtered
+            if self.smooth_operator.full:
+                # Filter each state variable over the history, oldest first
+                return butter_lowpass_filter(self._b, self._a, self.smooth_operator.view().T)[:, -1].tolist()
         return None
 
     def decode_packet(self, packet):
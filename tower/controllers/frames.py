@@ -11,6 +11,7 @@ import time
 import numpy as np
 from scipy import signal
 
+from tower.controllers.feedback.frames import RingBuffer
 from tower.map.dynamics import euler_from_quaternion
 
 
@@ -98,7 +99,7 @@ class FrameBuffer(object):
     def __init__(self, extrapolating=False, filtering=False, **kwargs):
         self.extrapolation_max = kwargs.get('extrapolation_max', 5)
         self._cutoff, self._fs, self._order = kwargs.get('cutoff', 20), kwargs.get('fs', 120), kwargs.get('order', 4)
-        self.smooth_operator = np.array([0, 0, 0, 0, 0, 0])  # no need to ask...
+        self.smooth_operator = RingBuffer(kwargs.get('history_length', 250), 6)  # states fed to the filter
         self.current_frame = None
         self.l_frame = None
         self.ll_frame = None
@@ -200,17 +201,11 @@ class FrameBuffer(object):
 
         """
         if state is not None:  # not None if frame is valid, or we could extrapolate
-            self.smooth_operator = np.vstack((self.smooth_operator, state))
+            self.smooth_operator.append(state)
             self.prev_time = time.time()
-            filtered = []
-            if self.smooth_operator.shape[0] > 250:
-                self.smooth_operator = np.delete(self.smooth_operator, 0, 0)
-                # Filter
-                for column in range(len(self.current_frame.state + 1)):
-                    filt = butter_lowpass_filter(self._b, self._a, self.smooth_operator[:, column])
-                    # print("Last", filt[-1])
-                    filtered.append(filt[-1])
-                return filtered
+            if self.smooth_operator.full:
+                # Filter each state variable over the history, oldest first
+                return butter_lowpass_filter(self._b, self._a, self.smooth_operator.view().T)[:, -1].tolist()
         return None
 
     def decode_packet(self, packet):
@@ -0,0 +1,94 @@
+"""
+
+Caching primitives for the map data layer. Raster reads go through GDAL, which is comparatively expensive for the
+small windows requested by path-profile and point-elevation clients; caching whole decoded blocks lets neighbouring
+queries be answered from memory.
+
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import threading
+from collections import OrderedDict
+
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+
+
+class BlockCache(object):
+    """
+
+    A thread-safe, least-recently-used cache of decoded raster blocks, bounded by the total size of the blocks held.
+
+    Keys are arbitrary hashables, typically (band, block_row, block_col) tuples matching a raster's internal tiling.
+    Values are numpy arrays; their `nbytes` is charged against `max_bytes`, and the least recently used blocks are
+    evicted whenever an insert would exceed it.
+
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        """
+
+        :param max_bytes: upper bound on the total size, in bytes, of the blocks held by the cache
+
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def __contains__(self, key):
+        return key in self._blocks
+
+    def get(self, key):
+        """
+
+        Retrieve a block, marking it as most recently used
+
+        :param key: key of the block to be retrieved
+        :return: the cached block, or None if it is not in the cache
+
+        """
+        with self._lock:
+            try:
+                block = self._blocks.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._blocks[key] = block
+            self.hits += 1
+            return block
+
+    def put(self, key, block):
+        """
+
+        Insert a block, evicting least recently used blocks until the cache is back under its memory cap. Blocks
+        larger than the cap on their own are not cached.
+
+        :param key: key of the block to be stored
+        :param block: numpy array holding the decoded block
+
+        """
+        with self._lock:
+            previous = self._blocks.pop(key, None)
+            if previous is not None:
+                self.nbytes -= previous.nbytes
+            if block.nbytes > self.max_bytes:
+                return
+            self._blocks[key] = block
+            self.nbytes += block.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._blocks.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def clear(self):
+        """
+
+        Drop every cached block
+
+        """
+        with self._lock:
+            self._blocks.clear()
+            self.nbytes = 0
@@ -0,0 +1,171 @@
+"""
+
+Vectorized geodesic kernels. Each function takes coordinates in decimal degrees as numpy arrays (or anything numpy
+can broadcast) together with the parameters of the ellipsoid, and evaluates every coordinate pair at once, so that
+e.g. all pairwise separations of a swarm can be computed with lons[:, None] and lons[None, :].
+
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import numpy as np
+
+TWO_PI = 2 * np.pi
+
+
+def haversine(lons1, lats1, lons2, lats2, radius):
+    """
+
+    Great-circle distance on a sphere, using the haversine formula
+
+    :param lons1: longitudes of the start points
+    :param lats1: latitudes of the start points
+    :param lons2: longitudes of the end points
+    :param lats2: latitudes of the end points
+    :param radius: radius of the sphere; the distances are returned in the same units
+    :return: array of distances
+
+    """
+    phi1, phi2 = np.radians(lats1), np.radians(lats2)
+    d_phi, d_lambda = phi2 - phi1, np.radians(np.subtract(lons2, lons1))
+    h = np.sin(d_phi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(d_lambda / 2) ** 2
+    return 2 * radius * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+
+def vincenty_inverse(lons1, lats1, lons2, lats2, a, f, tolerance=1e-12, max_iterations=200):
+    """
+
+    Solve the inverse geodesic problem with Vincenty's formulae. The iteration on lambda is carried out only for the
+    pairs that have not yet converged; nearly antipodal pairs that never converge keep their last iterate.
+
+    :param lons1: longitudes of the start points
+    :param lats1: latitudes of the start points
+    :param lons2: longitudes of the end points
+    :param lats2: latitudes of the end points
+    :param a: semi-major axis of the ellipsoid
+    :param f: flattening of the ellipsoid
+    :param tolerance: convergence threshold on lambda, in radians
+    :param max_iterations: upper bound on the number of iterations
+    :return: tuple of (distances, forward azimuths, reverse azimuths); distances are in the units of `a`, azimuths are
+    in radians in [0, 2pi)
+
+    """
+    lons1, lats1, lons2, lats2 = np.broadcast_arrays(*[np.asarray(x, dtype=np.float64)
+                                                       for x in (lons1, lats1, lons2, lats2)])
+    shape = lons1.shape
+    b = a * (1 - f)
+
+    u1 = np.arctan((1 - f) * np.tan(np.radians(lats1.ravel())))
+    u2 = np.arctan((1 - f) * np.tan(np.radians(lats2.ravel())))
+    sin_u1, cos_u1, sin_u2, cos_u2 = np.sin(u1), np.cos(u1), np.sin(u2), np.cos(u2)
+    omega = np.radians(lons2.ravel() - lons1.ravel())
+
+    def evaluate(lambda_, i):
+        sin_lambda, cos_lambda = np.sin(lambda_), np.cos(lambda_)
+        sin_sigma = np.hypot(cos_u2[i] * sin_lambda, cos_u1[i] * sin_u2[i] - sin_u1[i] * cos_u2[i] * cos_lambda)
+        cos_sigma = sin_u1[i] * sin_u2[i] + cos_u1[i] * cos_u2[i] * cos_lambda
+        sigma = np.arctan2(sin_sigma, cos_sigma)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sin_alpha = np.where(sin_sigma == 0, 0., cos_u1[i] * cos_u2[i] * sin_lambda / sin_sigma)
+            cos2_alpha = 1 - sin_alpha ** 2
+            # cos2_alpha vanishes on equatorial lines, where cos_2sigma_m is taken as 0
+            cos_2sigma_m = np.where(cos2_alpha == 0, 0., cos_sigma - 2 * sin_u1[i] * sin_u2[i] / cos2_alpha)
+        return sin_lambda, cos_lambda, sin_sigma, cos_sigma, sigma, sin_alpha, cos2_alpha, cos_2sigma_m
+
+    lambda_ = omega.copy()
+    active = np.arange(len(omega))
+    for _ in range(max_iterations):
+        if len(active) == 0:
+            break
+        _, _, sin_sigma, cos_sigma, sigma, sin_alpha, cos2_alpha, cos_2sigma_m = evaluate(lambda_[active], active)
+        c = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+        updated = omega[active] + (1 - c) * f * sin_alpha * \
+            (sigma + c * sin_sigma * (cos_2sigma_m + c * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)))
+        converged = np.abs(updated - lambda_[active]) <= tolerance
+        lambda_[active] = updated
+        active = active[~converged]
+
+    everything = slice(None)
+    sin_lambda, cos_lambda, sin_sigma, cos_sigma, sigma, sin_alpha, cos2_alpha, cos_2sigma_m = \
+        evaluate(lambda_, everything)
+    u_sq = cos2_alpha * (a * a - b * b) / (b * b)
+    big_a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+    big_b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+    delta_sigma = big_b * sin_sigma * (cos_2sigma_m + big_b / 4 * (cos_sigma * (-1 + 2 * cos_2sigma_m ** 2) -
+                                                                   big_b / 6 * cos_2sigma_m *
+                                                                   (-3 + 4 * sin_sigma ** 2) *
+                                                                   (-3 + 4 * cos_2sigma_m ** 2)))
+    distances = b * big_a * (sigma - delta_sigma)
+
+    forward = np.arctan2(cos_u2 * sin_lambda, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lambda)
+    reverse = np.arctan2(cos_u1 * sin_lambda, -sin_u1 * cos_u2 + cos_u1 * sin_u2 * cos_lambda) + np.pi
+    forward, reverse = np.mod(forward, TWO_PI), np.mod(reverse, TWO_PI)
+
+    coincident = distances == 0
+    forward[coincident], reverse[coincident] = 0., 0.
+    return distances.reshape(shape), forward.reshape(shape), reverse.reshape(shape)
+
+
+def vincenty_direct(lons1, lats1, azimuths, distances, a, f, tolerance=1e-12, max_iterations=200):
+    """
+
+    Solve the direct geodesic problem with Vincenty's formulae, iterating on sigma per element
+
+    :param lons1: longitudes of the start points
+    :param lats1: latitudes of the start points
+    :param azimuths: forward azimuths at the start points, in degrees
+    :param distances: distances to travel, in the units of `a`
+    :param a: semi-major axis of the ellipsoid
+    :param f: flattening of the ellipsoid
+    :param tolerance: convergence threshold on sigma, in radians
+    :param max_iterations: upper bound on the number of iterations
+    :return: tuple of (longitudes, latitudes, reverse azimuths) of the end points, all in degrees, longitudes wrapped
+    into [-180, 180)
+
+    """
+    lons1, lats1, azimuths, distances = np.broadcast_arrays(*[np.asarray(x, dtype=np.float64)
+                                                              for x in (lons1, lats1, azimuths, distances)])
+    shape = lons1.shape
+    b = a * (1 - f)
+    alpha1 = np.radians(azimuths.ravel())
+    sin_alpha1, cos_alpha1 = np.sin(alpha1), np.cos(alpha1)
+    s = distances.ravel()
+
+    tan_u1 = (1 - f) * np.tan(np.radians(lats1.ravel()))
+    cos_u1 = 1 / np.sqrt(1 + tan_u1 ** 2)
+    sin_u1 = tan_u1 * cos_u1
+    sigma1 = np.arctan2(tan_u1, cos_alpha1)
+    sin_alpha = cos_u1 * sin_alpha1
+    cos2_alpha = 1 - sin_alpha ** 2
+    u_sq = cos2_alpha * (a * a - b * b) / (b * b)
+    big_a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+    big_b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+
+    def delta(sigma, i):
+        cos_2sigma_m = np.cos(2 * sigma1[i] + sigma)
+        sin_sigma, cos_sigma = np.sin(sigma), np.cos(sigma)
+        return big_b[i] * sin_sigma * (cos_2sigma_m + big_b[i] / 4 * (cos_sigma * (-1 + 2 * cos_2sigma_m ** 2) -
+                                                                      big_b[i] / 6 * cos_2sigma_m *
+                                                                      (-3 + 4 * sin_sigma ** 2) *
+                                                                      (-3 + 4 * cos_2sigma_m ** 2)))
+
+    sigma = s / (b * big_a)
+    active = np.arange(len(s))
+    for _ in range(max_iterations):
+        if len(active) == 0:
+            break
+        updated = s[active] / (b * big_a[active]) + delta(sigma[active], active)
+        converged = np.abs(updated - sigma[active]) <= tolerance
+        sigma[active] = updated
+        active = active[~converged]
+
+    sin_sigma, cos_sigma = np.sin(sigma), np.cos(sigma)
+    cos_2sigma_m = np.cos(2 * sigma1 + sigma)
+    phi2 = np.arctan2(sin_u1 * cos_sigma + cos_u1 * sin_sigma * cos_alpha1,
+                      (1 - f) * np.hypot(sin_alpha, sin_u1 * sin_sigma - cos_u1 * cos_sigma * cos_alpha1))
+    lambda_ = np.arctan2(sin_sigma * sin_alpha1, cos_u1 * cos_sigma - sin_u1 * sin_sigma * cos_alpha1)
+    c = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+    omega = lambda_ - (1 - c) * f * sin_alpha * \
+        (sigma + c * sin_sigma * (cos_2sigma_m + c * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)))
+    reverse = np.mod(np.arctan2(sin_alpha, -sin_u1 * sin_sigma + cos_u1 * cos_sigma * cos_alpha1) + np.pi, TWO_PI)
+
+    lons2 = np.mod(lons1.ravel() + np.degrees(omega) + 180., 360.) - 180.
+    return lons2.reshape(shape), np.degrees(phi2).reshape(shape), np.degrees(reverse).reshape(shape)
@@ -1,14 +1,72 @@
 from __future__ import (absolute_import, division, print_function, unicode_literals)
+import bisect
 import future
 from future.utils import viewitems
+import heapq
+import json
+import math
+import os
+import shutil
 import sys
+import tempfile
+import numpy as np
 from pqdict import PQDict
 
+from tower.map.cache import BlockCache
+from tower.map.landmarks import Landmarks
+from tower.map.trajectory import Cycle, Path  # formerly defined here
+
 if sys.version_info[:2] < (2, 7):
     from ordereddict import OrderedDict
 else:
     from collections import OrderedDict
 
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python 2
+    from collections import Mapping
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import dijkstra as csgraph_dijkstra
+except ImportError:
+    csr_matrix = csgraph_dijkstra = None
+
+TREE_CACHE_BYTES = 256 * 1024 * 1024  # default memory cap of a CompactGraph's cache of shortest-path trees
+GRAPH_FORMAT_VERSION = 1  # bump whenever the on-disk layout of saved graphs changes, see `CompactGraph.save`
+MAX_LOGGED_CHANGES = 1 << 16  # edge changes a CompactGraph remembers for incremental searches, see `changes_since`
+
+# Smallest radius of curvature of the WGS84 ellipsoid, a * (1 - e^2). Great-circle distances on a sphere of this radius
+# never exceed geodesic distances on the ellipsoid, so they are admissible (and consistent) A* heuristics.
+WGS84_MIN_RADIUS = 6335439.327
+
+
+def great_circle_heuristic(radius=WGS84_MIN_RADIUS):
+    """
+
+    Default A* heuristic for graphs whose vertices are coordinates, e.g. Map points: the great-circle distance between
+    two vertices with `lon` and `lat` attributes, in degrees
+
+    :param radius: radius of the sphere, in the units of the edge weights
+    :return: function of (vertex, target) returning a lower bound on the length of the path between them
+
+    """
+    def heuristic(vertex, target):
+        phi1, phi2 = math.radians(vertex.lat), math.radians(target.lat)
+        h = math.sin((phi2 - phi1) / 2) ** 2 + \
+            math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(target.lon - vertex.lon) / 2) ** 2
+        return 2 * radius * math.asin(math.sqrt(min(h, 1.)))
+    return heuristic
+
+
+def has_coordinates(vertex):
+    return hasattr(vertex, 'lon') and hasattr(vertex, 'lat')
+
 
 class Vertex(dict):
     # __slots__ = []
@@ -97,10 +155,10 @@ class Graph(dict):
 
     def __setitem__(self, key, val):
         self.num_vertices += 1
-        if key not in set(self.keys()):
+        if not dict.__contains__(self, key):
             dict.__setitem__(self, key, val)
         for key, val in viewitems(val):
-            if key not in set(self.keys()):
+            if not dict.__contains__(self, key):
                 self.num_vertices += 1
                 dict.__setitem__(self, key, Vertex(key))
 
@@ -195,30 +253,37 @@ class Graph(dict):
          (a loop back to the vertex) or two vertices.
 
         """
-        edges = []
+        edges, seen = [], set()
         for key, vertex in viewitems(self):
             for neighbor in vertex:
-                if set((key, neighbor)) not in edges and self[key][neighbor] > 0:
+                edge = frozenset((key, neighbor))
+                if edge not in seen and self[key][neighbor] > 0:
+                    seen.add(edge)
                     edges.append((key, neighbor))
         return edges
 
     def find_path(self, start_vertex, end_vertex, path=[]):
         """
 
-        Find a path from start_vertex to end_vertex in graph
+        Find a path (not necessarily the shortest) from start_vertex to end_vertex in graph, by depth-first search
+        along edges; each vertex is visited at most once
+
+        :param path: vertices to prepend to the path found, and to avoid
+        :return: the list of vertices along the path, or None if there is none
 
         """
-        graph = self
-        path = path + [start_vertex]
-        if start_vertex == end_vertex:
-            return path
-        if start_vertex not in graph:
-            return None
-        for vertex in graph.keys():
-            if vertex not in path:
-                extended_path = self.find_path(vertex, end_vertex, path)
-                if extended_path:
-                    return extended_path
+        visited = set(path)
+        stack = [(start_vertex, list(path) + [start_vertex])]
+        while stack:
+            vertex, path = stack.pop()
+            if vertex == end_vertex:
+                return path
+            if vertex in visited or vertex not in self:
+                continue
+            visited.add(vertex)
+            for neighbor in self[vertex]:
+                if neighbor not in visited:
+                    stack.append((neighbor, path + [neighbor]))
         return None
 
     def dijkstra(self, start, end):
@@ -292,91 +357,1019 @@ class Graph(dict):
         path.reverse()
         return path
 
-class Path(object):
+    def a_star(self, start, end, heuristic=None):
+        """
+
+        Find a shortest path from the start vertex to the end with the A* algorithm: vertices are expanded in order of
+        their distance from the start plus the heuristic's estimate of their distance to the end, so that a search
+        guided by a good estimate expands few vertices beyond those near the path. The heuristic must never
+        overestimate (and, for the distances in D to be final, must be consistent).
+
+        :param start: key to starting node
+        :param end: key to ending node
+        :param heuristic: function of (vertex, end) returning a lower bound on the length of a path between them. By
+        default, the great-circle distance when vertices are coordinates (see `great_circle_heuristic`), and 0 (making
+        the search Dijkstra's) otherwise.
+        :return: a pair (D,P) as for `dijkstra`, where D holds the vertices expanded before reaching the end
+
+        """
+        if heuristic is None:
+            heuristic = great_circle_heuristic() if has_coordinates(start) and has_coordinates(end) else \
+                lambda vertex, target: 0.
+        d = {}  # dictionary of final distances
+        p = {}  # dictionary of predecessors
+        g = {start: 0}  # best known distances of non-final vertices
+        heap, counter = [(heuristic(start, end), 0, start)], 1  # the counter breaks ties without comparing vertices
+        while heap:
+            _, _, v_ = heapq.heappop(heap)
+            if v_ in d:
+                continue
+            d[v_] = g.pop(v_)
+            if v_ == end:
+                break
+            for w in self[v_]:
+                vwLength = d[v_] + self[v_][w]
+                if w not in d and (w not in g or vwLength < g[w]):
+                    g[w], p[w] = vwLength, v_
+                    heapq.heappush(heap, (vwLength + heuristic(w, end), counter, w))
+                    counter += 1
+        return d, p
+
+    def k_shortest_paths(self, start, end, k):
+        """
+
+        The k shortest loopless paths from the start vertex to the end, searched on a compact copy of the graph, see
+        `CompactGraph.k_shortest_paths`
+
+        """
+        return self.compact().k_shortest_paths(start, end, k)
+
+    def save(self, directory, replace=True):
+        """
+
+        Store the graph on disk in the layout of `CompactGraph.save`; `CompactGraph.load` maps it back into memory
+
+        """
+        self.compact().save(directory, replace)
+
+    def compact(self):
+        """
+
+        :return: a CompactGraph holding the same vertices and edges
+
+        """
+        return CompactGraph.from_dict(self)
+
+
+class Neighbors(Mapping):
     """
 
-    Formally, can be understood to represent a simply connected, directed graph.
+    Read-only view of the neighbours of one vertex of a CompactGraph, mapping neighbour ids to edge weights like the
+    inner dictionaries of a Graph
 
     """
 
-    origin = None
-    destination = None
+    __slots__ = ('graph', 'position')
 
-    def __init__(self, vertices=[]):
-        self.num_vertices = len(vertices)
-        self.vertices = vertices
-        self.origin = vertices[0]
-        self.destination = vertices[-1]
-        self.idx = -1
+    def __init__(self, graph, position):
+        self.graph = graph
+        self.position = position
+
+    def _slice(self):
+        graph = self.graph
+        return slice(graph.indptr[self.position], graph.indptr[self.position + 1])
+
+    def __len__(self):
+        return int(self.graph.indptr[self.position + 1] - self.graph.indptr[self.position])
 
     def __iter__(self):
-        return self
+        return iter(self.graph.id_of(self.graph.indices[self._slice()]))
+
+    def __getitem__(self, neighbor):
+        graph, row = self.graph, self._slice()
+        try:
+            target = graph.position_of(neighbor)
+        except KeyError:
+            raise KeyError(neighbor)
+        # rows are sorted by target, see `CompactGraph.from_edges`
+        k = row.start + np.searchsorted(graph.indices[row], target)
+        if k < row.stop and graph.indices[k] == target:
+            return graph.weights[k]
+        raise KeyError(neighbor)
+
+    @property
+    def id(self):
+        return self.graph.id_of(self.position)
+
+    def __str__(self):
+        return str(self.id) + ' adjacent: ' + str(list(self))
+
+
+class ShortestPathTree(object):
+    """
+
+    Arrays of a search from one vertex, see `CompactGraph.shortest_path_tree`; `complete` if the search covered every
+    vertex reachable from the source rather than stopping at its targets
 
-    def __next__(self):
-        return self.next()
+    """
+
+    __slots__ = ('distances', 'predecessors', 'settled', 'complete')
+
+    def __init__(self, distances, predecessors, settled, complete):
+        self.distances, self.predecessors, self.settled = distances, predecessors, settled
+        self.complete = complete
+
+    @property
+    def nbytes(self):
+        return self.distances.nbytes + self.predecessors.nbytes + self.settled.nbytes
 
-    def next(self):
+    def covers(self, targets):
         """
 
-        Get the next Coord in path
+        :return: True if the distances to the given vertex positions are final
 
         """
-        if self.idx < len(self.vertices) - 1:
-            self.idx += 1
-            return self.vertices[self.idx]
-        else:
-            self.idx = len(self.vertices)
-            raise StopIteration
+        return self.complete or bool(self.settled[targets].all())
+
+
+def _check_saved_graph(directory):
+    """
 
-    def has_next(self):
+    Raise ValueError unless the path is free or holds what `CompactGraph.save` would write there, that is a link or a
+    directory holding graph.json, so that saving never replaces or removes anything else
+
+    :param directory: path of a graph
+    :return:
+
+    """
+    if os.path.islink(directory) and not os.path.exists(directory):
+        return  # a dangling link
+    if os.path.lexists(directory) and not os.path.isfile(os.path.join(directory, 'graph.json')):
+        raise ValueError('%s exists and does not hold a saved graph' % directory)
+
+
+class CompactGraph(Mapping):
+    """
+
+    Directed graph held in compressed sparse row (CSR) arrays, for graphs too large for Graph's dictionaries, e.g.
+    grid graphs over rasters. Vertices are numbered 0..n-1 by position; the out-edges of the vertex at position i are
+    `indices[indptr[i]:indptr[i + 1]]`, sorted by target, with their lengths in the matching slice of `weights`.
+
+    Vertex ids are either the positions themselves (`ids` is None), or arbitrary hashables mapped to positions through
+    `index`. The graph behaves as a read-only dictionary of vertex ids to `Neighbors` views, so that code written for
+    Graph, such as `dijkstra` and `shortest_path`, works on it unchanged. Edges are built in bulk with `from_edges`;
+    edge weights can be changed in place with `set_weight` (and edges closed with `remove_edge`), and edges added with
+    `add_edges`. Each change increments `version`, which lets caches and preprocessed structures built on the graph
+    notice that it has been modified, and is logged so that incremental searches can repair their state, see
+    `changes_since` and `tower.map.replanning`.
+
+    Graphs are stored on disk as raw arrays with `save`, and `load` maps them into memory, so that several processes can
+    share one read-only planning graph. Graphs queried many times, such as the static terrain graph of a mission, can
+    be preprocessed for faster A* with
+    `preprocess` (ALT landmarks). Shortest-path trees are kept in an LRU cache, `trees`, keyed by their source and
+    emptied whenever the graph changes; repeated `shortest_path` queries, and the one-to-many and many-to-many queries
+    of `distances`, `shortest_paths` and `distance_matrix`, are answered from it.
+
+    """
+
+    def __init__(self, indptr, indices, weights, ids=None, lons=None, lats=None, radius=WGS84_MIN_RADIUS):
         """
 
-        Return true if there are more nodes after current node in dll
+        Wrap existing CSR arrays; see `from_edges` to build them
+
+        :param indptr: array of n + 1 offsets into `indices`
+        :param indices: array of edge targets, by position, sorted within each row
+        :param weights: array of edge lengths
+        :param ids: optional sequence of n distinct vertex ids; numpy arrays of numbers or strings are used as they are
+        :param lons: optional array of vertex longitudes, see `set_coordinates`
+        :param lats: optional array of vertex latitudes
+        :param radius: see `set_coordinates`
 
         """
-        if self.idx < len(self.vertices) - 1:
-            return True
-        else:
+        self.indptr = np.ascontiguousarray(indptr, dtype=np.int64)
+        self.indices = np.ascontiguousarray(indices, dtype=np.intp)
+        self.weights = np.ascontiguousarray(weights, dtype=np.float64)
+        self.ids = None
+        if isinstance(ids, np.ndarray) and ids.dtype != object:
+            self.ids = ids
+        elif ids is not None:
+            self.ids = np.empty(len(ids), dtype=object)  # filled one by one, so that tuple ids stay whole
+            for i, id_ in enumerate(ids):
+                self.ids[i] = id_
+        self._index = None
+        self.version = 0
+        self.landmarks = None
+        self._lists = None
+        self._changes = []  # (version, source, target) of recent edge changes, see `changes_since`
+        self.trees = BlockCache(TREE_CACHE_BYTES)
+        self._trees_version = 0
+        self._reversed = None  # (version, graph) of the reversed graph, for trees of paths towards a vertex
+        self.lons = self.lats = self._trig = None
+        self.radius = radius
+        if lons is not None:
+            self.set_coordinates(lons, lats, radius)
+
+    @classmethod
+    def from_edges(cls, sources, targets, weights=None, ids=None, num_vertices=None, directed=True, **kwargs):
+        """
+
+        Build a graph in bulk from arrays of edges. Duplicate edges are merged, keeping the shortest.
+
+        :param sources: array of edge sources, as positions (or as ids, if `ids` is given)
+        :param targets: array of edge targets, likewise
+        :param weights: array of edge lengths, 1 for every edge by default
+        :param ids: optional sequence of vertex ids; sources and targets are then looked up in it
+        :param num_vertices: number of vertices, by default one more than the largest position used (or len(ids))
+        :param directed: if False, every edge is added in both directions
+        :param kwargs: `lons`, `lats` and `radius` are passed on to the constructor
+        :return: a CompactGraph
+
+        """
+        if ids is not None:
+            index = dict((id_, i) for i, id_ in enumerate(ids))
+            sources = np.array([index[v] for v in sources], dtype=np.intp)
+            targets = np.array([index[v] for v in targets], dtype=np.intp)
+            num_vertices = len(ids)
+        sources, targets = np.asarray(sources, dtype=np.intp).ravel(), np.asarray(targets, dtype=np.intp).ravel()
+        weights = np.ones(len(sources)) if weights is None else \
+            np.broadcast_to(np.asarray(weights, dtype=np.float64), sources.shape).ravel()
+        if not directed:
+            sources, targets = np.concatenate((sources, targets)), np.concatenate((targets, sources))
+            weights = np.concatenate((weights, weights))
+        if num_vertices is None:
+            num_vertices = int(max(sources.max(), targets.max())) + 1 if len(sources) else 0
+
+        # sort by source, then target, then weight, and keep the first (shortest) of each run of parallel edges
+        order = np.lexsort((weights, targets, sources))
+        sources, targets, weights = sources[order], targets[order], weights[order]
+        keep = np.ones(len(sources), dtype=bool)
+        keep[1:] = (sources[1:] != sources[:-1]) | (targets[1:] != targets[:-1])
+        sources, targets, weights = sources[keep], targets[keep], weights[keep]
+
+        indptr = np.zeros(num_vertices + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=num_vertices), out=indptr[1:])
+        return cls(indptr, targets, weights, ids, **kwargs)
+
+    @classmethod
+    def from_dict(cls, graph):
+        """
+
+        :param graph: a Graph, or any dictionary of vertices to dictionaries of neighbours and edge lengths
+        :return: a CompactGraph holding the same vertices and edges
+
+        """
+        ids = list(graph.keys())
+        known = set(ids)
+        for neighbors in graph.values():
+            for neighbor in neighbors:
+                if neighbor not in known:
+                    known.add(neighbor)
+                    ids.append(neighbor)
+        edges = [(u, v, w) for u in list(graph.keys()) for v, w in viewitems(graph[u])]
+        sources, targets, weights = zip(*edges) if edges else ((), (), ())
+        return cls.from_edges(sources, targets, np.array(weights, dtype=np.float64), ids=ids)
+
+    @property
+    def num_vertices(self):
+        return len(self.indptr) - 1
+
+    @property
+    def index(self):
+        """
+
+        Dictionary of vertex ids to positions, built on first use; None if the vertices are identified by position
+
+        """
+        if self._index is None and self.ids is not None:
+            self._index = dict((id_, i) for i, id_ in enumerate(self.ids.tolist()))
+        return self._index
+
+    @property
+    def num_edges(self):
+        return len(self.indices)
+
+    def position_of(self, id_):
+        """
+
+        :return: position of the vertex with the given id; KeyError if there is none
+
+        """
+        if self.index is not None:
+            return self.index[id_]
+        if isinstance(id_, (int, np.integer)) and 0 <= id_ < self.num_vertices:
+            return int(id_)
+        raise KeyError(id_)
+
+    def id_of(self, positions):
+        """
+
+        :return: the id (or array of ids) of the vertex (or array of vertices) at the given position(s)
+
+        """
+        if self.ids is None:
+            return positions.tolist() if isinstance(positions, np.ndarray) else positions
+        if isinstance(positions, np.ndarray):
+            return self.ids[positions].tolist()
+        id_ = self.ids[positions]
+        return id_.item() if isinstance(id_, np.generic) else id_
+
+    def __len__(self):
+        return self.num_vertices
+
+    def __iter__(self):
+        return iter(range(self.num_vertices)) if self.ids is None else iter(self.ids.tolist())
+
+    def __contains__(self, id_):
+        try:
+            self.position_of(id_)
+        except (KeyError, TypeError):
             return False
+        return True
+
+    def __getitem__(self, id_):
+        return Neighbors(self, self.position_of(id_))
+
+    def get_vertex(self, id_):
+        """
+
+        If there is a vertex matching the given id, return a view of its neighbours
+
+        """
+        return self[id_] if id_ in self else None
+
+    def get_vertices(self):
+        return list(self)
+
+    def neighbors(self, position):
+        """
+
+        :param position: position of a vertex
+        :return: tuple of (targets, weights) arrays of the vertex's out-edges, by position
+
+        """
+        start, stop = self.indptr[position], self.indptr[position + 1]
+        return self.indices[start:stop], self.weights[start:stop]
+
+    def edge_arrays(self):
+        """
+
+        :return: tuple of (sources, targets, weights) arrays holding every edge, by position
+
+        """
+        sources = np.repeat(np.arange(self.num_vertices), np.diff(self.indptr))
+        return sources, self.indices, self.weights
+
+    def get_edges(self):
+        """
+
+        The edges of the graph with positive, finite lengths, as (from, to) pairs of ids; an edge present in both
+        directions is listed once, like `Graph.get_edges`
+
+        """
+        sources, targets, weights = self.edge_arrays()
+        keep = (weights > 0) & np.isfinite(weights) & ((sources <= targets) | ~self._has_edges(targets, sources))
+        return list(zip(self.id_of(sources[keep]), self.id_of(targets[keep])))
 
-    def previous(self):
+    def _has_edges(self, sources, targets):
         """
 
-        Get the previous coordinate in path
+        :return: boolean array flagging which of the (source, target) position pairs are edges of the graph
 
+        """
+        keys = np.repeat(np.arange(self.num_vertices, dtype=np.int64), np.diff(self.indptr)) * self.num_vertices + \
+            self.indices
+        queries = np.asarray(sources, dtype=np.int64) * self.num_vertices + np.asarray(targets, dtype=np.int64)
+        k = np.minimum(np.searchsorted(keys, queries), max(len(keys) - 1, 0))
+        return keys[k] == queries if len(keys) else np.zeros(len(queries), dtype=bool)
+
+    def _edge_position(self, source, target):
+        start, stop = self.indptr[source], self.indptr[source + 1]
+        k = start + np.searchsorted(self.indices[start:stop], target)
+        if k < stop and self.indices[k] == target:
+            return k
+        return None
+
+    def set_weight(self, frm, to, weight):
+        """
+
+        Change the length of an existing edge in place
+
+        :param frm: id of the source of the edge
+        :param to: id of the target of the edge
+        :param weight: new length of the edge
+
+        """
+        source, target = self.position_of(frm), self.position_of(to)
+        k = self._edge_position(source, target)
+        if k is None:
+            raise KeyError((frm, to))
+        self.weights[k] = weight
+        self.version += 1
+        self._log_change(source, target)
+        if self._lists is not None and self._lists[0] == self.version - 1:  # keep the list copies current
+            self._lists[1][2][k] = float(weight)
+            self._lists = (self.version, self._lists[1])
+
+    def remove_edge(self, frm, to):
+        """
+
+        Close an edge, e.g. one crossing a new no-fly zone, by making it infinitely long. The edge keeps its place in
+        the CSR arrays, so that it can be reopened with `set_weight` and incremental searches can be repaired around it.
+
+        :param frm: id of the source of the edge
+        :param to: id of the target of the edge
+
+        """
+        self.set_weight(frm, to, float('inf'))
+
+    def _log_change(self, source, target):
+        self._changes.append((self.version, int(source), int(target)))
+        if len(self._changes) > MAX_LOGGED_CHANGES:
+            del self._changes[:MAX_LOGGED_CHANGES // 2]
+
+    def changes_since(self, version):
+        """
+
+        :param version: an earlier `version` of the graph
+        :return: list of (source, target) positions of the edges whose lengths changed since that version, or None if
+        they are not all known: edges were added, or too many changes were made since
+
+        """
+        changes = self._changes[bisect.bisect_left(self._changes, (version + 1,)):]
+        if len(changes) != self.version - version or any(source < 0 for _, source, _ in changes):
+            return None
+        return [(source, target) for _, source, target in changes]
+
+    def add_edges(self, sources, targets, weights=None, directed=True):
+        """
+
+        Add edges between existing vertices, replacing the lengths of those already present. The CSR arrays are
+        rebuilt, so edges are best added in large batches.
+
+        :param sources: array of edge sources, as ids
+        :param targets: array of edge targets, as ids
+        :param weights: array of edge lengths, 1 for every edge by default
+
+        """
+        sources = np.array([self.position_of(v) for v in sources], dtype=np.intp)
+        targets = np.array([self.position_of(v) for v in targets], dtype=np.intp)
+        weights = np.ones(len(sources)) if weights is None else \
+            np.broadcast_to(np.asarray(weights, dtype=np.float64), sources.shape)
+        if not directed:
+            sources, targets = np.concatenate((sources, targets)), np.concatenate((targets, sources))
+            weights = np.concatenate((weights, weights))
+        old_sources, old_targets, old_weights = self.edge_arrays()
+        # new edges take precedence over existing ones: drop the existing edges they replace
+        stale = np.isin(old_sources.astype(np.int64) * self.num_vertices + old_targets,
+                        sources.astype(np.int64) * self.num_vertices + targets)
+        graph = CompactGraph.from_edges(np.concatenate((old_sources[~stale], sources)),
+                                        np.concatenate((old_targets[~stale], targets)),
+                                        np.concatenate((old_weights[~stale], weights)), num_vertices=self.num_vertices)
+        self.indptr, self.indices, self.weights = graph.indptr, graph.indices, graph.weights
+        self.version += 1
+        self._log_change(-1, -1)
+
+    def reverse(self):
+        """
+
+        :return: a CompactGraph with the same vertices and every edge reversed
+
+        """
+        sources, targets, weights = self.edge_arrays()
+        order = np.argsort(targets, kind='mergesort')  # stable, so that the new targets stay sorted within each row
+        indptr = np.zeros(self.num_vertices + 1, dtype=np.int64)
+        np.cumsum(np.bincount(targets, minlength=self.num_vertices), out=indptr[1:])
+        return CompactGraph(indptr, sources[order], weights[order], self.ids, self.lons, self.lats, self.radius)
+
+    def preprocess(self, landmarks=8, file_name=None, seed=0):
         """
 
-        if self.idx > 0:
-            self.idx -= 1
-            return self.vertices[self.idx]
+        Compute ALT landmarks (see `tower.map.landmarks`), which then guide `a_star` and `shortest_path` in place of the
+        great-circle heuristic. Preprocessing takes two full shortest-path trees per landmark; queries on large graphs
+        then typically expand a small fraction of the vertices plain A* would. Once the graph is modified (its `version`
+        changes), its landmarks are ignored and queries fall back to the default search until `preprocess` is called
+        again.
+
+        :param landmarks: number of landmarks
+        :param file_name: optional .npz file to load the landmarks from, if it holds landmarks of this graph, and to
+        store them in otherwise
+        :param seed: seed of the landmark selection
+        :return: the Landmarks
+
+        """
+        self.landmarks = None
+        if file_name is not None and os.path.exists(file_name):
+            try:
+                self.landmarks = Landmarks.load(file_name, self)
+            except ValueError:  # computed on another graph, or an earlier version of this one
+                pass
+        if self.landmarks is None:
+            self.landmarks = Landmarks.build(self, landmarks, seed)
+            if file_name is not None:
+                self.landmarks.save(file_name)
+        return self.landmarks
+
+    def set_coordinates(self, lons, lats, radius=WGS84_MIN_RADIUS):
+        """
+
+        Attach a geographic position to every vertex, enabling the great-circle heuristic of `a_star`
+
+        :param lons: array of vertex longitudes, in degrees, by position
+        :param lats: array of vertex latitudes, in degrees, by position
+        :param radius: radius of the sphere on which great-circle distances are taken, in the units of the edge
+        weights; it must make them lower bounds on path lengths, see WGS84_MIN_RADIUS
+
+        """
+        self.lons, self.lats = np.asarray(lons, dtype=np.float64), np.asarray(lats, dtype=np.float64)
+        self.radius = radius
+        self._trig = None
+
+    def great_circle_heuristic(self, target):
+        """
+
+        :param target: position of the target vertex
+        :return: function of a vertex position returning the great-circle distance from the vertex to the target
+
+        """
+        if self._trig is None:  # radians and cosines of the latitudes, as lists for the search loops
+            lats = np.radians(self.lats)
+            self._trig = (np.radians(self.lons).tolist(), lats.tolist(), np.cos(lats).tolist())
+        lons, lats, cos_lats = self._trig
+        lon, lat, cos_lat, diameter = lons[target], lats[target], cos_lats[target], 2 * self.radius
+        sin, asin, sqrt = math.sin, math.asin, math.sqrt
+
+        def heuristic(u):
+            h = sin((lats[u] - lat) / 2) ** 2 + cos_lats[u] * cos_lat * sin((lons[u] - lon) / 2) ** 2
+            return diameter * asin(sqrt(h if h < 1. else 1.))
+        return heuristic
+
+    def shortest_path_tree(self, source, target=None, heuristic=None):
+        """
+
+        Dijkstra's algorithm over the CSR arrays, with a binary heap and lazy deletion; given a target and a heuristic,
+        A*. Edge lengths must be non-negative, and the heuristic consistent.
+
+        :param source: position of the start vertex
+        :param target: optional position of a vertex (or, without heuristic, collection of positions of vertices) at
+        which to stop, once the distances are final
+        :param heuristic: optional function of a vertex position returning a lower bound on its distance to the target
+        :return: tuple of (distances, predecessors, settled) arrays over vertex positions: distances are inf for
+        vertices not reached, predecessors -1 for the source and vertices not reached, and settled flags the vertices
+        whose distance is final
+
+        """
+        if target is None and heuristic is None and csgraph_dijkstra is not None:  # a whole tree, searched by scipy
+            n = self.num_vertices
+            matrix = csr_matrix((self.weights, self.indices, self.indptr), shape=(n, n))
+            distances, predecessors = csgraph_dijkstra(matrix, indices=source, return_predecessors=True)
+            predecessors = np.where(predecessors < 0, -1, predecessors).astype(np.intp)
+            return distances, predecessors, np.isfinite(distances)
+        n = self.num_vertices
+        indptr, indices, weights = self.adjacency_lists()
+        inf = float('inf')
+        distances, predecessors, settled = [inf] * n, [-1] * n, [False] * n
+        distances[source] = 0.
+        push, pop = heapq.heappush, heapq.heappop
+        if heuristic is None:
+            remaining = set() if target is None else \
+                set([target]) if isinstance(target, (int, np.integer)) else set(target)
+            heap = [(0., source)]
+            while heap:
+                d, u = pop(heap)
+                if settled[u]:
+                    continue
+                settled[u] = True
+                if u in remaining:
+                    remaining.discard(u)
+                    if not remaining:
+                        break
+                for k in range(indptr[u], indptr[u + 1]):
+                    v, dv = indices[k], d + weights[k]
+                    if dv < distances[v]:
+                        distances[v], predecessors[v] = dv, u
+                        push(heap, (dv, v))
         else:
-            raise StopIteration
+            estimates = [-1.] * n  # heuristic values, computed once per vertex reached
+            heap = [(heuristic(source), source)]
+            while heap:
+                _, u = pop(heap)
+                if settled[u]:
+                    continue
+                settled[u] = True
+                if u == target:
+                    break
+                d = distances[u]
+                for k in range(indptr[u], indptr[u + 1]):
+                    v, dv = indices[k], d + weights[k]
+                    if dv < distances[v]:
+                        distances[v], predecessors[v] = dv, u
+                        h = estimates[v]
+                        if h < 0.:
+                            h = estimates[v] = heuristic(v)
+                        push(heap, (dv + h, v))
+        return np.array(distances), np.array(predecessors, dtype=np.intp), np.array(settled, dtype=bool)
+
+    def adjacency_lists(self):
+        """
+
+        The CSR arrays in the form the pure-Python search loops index fastest: memoryviews, which share the arrays'
+        memory (and so that of graphs mapped from disk), or lists on Python 2. They are kept until the graph changes.
+
+        :return: tuple of (indptr, indices, weights) sequences
+
+        """
+        if self._lists is None or self._lists[0] != self.version:
+            arrays = (self.indptr, self.indices, self.weights)
+            self._lists = (self.version, tuple(a.tolist() for a in arrays) if sys.version_info[0] < 3 else
+                           tuple(memoryview(a) for a in arrays))
+        return self._lists[1]
+
+    def _arrays(self):
+        """
+
+        :return: tuple of the dictionaries of the arrays and of the attributes stored by `save`
+
+        """
+        arrays = dict(indptr=self.indptr, indices=self.indices, weights=self.weights)
+        if self.ids is not None:
+            arrays['ids'] = self.ids
+            if self.ids.dtype == object:  # store plain numbers and strings as raw arrays, which can be mapped
+                for dtype in (np.int64, np.str_):
+                    kinds = (int, np.integer) if dtype is np.int64 else (type(''), np.str_)
+                    if all(isinstance(id_, kinds) and not isinstance(id_, bool) for id_ in self.ids):
+                        arrays['ids'] = self.ids.astype(dtype)
+                        break
+        if self.lons is not None:
+            arrays.update(lons=self.lons, lats=self.lats)
+        return arrays, dict(radius=self.radius)
+
+    @classmethod
+    def _from_arrays(cls, arrays, attributes):
+        return cls(arrays['indptr'], arrays['indices'], arrays['weights'], arrays.get('ids'), arrays.get('lons'),
+                   arrays.get('lats'), attributes['radius'])
+
+    def save(self, directory, replace=True):
+        """
+
+        Store the graph in a directory holding one raw .npy file per array (the CSR arrays, vertex ids and coordinates)
+        and a graph.json of its other attributes. The files are written to a new directory next to `directory`, which
+        is then made a symbolic link to it, atomically: readers see either the previous graph or the new one in full,
+        never a partial or missing one. Where symbolic links are not available, the new directory is renamed into
+        place instead, after moving a previous one aside.
+
+        :param directory: path of the graph
+        :param replace: replace a graph already saved there; if False, it is kept, as suits caches whose content is
+        determined by their name, which concurrent processes may save at the same time. Anything else found at the
+        path is left alone, and raises ValueError.
 
-    def has_previous(self):
         """
+        if os.path.lexists(directory):
+            if not replace:
+                return
+            _check_saved_graph(directory)  # before writing anything
+        arrays, attributes = self._arrays()
+        parent, base = os.path.split(os.path.abspath(directory))
+        data = tempfile.mkdtemp(prefix=base + '.', suffix='.data', dir=parent)  # private to this save
+        os.chmod(data, 0o755)
+        for name, array in viewitems(arrays):
+            np.save(os.path.join(data, name + '.npy'), array, allow_pickle=array.dtype == object)
+        with open(os.path.join(data, 'graph.json'), 'w') as f:
+            json.dump(dict(format=GRAPH_FORMAT_VERSION, type=type(self).__name__, arrays=sorted(arrays),
+                           attributes=attributes), f)
+
+        if not replace:
+            try:
+                if hasattr(os, 'symlink'):
+                    os.symlink(os.path.basename(data), directory)
+                else:
+                    os.rename(data, directory)
+            except OSError:
+                if not os.path.lexists(directory):
+                    raise
+                shutil.rmtree(data, ignore_errors=True)  # saved concurrently
+            return
+        link = None
+        if hasattr(os, 'symlink'):
+            link = data + '.link'
+            os.symlink(os.path.basename(data), link)
+        with open(directory + '.lock', 'a') as lock:
+            if fcntl is not None:  # concurrent saves take turns, so that each removes the graph it replaced
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                _check_saved_graph(directory)
+            except ValueError:
+                if link is not None:
+                    os.remove(link)
+                shutil.rmtree(data, ignore_errors=True)
+                raise
+            previous = os.path.realpath(directory) if os.path.islink(directory) else None
+            if os.path.isdir(directory) and previous is None:  # a plain directory, saved without a link
+                previous = data + '.old'
+                os.rename(directory, previous)
+            os.rename(link or data, directory)
+        if previous is not None:
+            shutil.rmtree(previous, ignore_errors=True)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """
+
+        Load a graph stored by `save`, mapping its arrays into memory rather than reading them: loading is immediate
+        and processes mapping the same graph share its pages. Vertex ids that are neither numbers nor strings are read
+        in full.
 
-        Return true if there are nodes before current node in dll
+        :param directory: path of the graph
+        :param mmap_mode: 'r' maps the graph read-only, so that `set_weight` raises ValueError; 'c' maps it
+        copy-on-write, so that changes stay private to the process; None reads the arrays into memory
+        :return: a graph of this class; e.g. GridGraph.load restores the grid attributes of a saved GridGraph
 
         """
-        if self.idx < len(self.nodes):
-            return True
+        while True:
+            path = os.path.realpath(directory)
+            try:
+                with open(os.path.join(path, 'graph.json')) as f:
+                    header = json.load(f)
+                if header['format'] != GRAPH_FORMAT_VERSION:
+                    raise ValueError("%s holds a graph in format %s, not %s" % (directory, header['format'],
+                                                                             GRAPH_FORMAT_VERSION))
+                arrays = {}
+                for name in header['arrays']:
+                    file_name = os.path.join(path, name + '.npy')
+                    try:
+                        arrays[name] = np.load(file_name, mmap_mode=mmap_mode)
+                    except ValueError:  # object arrays cannot be mapped
+                        arrays[name] = np.load(file_name, allow_pickle=True)
+                return cls._from_arrays(arrays, header['attributes'])
+            except (IOError, OSError):
+                if os.path.realpath(directory) == path:
+                    raise
+                # replaced, and the previous graph removed, while it was being read: read the new one
+
+    def _heuristic(self, source, target, heuristic):
+        """
+
+        Resolve the `heuristic` argument of `a_star` into a function of vertex positions
+
+        """
+        if heuristic is None:
+            if self.landmarks is not None and self.landmarks.version == self.version:
+                return self.landmarks.heuristic(source, target)
+            return self.great_circle_heuristic(target) if self.lons is not None else None
+        if self.ids is None:
+            return lambda u: heuristic(u, target)
+        ids, end = self.ids, self.ids[target]
+        return lambda u: heuristic(ids[u], end)
+
+    def dijkstra(self, start, end):
+        """
+
+        Find shortest paths from the start vertex to all vertices nearer than or equal to the end, see
+        `Graph.dijkstra`
+
+        :param start: id of the starting vertex
+        :param end: id of the ending vertex
+        :return: The output is a pair (D,P) where D[v] is the distance from start to v and P[v] is the
+        predecessor of v along the shortest path from s to v.
+
+        """
+        return self._search_result(*self.shortest_path_tree(self.position_of(start), self.position_of(end)))
+
+    def a_star(self, start, end, heuristic=None):
+        """
+
+        Find a shortest path from the start vertex to the end with A*, see `Graph.a_star`
+
+        :param start: id of the starting vertex
+        :param end: id of the ending vertex
+        :param heuristic: function of (vertex id, end id) returning a lower bound on the length of a path between
+        them; by default the landmark bounds if the graph is preprocessed (see `preprocess`), else the great-circle
+        distance if the graph has coordinates (see `set_coordinates`), and none (making the search Dijkstra's) otherwise
+        :return: a pair (D,P) as for `dijkstra`
+
+        """
+        source, target = self.position_of(start), self.position_of(end)
+        return self._search_result(*self.shortest_path_tree(source, target, self._heuristic(source, target, heuristic)))
+
+    def _search_result(self, distances, predecessors, settled):
+        """
+
+        Convert the arrays of `shortest_path_tree` into the (D,P) dictionaries of `dijkstra`
+
+        """
+        final = np.flatnonzero(settled)
+        reached = np.flatnonzero(predecessors >= 0)
+        d = dict(zip(self.id_of(final), distances[final].tolist()))
+        p = dict(zip(self.id_of(reached), self.id_of(predecessors[reached])))
+        return d, p
+
+    def shortest_path(self, start, end, heuristic=None):
+        """
+
+        Find a single shortest path from the given start vertex to the given end vertex, see `Graph.shortest_path`.
+        The path is read from the cached tree of the start if it reaches the end; otherwise it is searched, with A*
+        whenever a heuristic is available (see `a_star`), and the tree cached.
+
+        :param start: id of the starting vertex
+        :param end: id of the ending vertex
+        :param heuristic: see `a_star`
+        :return: list of the ids of the vertices along the path; KeyError if `end` cannot be reached
+
+        """
+        source, target = self.position_of(start), self.position_of(end)
+        tree = self._cached_tree(source)
+        if tree is None or not tree.covers(target):
+            arrays = self.shortest_path_tree(source, target, self._heuristic(source, target, heuristic))
+            tree = ShortestPathTree(*arrays, complete=False)
+            if heuristic is None:  # trees searched with custom heuristics are not shared
+                self.trees.put((False, source), tree)
+        if not np.isfinite(tree.distances[target]):
+            raise KeyError(end)
+        return self._path(tree.predecessors, source, target)
+
+    def _path(self, predecessors, source, target):
+        path = [target]
+        while path[-1] != source:
+            path.append(predecessors[path[-1]])
+        path.reverse()
+        return [self.id_of(int(v)) for v in path]
+
+    def _cached_tree(self, source, reverse=False):
+        if self._trees_version != self.version:
+            self.trees.clear()
+            self._trees_version = self.version
+        return self.trees.get((reverse, source))
+
+    def search_tree(self, source, targets=None, reverse=False):
+        """
+
+        Shortest-path tree from a vertex, from the cache of trees if it holds one covering the targets, and otherwise
+        searched until the targets (those of the cached tree included) are settled
+
+        :param source: position of the source vertex
+        :param targets: optional collection of positions of vertices whose distances are needed; by default, all
+        :param reverse: if True, the tree of the shortest paths from every vertex *to* the source, searched over the
+        reversed graph
+        :return: ShortestPathTree over vertex positions
+
+        """
+        tree = self._cached_tree(source, reverse)
+        targets = None if targets is None else np.asarray(targets, dtype=np.intp)
+        if tree is not None and (tree.complete or targets is not None and tree.covers(targets)):
+            return tree
+        if targets is not None and tree is not None:
+            targets = np.union1d(targets, np.flatnonzero(tree.settled))
+        graph = self
+        if reverse:
+            if self._reversed is None or self._reversed[0] != self.version:
+                self._reversed = (self.version, self.reverse())
+            graph = self._reversed[1]
+        tree = ShortestPathTree(*graph.shortest_path_tree(source, None if targets is None else targets.tolist()),
+                                complete=targets is None)
+        self.trees.put((reverse, source), tree)
+        return tree
+
+    def distances(self, start, ends):
+        """
+
+        One-to-many shortest path lengths, from a single search
+
+        :param start: id of the starting vertex
+        :param ends: sequence of ids of ending vertices
+        :return: array of the lengths of the shortest paths from the start to each end, inf for those not reachable
+
+        """
+        targets = [self.position_of(end) for end in ends]
+        if not targets:
+            return np.empty(0)
+        return self.search_tree(self.position_of(start), targets).distances[targets]
+
+    def shortest_paths(self, start, ends):
+        """
+
+        One-to-many shortest paths, from a single search
+
+        :param start: id of the starting vertex
+        :param ends: sequence of ids of ending vertices
+        :return: dictionary of the ends reachable from the start to the lists of the ids of the vertices along the
+        shortest paths to them
+
+        """
+        source, targets = self.position_of(start), [self.position_of(end) for end in ends]
+        tree = self.search_tree(source, targets) if targets else None
+        return dict((end, self._path(tree.predecessors, source, target)) for end, target in zip(ends, targets)
+                    if np.isfinite(tree.distances[target]))
+
+    def distance_matrix(self, starts, ends):
+        """
+
+        Many-to-many shortest path lengths, e.g. between vehicles and goals for task allocation, with one search per
+        start, or per end over the reversed graph when there are fewer ends than starts
+
+        :param starts: sequence of ids of starting vertices
+        :param ends: sequence of ids of ending vertices
+        :return: (starts, ends) array of the lengths of the shortest paths, inf where an end is not reachable
+
+        """
+        sources = [self.position_of(start) for start in starts]
+        targets = [self.position_of(end) for end in ends]
+        matrix = np.full((len(sources), len(targets)), np.inf)
+        if not sources or not targets:
+            return matrix
+        if len(targets) < len(sources):
+            for j, target in enumerate(targets):
+                matrix[:, j] = self.search_tree(target, sources, reverse=True).distances[sources]
         else:
-            return False
+            for i, source in enumerate(sources):
+                matrix[i] = self.search_tree(source, targets).distances[targets]
+        return matrix
 
-    def insert(self):
-        pass
+    def k_shortest_paths(self, start, end, k):
+        """
 
-    def remove(self):
-        pass
+        Yen's algorithm for the k shortest loopless paths, e.g. alternative routes for contingency planning. Every path
+        after the first leaves an earlier one at a spur vertex, after a root shared with it. All spur searches share
+        the tree of shortest paths to the end, searched once over the reversed graph (and cached, see `search_tree`):
+        a spur that leaves the root through the edge minimising its length plus the tree distance to the end, and
+        whose tree path then avoids the root, is optimal as it stands; only the remaining spurs are searched, with A*
+        guided by the exact tree distances, so that most searches expand little beyond the path they find.
 
+        :param start: id of the starting vertex
+        :param end: id of the ending vertex
+        :param k: number of paths
+        :return: list of up to k (length, path) pairs by increasing length, each path a list of vertex ids
 
-class Cycle(Path):
-    """
+        """
+        source, target = self.position_of(start), self.position_of(end)
+        tree = self.search_tree(target, reverse=True)
+        to_end, next_hop = tree.distances.tolist(), tree.predecessors.tolist()
+        inf = float('inf')
+        if k < 1 or to_end[source] == inf:
+            return []
+        indptr, indices, weights = self.adjacency_lists()
+
+        def tree_path(v, avoid):
+            path = [v]
+            while v != target:
+                v = next_hop[v]
+                if v in avoid:
+                    return None
+                path.append(v)
+            return path
 
-    Cycle is a connected path that can be traversed continuously
+        def spur_search(spur, avoid, banned):
+            g, predecessors, closed = {spur: 0.}, {}, set()
+            heap = [(to_end[spur], spur)]
+            while heap:
+                _, u = heapq.heappop(heap)
+                if u in closed:
+                    continue
+                if u == target:
+                    path = [u]
+                    while path[-1] != spur:
+                        path.append(predecessors[path[-1]])
+                    return g[u], path[::-1]
+                closed.add(u)
+                for kk in range(indptr[u], indptr[u + 1]):
+                    v = indices[kk]
+                    if v in avoid or to_end[v] == inf or u == spur and v in banned:
+                        continue
+                    dv = g[u] + weights[kk]
+                    if dv < g.get(v, inf):
+                        g[v], predecessors[v] = dv, u
+                        heapq.heappush(heap, (dv + to_end[v], v))
+            return None
 
-    """
-    pass
+        paths = [(to_end[source], tree_path(source, ()))]
+        candidates, seen = [], set([tuple(paths[0][1])])
+        while len(paths) < k:
+            last = paths[-1][1]
+            root_length, root = 0., set()
+            for i, spur in enumerate(last[:-1]):
+                root.add(spur)
+                prefix = last[:i + 1]
+                banned = set(path[i + 1] for _, path in paths if len(path) > i + 1 and path[:i + 1] == prefix)
+                bounds = sorted((weights[kk] + to_end[indices[kk]], kk) for kk in range(indptr[spur], indptr[spur + 1])
+                                if indices[kk] not in banned and indices[kk] not in root)
+                spur_path = None
+                for bound, kk in bounds:
+                    if bound > bounds[0][0] or bound == inf:
+                        break
+                    spur_path = tree_path(indices[kk], root)
+                    if spur_path is not None:
+                        spur_path = (bound, [spur] + spur_path)
+                        break
+                if spur_path is None and bounds and bounds[0][0] < inf:
+                    spur_path = spur_search(spur, root, banned)
+                if spur_path is not None:
+                    path = prefix + spur_path[1][1:]
+                    if tuple(path) not in seen:
+                        seen.add(tuple(path))
+                        heapq.heappush(candidates, (root_length + spur_path[0], path))
+                root_length += weights[self._edge_position(spur, last[i + 1])]
+            if not candidates:
+                break
+            paths.append(heapq.heappop(candidates))
+        return [(length, [self.id_of(v) for v in path]) for length, path in paths]
 
 
 if __name__ == '__main__':
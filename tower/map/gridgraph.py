@@ -0,0 +1,217 @@
+"""
+
+Planning graphs derived from rasters. A rectangular region of a Map, read at full resolution or from a decimated level,
+becomes an 8-connected grid whose vertices are the region's pixels; edge lengths combine the geodesic distance between
+pixel centres with penalties for climbing, and pixels that are no-data, masked as obstacles, or too high to clear are
+left unconnected. Built graphs are cached on disk next to the raster, and mapped back into memory when reused.
+
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import hashlib
+import math
+import os
+
+import numpy as np
+
+from tower.map import geodesy
+from tower.map.graph import CompactGraph
+from tower.map.terrain import fingerprint
+
+# (row, column) offsets of the eight neighbours of a pixel, in increasing order of their row-major position, so that
+# the edges of each vertex come out sorted by target as CompactGraph requires
+NEIGHBORS = ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1))
+GRID_GRAPH_VERSION = 2  # bump whenever the layout or the cost model of cached graphs changes
+
+
+class GridGraph(CompactGraph):
+    """
+
+    A CompactGraph whose vertices are the pixels of a grid, numbered row by row. `transform` holds the six affine
+    coefficients (a, b, c, d, e, f) mapping fractional (column, row) positions of the grid to coordinates, like a
+    raster's geotransform.
+
+    """
+
+    def __init__(self, indptr, indices, weights, shape, transform, elevations=None, **kwargs):
+        """
+
+        :param shape: (rows, columns) of the grid
+        :param transform: affine coefficients of the grid
+        :param elevations: optional (rows, columns) array of the elevation of each pixel
+        :param kwargs: passed on to CompactGraph
+
+        """
+        super(GridGraph, self).__init__(indptr, indices, weights, **kwargs)
+        self.shape = tuple(int(n) for n in shape)
+        self.transform = tuple(float(x) for x in transform)
+        self.elevations = elevations
+
+    def vertex_at(self, lons, lats):
+        """
+
+        :param lons: longitude, or array of longitudes
+        :param lats: latitude, or array of latitudes
+        :return: the vertex (or array of vertices) of the pixel holding each coordinate, -1 for those off the grid
+
+        """
+        a, b, c, d, e, f = self.transform
+        det = a * e - b * d
+        x, y = np.asarray(lons, dtype=np.float64) - c, np.asarray(lats, dtype=np.float64) - f
+        with np.errstate(invalid='ignore'):
+            cols, rows = np.floor((e * x - b * y) / det), np.floor((a * y - d * x) / det)
+            inside = (rows >= 0) & (rows < self.shape[0]) & (cols >= 0) & (cols < self.shape[1])
+        vertices = np.full(inside.shape, -1, dtype=np.intp)
+        vertices[inside] = rows[inside] * self.shape[1] + cols[inside]
+        return int(vertices) if vertices.ndim == 0 else vertices
+
+    def cell_of(self, vertices):
+        """
+
+        :return: tuple of (rows, columns) of the given vertices
+
+        """
+        return np.divmod(vertices, self.shape[1])
+
+    def _arrays(self):
+        arrays, attributes = super(GridGraph, self)._arrays()
+        if self.elevations is not None:
+            arrays['elevations'] = self.elevations
+        attributes.update(shape=self.shape, transform=self.transform)
+        return arrays, attributes
+
+    @classmethod
+    def _from_arrays(cls, arrays, attributes):
+        return cls(arrays['indptr'], arrays['indices'], arrays['weights'], attributes['shape'],
+                   attributes['transform'], arrays.get('elevations'), lons=arrays.get('lons'), lats=arrays.get('lats'),
+                   radius=attributes['radius'])
+
+
+def build_grid_graph(map_, bounds=None, resolution=None, factor=None, reduction='max', climb_penalty=1.,
+                     descent_penalty=0., max_slope=None, ceiling=None, clearance=0., obstacles=None, cache=True,
+                     cache_dir=None, strip_rows=256):
+    """
+
+    Build the 8-connected grid graph of a region of a Map's raster. The edge from pixel u to its neighbour v costs
+
+        distance(u, v) + climb_penalty * max(z(v) - z(u), 0) + descent_penalty * max(z(u) - z(v), 0)
+
+    where the distance is the geodesic between the pixel centres on the map's ellipsoid (or the Euclidean distance
+    in a projected CRS) and z the pixel elevations. Edges are computed for whole strips of rows at a time.
+
+    :param map_: the Map to build the graph from
+    :param bounds: (west, south, east, north) of the region, the whole raster by default
+    :param resolution: build the graph on the coarsest decimated level no coarser than this ground resolution, in
+    the units of the raster's CRS; see `Map.select_overview`
+    :param factor: decimation factor of the level to build the graph on, instead of `resolution`
+    :param reduction: how decimated levels are built, see `Map.get_overview`; 'max' keeps the highest terrain of
+    each decimated pixel, so that clearances are not underestimated
+    :param climb_penalty: cost per unit of height gained
+    :param descent_penalty: cost per unit of height lost
+    :param max_slope: edges steeper than this, in degrees, are left out
+    :param ceiling: highest altitude available, e.g. the flight altitude: pixels whose elevation plus `clearance`
+    exceeds it are obstacles
+    :param clearance: required height above the terrain, see `ceiling`
+    :param obstacles: boolean array shaped like the region at the chosen level, flagging pixels to avoid
+    :param cache: reuse (and store) a graph cached on disk for the same raster, region and parameters
+    :param cache_dir: directory of cached graphs, by default the raster's path with '.graphs' appended
+    :param strip_rows: number of rows of pixels whose edges are computed at once
+    :return: a GridGraph, whose vertices carry the coordinates of their pixel centres on geographic rasters
+
+    """
+    if factor is None:
+        factor = map_.select_overview(resolution=resolution) if resolution is not None else 1
+    level_shape = (map_.nrow, map_.ncol) if factor == 1 else (map_.nrow // factor, map_.ncol // factor)
+    if bounds is None:
+        r0, r1, c0, c1 = 0, level_shape[0], 0, level_shape[1]
+    else:
+        west, south, east, north = bounds
+        px, py = map_.lat_lon_to_pixel_array([west, east, west, east], [north, north, south, south])
+        r0, r1 = max(int(math.floor(py.min() / factor)), 0), min(int(math.ceil(py.max() / factor)), level_shape[0])
+        c0, c1 = max(int(math.floor(px.min() / factor)), 0), min(int(math.ceil(px.max() / factor)), level_shape[1])
+    rows, cols = r1 - r0, c1 - c0
+    if rows <= 0 or cols <= 0:
+        raise ValueError("The region does not overlap the raster")
+    if obstacles is not None:
+        obstacles = np.asarray(obstacles, dtype=bool)
+        if obstacles.shape != (rows, cols):
+            raise ValueError("obstacles must have the shape of the region, (%d, %d)" % (rows, cols))
+
+    parameters = (GRID_GRAPH_VERSION, factor, r0, r1, c0, c1, reduction if factor > 1 else None, climb_penalty,
+                  descent_penalty, max_slope, ceiling, clearance)
+    cache_file = None
+    if cache:
+        sha = hashlib.sha1(repr(parameters).encode('ascii'))
+        if obstacles is not None:
+            sha.update(np.packbits(obstacles).tobytes())
+        cache_dir = cache_dir or map_.file_name + '.graphs'
+        cache_file = os.path.join(cache_dir, '%s-%s.graph' % (fingerprint(map_.file_name), sha.hexdigest()[:16]))
+        if os.path.exists(cache_file):
+            return GridGraph.load(cache_file, mmap_mode='c')  # copy-on-write, so that the cache stays intact
+
+    elevations = map_.read_overview_window(factor, r0, r1, c0, c1, reduction).astype(np.float64)
+    blocked = map_._no_data(elevations)
+    elevations[blocked] = np.nan
+    if obstacles is not None:
+        blocked |= obstacles
+    if ceiling is not None:
+        with np.errstate(invalid='ignore'):
+            blocked |= elevations + clearance > ceiling
+
+    # pixel centres, and the horizontal length of each kind of edge along each row of the region
+    a, b, c, d, e, f = map_.affine[:6]
+    transform = (a * factor, b * factor, a * c0 * factor + b * r0 * factor + c,
+                 d * factor, e * factor, d * c0 * factor + e * r0 * factor + f)
+    centre_cols, centre_rows = np.meshgrid(np.arange(cols) + .5, np.arange(rows) + .5)
+    lons = transform[0] * centre_cols + transform[1] * centre_rows + transform[2]
+    lats = transform[3] * centre_cols + transform[4] * centre_rows + transform[5]
+    geographic = 'PROJCS' not in map_.crs_wkt
+    lengths = np.empty((len(NEIGHBORS), rows))
+    for k, (dr, dc) in enumerate(NEIGHBORS):
+        if geographic:  # on a north-up raster, the length only depends on the row
+            lengths[k] = geodesy.vincenty_inverse(lons[:, 0], lats[:, 0], lons[:, 0] + transform[0] * dc,
+                                                  lats[:, 0] + transform[4] * dr, map_.semimajor, map_.flattening)[0]
+        else:
+            lengths[k] = math.hypot(transform[0] * dc + transform[1] * dr, transform[3] * dc + transform[4] * dr)
+    max_grade = math.tan(math.radians(max_slope)) if max_slope is not None else None
+
+    counts, indices, weights = [], [], []
+    for start in range(0, rows, strip_rows):
+        stop = min(start + strip_rows, rows)
+        strip_r, strip_c = np.meshgrid(np.arange(start, stop), np.arange(cols), indexing='ij')
+        strip_r, strip_c = strip_r.ravel(), strip_c.ravel()
+        z, free = elevations[strip_r, strip_c], ~blocked[strip_r, strip_c]
+        strip_weights = np.full((len(strip_r), len(NEIGHBORS)), np.nan)
+        targets = np.empty((len(strip_r), len(NEIGHBORS)), dtype=np.intp)
+        for k, (dr, dc) in enumerate(NEIGHBORS):
+            tr, tc = strip_r + dr, strip_c + dc
+            valid = free & (tr >= 0) & (tr < rows) & (tc >= 0) & (tc < cols)
+            tr, tc = np.where(valid, tr, 0), np.where(valid, tc, 0)
+            valid &= ~blocked[tr, tc]
+            horizontal = lengths[k][strip_r]
+            dz = elevations[tr, tc] - z
+            if max_grade is not None:
+                with np.errstate(invalid='ignore'):
+                    valid &= np.abs(dz) <= max_grade * horizontal
+            cost = horizontal + climb_penalty * np.maximum(dz, 0) + descent_penalty * np.maximum(-dz, 0)
+            strip_weights[:, k] = np.where(valid, cost, np.nan)
+            targets[:, k] = tr * cols + tc
+        valid = ~np.isnan(strip_weights)
+        counts.append(valid.sum(axis=1))
+        indices.append(targets[valid])  # row-major, hence sorted by target within each vertex
+        weights.append(strip_weights[valid])
+
+    indptr = np.zeros(rows * cols + 1, dtype=np.int64)
+    np.cumsum(np.concatenate(counts), out=indptr[1:])
+    kwargs = dict(elevations=elevations)
+    if geographic:
+        # great-circle distances on a sphere of the ellipsoid's smallest radius of curvature bound geodesics from below
+        kwargs.update(lons=lons.ravel(), lats=lats.ravel(), radius=map_.semimajor * (1 - map_.eccentricity ** 2))
+    graph = GridGraph(indptr, np.concatenate(indices), np.concatenate(weights), (rows, cols), transform, **kwargs)
+    if cache_file is not None:
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:  # created concurrently
+                pass
+        graph.save(cache_file, replace=False)  # concurrent builds of the same graph keep the first one saved
+    return graph
@@ -0,0 +1,194 @@
+"""
+
+ALT preprocessing (A*, landmarks and the triangle inequality) for repeated shortest-path queries on a CompactGraph.
+The distances from and to a few well-spread landmark vertices are computed once; by the triangle inequality, for any
+landmark L and vertices u and t,
+
+    d(u, t) >= d(L, t) - d(L, u)    and    d(u, t) >= d(u, L) - d(t, L)
+
+which gives A* a consistent lower bound that is usually far tighter than the great-circle distance, e.g. on terrain
+graphs where climbing makes paths much longer than their horizontal extent.
+
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import hashlib
+import os
+import sys
+
+import numpy as np
+
+LANDMARKS_VERSION = 1  # bump whenever the layout of saved landmarks changes
+
+
+def checksum(graph):
+    """
+
+    :return: hex digest identifying the edges and weights of a CompactGraph, so that saved landmarks are only loaded
+    for the graph they were computed on
+
+    """
+    sha = hashlib.sha1()
+    for array in (graph.indptr, graph.indices.astype(np.int64), graph.weights):
+        sha.update(np.ascontiguousarray(array).tobytes())
+    return sha.hexdigest()
+
+
+def distances_from(graph, source, reverse=False):
+    """
+
+    Single-source shortest path lengths over a whole CompactGraph, see `CompactGraph.shortest_path_tree`
+
+    :param graph: a CompactGraph
+    :param source: position of the source vertex
+    :param reverse: if True, the lengths of the shortest paths from every vertex *to* the source
+    :return: array of the lengths by vertex position, inf for vertices not connected
+
+    """
+    return (graph.reverse() if reverse else graph).shortest_path_tree(source)[0]
+
+
+class Landmarks(object):
+    """
+
+    Landmark distance tables of a CompactGraph. `forward[i]` holds the distances from landmark i to every vertex and
+    `backward[i]` those from every vertex to it. Landmarks record the graph's `version` when they are attached to it:
+    once the graph has been modified, its bounds may overestimate and the graph no longer uses them, see
+    `CompactGraph.preprocess`.
+
+    """
+
+    def __init__(self, vertices, forward, backward, digest=None, version=0):
+        """
+
+        :param vertices: array of the positions of the landmarks
+        :param forward: (landmarks, vertices) array of distances from the landmarks
+        :param backward: (landmarks, vertices) array of distances to the landmarks
+        :param digest: `checksum` of the graph the distances were computed on
+        :param version: `version` of the graph the distances are valid for
+
+        """
+        self.vertices = np.asarray(vertices, dtype=np.intp)
+        self.forward = np.ascontiguousarray(forward, dtype=np.float64)
+        self.backward = np.ascontiguousarray(backward, dtype=np.float64)
+        self.digest = digest
+        self.version = version
+        self._rows = {}  # rows of the tables in the form heuristics index fastest, see `_row`
+
+    @classmethod
+    def build(cls, graph, count=8, seed=0):
+        """
+
+        Choose landmarks by farthest-point selection, each landmark being the vertex farthest (by the length of the
+        round trip) from those already chosen, starting from the vertex farthest from a random one
+
+        :param graph: a CompactGraph
+        :param count: number of landmarks; fewer are chosen if the graph runs out of vertices with edges
+        :param seed: seed of the random first vertex
+        :return: Landmarks, valid for the current version of the graph
+
+        """
+        n = graph.num_vertices
+        candidates = np.diff(graph.indptr) > 0  # vertices without out-edges make useless landmarks
+        if not candidates.any():
+            raise ValueError("The graph has no edges")
+        start = np.flatnonzero(candidates)[np.random.RandomState(seed).randint(candidates.sum())]
+        spread = distances_from(graph, start)  # round-trip distance to the nearest landmark chosen so far
+        reverse = graph.reverse()
+        vertices, forward, backward = [], [], []
+        for _ in range(count):
+            score = np.where(candidates & np.isfinite(spread), spread, -1.)
+            landmark = int(np.argmax(score))
+            if score[landmark] <= 0:
+                break
+            vertices.append(landmark)
+            forward.append(distances_from(graph, landmark))
+            backward.append(distances_from(reverse, landmark))
+            round_trip = forward[-1] + backward[-1]
+            spread = round_trip if len(vertices) == 1 else np.minimum(spread, round_trip)
+            candidates[landmark] = False
+        if not vertices:
+            raise ValueError("No vertex of the graph can serve as a landmark")
+        return cls(vertices, np.array(forward).reshape(-1, n), np.array(backward).reshape(-1, n), checksum(graph),
+                   graph.version)
+
+    def __len__(self):
+        return len(self.vertices)
+
+    def bounds(self, sources, target):
+        """
+
+        :param sources: position, or array of positions, of vertices
+        :param target: position of the target vertex
+        :return: (landmarks, sources) array of the lower bound each landmark gives on the distance from each source to
+        the target, -inf where it gives none
+
+        """
+        sources = np.atleast_1d(sources)
+        with np.errstate(invalid='ignore'):
+            bounds = np.fmax(self.forward[:, target, None] - self.forward[:, sources],
+                             self.backward[:, sources] - self.backward[:, target, None])
+        return np.where(np.isnan(bounds), -np.inf, bounds)
+
+    def _row(self, table, i):
+        """
+
+        :return: row i of a table as a memoryview, which shares the table's memory, or a list on Python 2, like
+        `CompactGraph.adjacency_lists`
+
+        """
+        key = (table, i)
+        if key not in self._rows:
+            row = (self.forward if table == 'forward' else self.backward)[i]
+            self._rows[key] = row.tolist() if sys.version_info[0] < 3 else memoryview(row)
+        return self._rows[key]
+
+    def heuristic(self, source, target, active=4):
+        """
+
+        :param source: position of the start vertex
+        :param target: position of the target vertex
+        :param active: number of landmarks consulted, those giving the best bounds between the source and target
+        :return: function of a vertex position returning a lower bound on its distance to the target
+
+        """
+        best = np.argsort(-self.bounds(source, target)[:, 0])[:active]
+        terms = [(self._row('forward', i), float(self.forward[i, target]), self._row('backward', i),
+                  float(self.backward[i, target])) for i in best]
+
+        def heuristic(u):
+            h = 0.
+            for forward, to_target, backward, from_target in terms:
+                bound = to_target - forward[u]
+                if bound > h:
+                    h = bound
+                bound = backward[u] - from_target
+                if bound > h:
+                    h = bound
+            return h
+        return heuristic
+
+    def save(self, file_name):
+        """
+
+        Store the distance tables in an .npz file, see `load`
+
+        """
+        partial_file = '%s.%d.tmp.npz' % (file_name, os.getpid())
+        np.savez(partial_file, vertices=self.vertices, forward=self.forward, backward=self.backward,
+                 digest=np.array(self.digest or ''), version=np.array(LANDMARKS_VERSION))
+        os.rename(partial_file, file_name)
+
+    @classmethod
+    def load(cls, file_name, graph):
+        """
+
+        :param file_name: file stored by `save`
+        :param graph: the CompactGraph the landmarks were computed on
+        :return: Landmarks valid for the current version of the graph; ValueError if they were computed on different
+        edges or weights
+
+        """
+        with np.load(file_name) as arrays:
+            if int(arrays['version']) != LANDMARKS_VERSION or str(arrays['digest']) != checksum(graph):
+                raise ValueError("%s does not hold landmarks of this graph" % file_name)
+            return cls(arrays['vertices'], arrays['forward'], arrays['backward'], str(arrays['digest']), graph.version)
@@ -6,14 +6,32 @@ Manages
 """
 from __future__ import (absolute_import, division, print_function, unicode_literals)
 import collections
+import math
+import multiprocessing
+import os
+import threading
+import weakref
 import affine
 affine.set_epsilon(1e-12)  # must set epsilon to small value to prevent sensitive trip of degenerate matrix detection
+import numpy as np
 import rasterio
 from builtins import *
-from geographiclib.geodesic import Geodesic
-from numpy import math
+from tower.map import geodesy
+from tower.map.cache import BlockCache, DEFAULT_CACHE_BYTES
 from tower.map.space import Space
+from tower.map.terrain import Terrain, traverse_grid
 from tower.map.graph import Graph
+from tower.map.gridgraph import build_grid_graph
+
+try:
+    from rasterio import Env as RasterioEnv
+except ImportError:  # rasterio < 1.0 exposes the GDAL environment as `drivers`
+    RasterioEnv = rasterio.drivers
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # Python 2 without the futures backport
+    ThreadPoolExecutor = None
 
 try:
     from osgeo import gdal
@@ -81,6 +99,79 @@ class RetrievePointException(Exception):
         return repr(self.strn)
 
 
+def cubic_weights(t):
+    """
+
+    Weights of the four samples at offsets -1, 0, 1 and 2 for cubic convolution (Keys, a = -0.5) at fractional
+    offset `t` between samples 0 and 1
+
+    :param t: array of fractional offsets in [0, 1)
+    :return: array of shape (4,) + t.shape
+
+    """
+    t2, t3 = t * t, t * t * t
+    return np.array([(-t3 + 2 * t2 - t) / 2,
+                     (3 * t3 - 5 * t2 + 2) / 2,
+                     (-3 * t3 + 4 * t2 + t) / 2,
+                     (t3 - t2) / 2])
+
+
+class _DatasetHandle(object):
+    """
+
+    An open raster dataset held by one thread of one process. The thread-local storage of the Map holds the only strong
+    reference, so that the dataset is closed as soon as its thread exits.
+
+    """
+
+    def __init__(self, file_name):
+        self.dataset = rasterio.open(file_name, 'r')
+        self.pid = os.getpid()
+
+    def close(self):
+        if self.pid == os.getpid():  # a forked child leaves its parent's handles alone
+            self.dataset.close()
+
+    def __del__(self):
+        self.close()
+
+
+MAX_WORKER_MAPS = 4  # Maps kept open by each executor worker process
+_worker_maps = collections.OrderedDict()  # Maps opened by executor workers, keyed by file name and options
+
+
+def _sample_map(map_, lons, lats, kwargs):
+    """
+
+    Executor task behind `Map.get_point_elevations`: sample one shard of points
+
+    :return: tuple of (elevations, mask) arrays
+
+    """
+    elevations = map_.get_point_elevations(lons, lats, **kwargs)
+    return elevations.data, np.ma.getmaskarray(elevations)
+
+
+def _sample_shard(file_name, options, lons, lats, kwargs):
+    """
+
+    Process executor task behind `Map.get_point_elevations`: sample one shard of points with the worker's own Map,
+    opened (with its own dataset and block cache) the first time the worker sees the raster. Each worker keeps the
+    `MAX_WORKER_MAPS` most recently used Maps open, and closes the others.
+
+    :return: tuple of (elevations, mask) arrays
+
+    """
+    key = (file_name, repr(sorted(options.items())))
+    map_ = _worker_maps.pop(key, None)
+    if map_ is None:
+        map_ = Map(file_name, **options)
+    _worker_maps[key] = map_
+    while len(_worker_maps) > MAX_WORKER_MAPS:
+        _worker_maps.popitem(last=False)[1].close()
+    return _sample_map(map_, lons, lats, kwargs)
+
+
 class Map(Space):
     """
 
@@ -94,29 +185,82 @@ class Map(Space):
 
     """
 
+    def __new__(cls, filename=None, *args, **kwargs):
+        """
+
+        A directory or a list of rasters makes a `Mosaic` of them rather than a single-raster Map
+
+        """
+        if cls is Map and filename is not None and (isinstance(filename, (list, tuple)) or os.path.isdir(filename)):
+            from tower.map.mosaic import Mosaic
+            cls = Mosaic
+        return super(Map, cls).__new__(cls)
+
     def __init__(self, filename=None, verbose=False, **kwargs):
+        """
+
+        :param filename: path to the raster backing this map; a directory or list of rasters opens a `Mosaic` instead
+        :param verbose: print the raster's CRS and metadata on load
+        :param kwargs: `cache_bytes` sets the memory cap of the raster block cache, 64 MiB by default. `grid` holds
+        band 1 in an array instead, see `load_grid`; give 'memory' or 'memmap' as the mode, and optionally `grid_file`.
+        `terrain_tile`, `terrain_cell` and `terrain_dir` configure the terrain derivative grids, see `terrain`.
+
+        """
 
         self.file_name = filename
+        self.options = kwargs  # kept so that executor workers can open an identical Map
 
         try:
-            with rasterio.drivers():
+            with RasterioEnv():
                 with rasterio.open(self.file_name, 'r') as ds:
-                    self.affine = ds.meta['affine']
+                    self.affine = ds.meta.get('affine', ds.transform)  # rasterio >= 1.0 keeps the Affine in transform
                     self.ncol = ds.meta['width']
                     self.nrow = ds.meta['height']
-                    self.geo_transform = ds.meta['transform']
+                    self.geo_transform = self.affine.to_gdal()
                     self.no_data_value = ds.meta['nodata']
                     self.crs = ds.crs
-                    self.crs_wkt = ds.crs_wkt
+                    self.crs_wkt = getattr(ds, 'crs_wkt', None) or ds.crs.wkt
                     self.meta = ds.meta
+                    self.block_shape = ds.block_shapes[0]  # (rows, cols) of the raster's internal tiles
+                    self.overview_factors = sorted(ds.overviews(1))  # decimation factors of the native overviews
                     if verbose is True:
                         print(ds.crs)
-                        print(ds.crs_wkt)
-                        print("Metadata:{}".format(self.img.meta))
+                        print(self.crs_wkt)
+                        print("Metadata:{}".format(ds.meta))
         except:
-            raise Exception("Error opening file with Rasterio")
+            raise ReadException("Error opening file with Rasterio")
             sys.exit(1)  # todo: is this necessary?
 
+        # Open datasets are kept per thread (GDAL handles must not be shared between threads) and per process (handles
+        # do not survive a fork); decoded blocks are shared by all threads through the cache.
+        self._local = threading.local()
+        self._handles = weakref.WeakValueDictionary()  # the handles still open, by id, see `close`
+        self._handles_lock = threading.Lock()
+        self.block_cache = BlockCache(max_bytes=kwargs.get('cache_bytes', DEFAULT_CACHE_BYTES))
+        self.cache_prefix = ()  # prepended to block cache keys, to tell apart maps sharing a cache
+        self._inverse_affine = None
+        self.grid = None
+        self._overviews = {}
+        self._terrain = None
+        self._terrain_args = dict(tile_size=kwargs.get('terrain_tile', 256), cell_size=kwargs.get('terrain_cell', 16),
+                                  cache_dir=kwargs.get('terrain_dir', None))
+        if kwargs.get('grid', None) is not None:
+            self.load_grid(kwargs['grid'], grid_file=kwargs.get('grid_file', None))
+
+        self._init_space()
+
+        self.rotation = self.geo_transform[2]  # rotation, 0 if image is 'north-up'
+        self.originX = self.geo_transform[0]  # top-left x
+        self.originY = self.geo_transform[3]  # top-left y
+        self.pixelWidth = self.geo_transform[1]  # w/e pixel resoluton
+        self.pixelHeight = self.geo_transform[5]  # n/s pixel resolution
+
+    def _init_space(self):
+        """
+
+        Set up the spheroid parsed from `crs_wkt`, the planning graph and the point naming of the space
+
+        """
         spheroid_start = self.crs_wkt.find("SPHEROID[") + len("SPHEROID")
         spheroid_end = self.crs_wkt.find("AUTHORITY", spheroid_start)
         self.spheroid = str(self.crs_wkt)[spheroid_start:spheroid_end].strip('[]').split(',')
@@ -127,12 +271,6 @@ class Map(Space):
         self.semiminor = float(self.semimajor * (1 - self.flattening))
         self.eccentricity = math.sqrt(2 * self.flattening - self.flattening * self.flattening)
 
-        self.rotation = self.geo_transform[2]  # rotation, 0 if image is 'north-up'
-        self.originX = self.geo_transform[0]  # top-left x
-        self.originY = self.geo_transform[3]  # top-left y
-        self.pixelWidth = self.geo_transform[1]  # w/e pixel resoluton
-        self.pixelHeight = self.geo_transform[5]  # n/s pixel resolution
-
         self.graph = Graph()    # Graph object used for planning and controller logic.
                                 # Each vehicle will probably alo need to carry arodun an instance of Graph or Path
                                 # to keep track of it's path
@@ -141,6 +279,7 @@ class Map(Space):
         self.__x = 'lon'
         self.__y = 'lat'
         self.__name = 'Coord'
+        self._point = collections.namedtuple(self.name, [self.x, self.y, 'units'])  # created once, see `point`
 
     @property
     def units(self):
@@ -162,6 +301,446 @@ class Map(Space):
     def origin(self):
         pass
 
+    @property
+    def dataset(self):
+        """
+
+        The open raster dataset belonging to the calling thread. It is opened on first use and kept open for
+        subsequent reads; a forked child process opens its own.
+
+        """
+        handle = getattr(self._local, 'handle', None)
+        if handle is None or handle.pid != os.getpid():
+            handle = self._local.handle = _DatasetHandle(self.file_name)
+            with self._handles_lock:
+                self._handles[id(handle)] = handle
+        return handle.dataset
+
+    img = dataset
+
+    def close(self):
+        """
+
+        Close every dataset this process opened for the map and empty the block cache. The map remains usable;
+        datasets are reopened on the next read. Datasets of threads that have exited are already closed.
+
+        """
+        with self._handles_lock:
+            handles, self._handles = list(self._handles.values()), weakref.WeakValueDictionary()
+        for handle in handles:
+            handle.close()
+        self._local = threading.local()
+        self.block_cache.clear()
+
+    def load_grid(self, mode='memmap', grid_file=None):
+        """
+
+        Hold band 1 of the raster as a numpy array, so that point, window and segment queries on it are plain array
+        indexing with no GDAL call. Intended for rasters that fit in memory.
+
+        In 'memory' mode the band is read into a private array. In 'memmap' mode it is memory-mapped read-only from a
+        sidecar .npy file, which is written from the raster first if it is missing or older than the raster; the
+        pages are then shared through the OS page cache by every process mapping the same file.
+
+        :param mode: either 'memory' or 'memmap'
+        :param grid_file: path of the sidecar file, by default the raster's path with '.npy' appended
+        :return: the array holding the band
+
+        """
+        if mode == 'memory':
+            self.grid = self.dataset.read(1)
+            self.grid.setflags(write=False)
+        elif mode == 'memmap':
+            self.grid = self._load_sidecar(grid_file or self.file_name + '.npy', lambda: self.dataset.read(1))
+        else:
+            raise ArgumentError("Unknown grid mode '%s', expected 'memory' or 'memmap'" % mode)
+        return self.grid
+
+    def _load_sidecar(self, file_name, build):
+        """
+
+        Memory-map a derived array stored next to the raster, (re)building it first if it is missing or older than
+        the raster. The array is written under a private name and renamed into place, so that concurrent workers
+        never map a partial file.
+
+        :param file_name: path of the .npy sidecar
+        :param build: callable returning the array to be stored
+        :return: the sidecar, memory-mapped read-only
+
+        """
+        if not os.path.exists(file_name) or os.path.getmtime(file_name) < os.path.getmtime(self.file_name):
+            partial_file = '%s.%d.tmp.npy' % (file_name, os.getpid())
+            np.save(partial_file, build())
+            os.rename(partial_file, file_name)
+        return np.load(file_name, mmap_mode='r')
+
+    def build_graph(self, **kwargs):
+        """
+
+        Fill in `graph` with the 8-connected grid graph of a region of the raster, with terrain-aware edge costs; see
+        `build_grid_graph` for the options. Graphs are cached on disk, so that rebuilding the same graph is a load.
+
+        :return: the GridGraph
+
+        """
+        self.graph = build_grid_graph(self, **kwargs)
+        return self.graph
+
+    @property
+    def terrain(self):
+        """
+
+        Slope, aspect and max elevation grids of the raster, computed lazily and cached on disk, see `Terrain`
+
+        """
+        if self._terrain is None:
+            self._terrain = Terrain(self, **self._terrain_args)
+        return self._terrain
+
+    def get_slopes(self, lons, lats=None):
+        """
+
+        Terrain slope, in degrees, at many coordinates; arguments are as for `get_point_elevations`
+
+        :return: a masked array of slopes; coordinates off the raster or next to no-data pixels are masked
+
+        """
+        return self._terrain_lookup('slope', lons, lats)
+
+    def get_aspects(self, lons, lats=None):
+        """
+
+        Terrain aspect (direction of steepest descent), in degrees clockwise from north, at many coordinates
+
+        :return: a masked array of aspects; coordinates off the raster, next to no-data pixels or on flat ground are
+        masked
+
+        """
+        return self._terrain_lookup('aspect', lons, lats)
+
+    def get_max_elevations(self, lons, lats=None):
+        """
+
+        Highest elevation within the terrain cell (see `Terrain`) holding each coordinate
+
+        :return: a masked array of elevations; coordinates off the raster or in cells without valid data are masked
+
+        """
+        return self._terrain_lookup('max_elevation', lons, lats)
+
+    def _terrain_lookup(self, grid, lons, lats=None):
+        if lats is None:
+            coordinates = np.asarray(lons, dtype=np.float64)
+            lons, lats = coordinates[..., 0], coordinates[..., 1]
+        lons, lats = np.broadcast_arrays(np.asarray(lons, dtype=np.float64), np.asarray(lats, dtype=np.float64))
+        px, py = self.lat_lon_to_pixel_array(lons, lats)
+        cols, rows = np.floor(px).ravel(), np.floor(py).ravel()
+        valid = (rows >= 0) & (rows < self.nrow) & (cols >= 0) & (cols < self.ncol)
+        rows, cols = rows[valid].astype(np.intp), cols[valid].astype(np.intp)
+
+        terrain = self.terrain
+        terrain.ensure(rows, cols)
+        values = np.full(valid.shape, np.nan)
+        if grid == 'max_elevation':
+            values[valid] = terrain.max_elevation[rows // terrain.cell_size, cols // terrain.cell_size]
+        else:
+            values[valid] = getattr(terrain, grid)[rows, cols]
+        return np.ma.masked_invalid(values.reshape(lons.shape))
+
+    def get_line_of_sight(self, start, end, clearance=0., prune=True):
+        """
+
+        Check whether the straight segment between two points clears the terrain, see `get_lines_of_sight`
+
+        :param start: (lon, lat, alt) of the start of the segment
+        :param end: (lon, lat, alt) of the end of the segment
+        :return: dictionary of 'clear' (bool), 'min_clearance' (float) and 'first_violation' ((lon, lat, alt) of the
+        first point closer to the terrain than `clearance`, or None)
+
+        """
+        result = self.get_lines_of_sight([start], [end], clearance, prune)
+        first_violation = None if result['clear'][0] else tuple(result['first_violation'][0])
+        return {'clear': bool(result['clear'][0]), 'min_clearance': float(result['min_clearance'][0]),
+                'first_violation': first_violation}
+
+    def get_lines_of_sight(self, starts, ends, clearance=0., prune=True):
+        """
+
+        Line of sight and terrain clearance of many straight segments at once, e.g. every edge of a planning graph.
+        Altitudes are in the units of the raster's elevations and vary linearly along each segment.
+
+        Each segment is rasterized exactly onto the pixels it crosses, and clearance is measured from the lowest point
+        of the segment within each pixel. With `prune`, the segment is first traversed over the cells of the terrain
+        max elevation grid (see `Terrain`), and only cells whose maximum comes within `clearance` of the segment, or
+        could lower its minimum clearance, are read pixel by pixel; only the blocks holding those cells are read.
+        No-data pixels and parts of segments off the raster are not checked.
+
+        :param starts: array of (lon, lat, alt) rows, the starts of the segments
+        :param ends: array of (lon, lat, alt) rows, the ends of the segments
+        :param clearance: required height above the terrain
+        :param prune: skip cells whose maximum elevation is clearly below the segment
+        :return: dictionary of 'clear' (bool array), 'min_clearance' (array, inf where no terrain was checked) and
+        'first_violation' ((N, 3) array of the first points closer to the terrain than `clearance`, NaN where clear)
+
+        """
+        starts = np.atleast_2d(np.asarray(starts, dtype=np.float64))
+        ends = np.atleast_2d(np.asarray(ends, dtype=np.float64))
+        n = len(starts)
+        inv_affine = self.inverse_affine
+        px0, py0 = self.lat_lon_to_pixel_array(starts[:, 0], starts[:, 1])
+        dx = inv_affine.a * (ends[:, 0] - starts[:, 0]) + inv_affine.b * (ends[:, 1] - starts[:, 1])
+        dy = inv_affine.d * (ends[:, 0] - starts[:, 0]) + inv_affine.e * (ends[:, 1] - starts[:, 1])
+        alt0, d_alt = starts[:, 2], ends[:, 2] - starts[:, 2]
+
+        min_clearance, first_t = np.full(n, np.inf), np.full(n, np.inf)
+
+        def examine(segment, ta, tb):
+            index, t0, t1, rows, cols = traverse_grid(px0[segment], py0[segment], dx[segment], dy[segment], ta, tb)
+            segment = segment[index]
+            elevations, valid = self._sample_pixels(rows, cols)
+            valid &= ~self._no_data(elevations)
+            segment, t0, t1, elevations = segment[valid], t0[valid], t1[valid], elevations[valid]
+            margin = np.minimum(alt0[segment] + d_alt[segment] * t0, alt0[segment] + d_alt[segment] * t1) - elevations
+            np.minimum.at(min_clearance, segment, margin)
+            violating = margin < clearance
+            np.minimum.at(first_t, segment[violating], t0[violating])
+
+        if not prune:
+            examine(np.arange(n), np.zeros(n), np.ones(n))
+        else:
+            terrain = self.terrain
+            segment, t0, t1, rows, cols = traverse_grid(px0, py0, dx, dy, np.zeros(n), np.ones(n),
+                                                        unit=terrain.cell_size)
+            inside = (rows >= 0) & (rows < terrain.max_elevation.shape[0]) & \
+                     (cols >= 0) & (cols < terrain.max_elevation.shape[1])
+            segment, t0, t1, rows, cols = segment[inside], t0[inside], t1[inside], rows[inside], cols[inside]
+            terrain.ensure_cells(rows, cols)
+            # lower bound of the clearance within each cell; +inf for cells without valid data
+            bound = np.minimum(alt0[segment] + d_alt[segment] * t0, alt0[segment] + d_alt[segment] * t1) - \
+                terrain.max_elevation[rows, cols]
+            lowest = np.full(n, np.inf)
+            np.minimum.at(lowest, segment, bound)
+
+            todo = (bound < clearance) | ((bound == lowest[segment]) & np.isfinite(bound))
+            pending = np.ones(len(segment), dtype=bool)
+            while todo.any():
+                examine(segment[todo], t0[todo], t1[todo])
+                pending &= ~todo
+                todo = pending & (bound < min_clearance[segment])
+
+        clear = np.isinf(first_t)
+        first_violation = np.full((n, 3), np.nan)
+        first_violation[~clear] = starts[~clear] + (ends[~clear] - starts[~clear]) * first_t[~clear, None]
+        return {'clear': clear, 'min_clearance': min_clearance, 'first_violation': first_violation}
+
+    def select_overview(self, resolution=None, window=None, max_window=512):
+        """
+
+        Choose the decimation factor to read at: the coarsest level whose pixels are no larger than `resolution`, or
+        the finest level at which a `window` pixels wide full-resolution window is at most `max_window` pixels wide.
+        Candidate levels are the native overview factors and powers of two.
+
+        :param resolution: requested ground resolution, in the units of the raster's CRS
+        :param window: width in full-resolution pixels of the area to be read
+        :param max_window: width in pixels above which `window` is read from a coarser level
+        :return: the decimation factor, 1 for full resolution
+
+        """
+        candidates = set(self.overview_factors)
+        factor = 2
+        while factor <= min(self.nrow, self.ncol):
+            candidates.add(factor)
+            factor *= 2
+        candidates = sorted(f for f in candidates if f <= min(self.nrow, self.ncol))
+
+        if resolution is not None:
+            fitting = [f for f in candidates if f * abs(self.pixelWidth) <= resolution]
+            return fitting[-1] if fitting else 1
+        if window is not None and window > max_window:
+            fitting = [f for f in candidates if window / f <= max_window]
+            return fitting[0] if fitting else candidates[-1]
+        return 1
+
+    def get_overview(self, factor, reduction=None, band=1):
+        """
+
+        Retrieve the raster decimated by `factor`, as an array of shape (nrow // factor, ncol // factor) whose pixel
+        (c, r) covers full-resolution pixels [c * factor, (c + 1) * factor) x [r * factor, (r + 1) * factor).
+
+        Without a `reduction`, the dataset's native overview for the factor is read, which is fast and small. Otherwise,
+        or when there is no such overview, the level is built from the full-resolution raster, strip by strip, by
+        taking the 'min', 'max' or 'mean' (the default) of the valid pixels each level pixel covers; built levels are
+        kept in a sidecar next to the raster, so they are only ever built once.
+
+        :param factor: decimation factor
+        :param reduction: None for the native overview, or one of 'min', 'max' or 'mean'
+        :param band: raster band to read
+        :return: the decimated raster, read-only
+
+        """
+        if factor == 1:
+            return self.grid if self.grid is not None and band == 1 else self.dataset.read(band)
+        if reduction is None and factor not in self.overview_factors:
+            reduction = 'mean'
+        key = (band, factor, reduction)
+        if key not in self._overviews:
+            rows, cols = self.nrow // factor, self.ncol // factor
+            if reduction is None:
+                level = self.dataset.read(band, window=((0, rows * factor), (0, cols * factor)), out_shape=(rows, cols))
+                level.setflags(write=False)
+            elif reduction in ('min', 'max', 'mean'):
+                level = self._load_sidecar('%s.b%d.ovr%d.%s.npy' % (self.file_name, band, factor, reduction),
+                                           lambda: self._reduce(factor, reduction, band))
+            else:
+                raise ArgumentError("Unknown reduction '%s', expected 'min', 'max' or 'mean'" % reduction)
+            self._overviews[key] = level
+        return self._overviews[key]
+
+    def _reduce(self, factor, reduction, band=1):
+        """
+
+        Build a decimated level of the raster, see `get_overview`. Strips of full-resolution rows are read straight
+        from the dataset (bypassing the block cache) and reduced one at a time, to bound memory use.
+
+        """
+        rows, cols = self.nrow // factor, self.ncol // factor
+        fill = self.no_data_value if self.no_data_value is not None else 0
+        dtype = np.float64 if reduction == 'mean' else self.meta['dtype']
+        level = np.empty((rows, cols), dtype=dtype)
+        strip = max(1, (1 << 24) // (factor * factor * max(cols, 1)))  # level rows per strip, ~16M pixels read
+        for row in range(0, rows, strip):
+            stop = min(row + strip, rows)
+            data = self.dataset.read(band, window=((row * factor, stop * factor), (0, cols * factor)))
+            data = np.ma.array(data, mask=self._no_data(data)).reshape(stop - row, factor, cols, factor)
+            level[row:stop] = getattr(data, reduction)(axis=(1, 3)).filled(fill)
+        return level
+
+    def read_overview_window(self, factor, row_start, row_stop, col_start, col_stop, reduction=None, band=1,
+                             boundless=False, fill_value=None):
+        """
+
+        Read a rectangular window from a decimated level of the raster, in that level's pixel coordinates
+
+        :param factor: decimation factor, see `get_overview`
+        :param boundless: see `read_window`
+        :param fill_value: see `read_window`
+        :return: an array of shape (row_stop - row_start, col_stop - col_start)
+
+        """
+        if factor == 1:
+            return self.read_window(row_start, row_stop, col_start, col_stop, band, boundless, fill_value)
+        level = self.get_overview(factor, reduction, band)
+        if row_start < 0 or col_start < 0 or row_stop > level.shape[0] or col_stop > level.shape[1]:
+            if boundless:
+                return self._pad_window(lambda r0, r1, c0, c1: level[r0:r1, c0:c1], level.shape, level.dtype,
+                                        row_start, row_stop, col_start, col_stop, fill_value)
+            raise RetrievePointException("Window ((%d, %d), (%d, %d)) is outside of overview extent" %
+                                         (row_start, row_stop, col_start, col_stop))
+        return np.array(level[row_start:row_stop, col_start:col_stop])
+
+    def read_block(self, block_row, block_col, band=1):
+        """
+
+        Retrieve one of the raster's internal blocks, from the block cache if possible. Blocks along the right and
+        bottom edges of the raster are clipped to its extent.
+
+        :param block_row: row index of the block
+        :param block_col: column index of the block
+        :param band: raster band to read
+        :return: a read-only array holding the block
+
+        """
+        rows, cols = self.block_shape
+        if self.grid is not None and band == 1:
+            return self.grid[block_row * rows:(block_row + 1) * rows, block_col * cols:(block_col + 1) * cols]
+
+        key = self.cache_prefix + (band, block_row, block_col)
+        block = self.block_cache.get(key)
+        if block is None:
+            row_start, col_start = block_row * rows, block_col * cols
+            window = ((row_start, min(row_start + rows, self.nrow)), (col_start, min(col_start + cols, self.ncol)))
+            block = self.dataset.read(band, window=window)
+            block.setflags(write=False)  # blocks are shared between callers
+            self.block_cache.put(key, block)
+        return block
+
+    def read_window(self, row_start, row_stop, col_start, col_stop, band=1, boundless=False, fill_value=None):
+        """
+
+        Read a rectangular window of pixels, assembled from cached blocks
+
+        :param row_start: first row of the window
+        :param row_stop: row after the last row of the window
+        :param col_start: first column of the window
+        :param col_stop: column after the last column of the window
+        :param band: raster band to read
+        :param boundless: if True, the window may extend past the raster (start indices may be negative); only its
+        intersection with the raster is read, and the remaining cells are padded. Otherwise such windows raise a
+        RetrievePointException.
+        :param fill_value: value of the padded cells, by default the raster's no-data value (or NaN, or 0 for integer
+        rasters, when it has none); the window is promoted to float64 if its dtype cannot hold the value
+        :return: an array of shape (row_stop - row_start, col_stop - col_start)
+
+        """
+        if row_start < 0 or col_start < 0 or row_stop > self.nrow or col_stop > self.ncol:
+            if boundless:
+                return self._pad_window(lambda r0, r1, c0, c1: self.read_window(r0, r1, c0, c1, band),
+                                        (self.nrow, self.ncol), self.meta['dtype'],
+                                        row_start, row_stop, col_start, col_stop, fill_value)
+            raise RetrievePointException("Window ((%d, %d), (%d, %d)) is outside of raster extent" %
+                                         (row_start, row_stop, col_start, col_stop))
+        if self.grid is not None and band == 1:
+            return np.array(self.grid[row_start:row_stop, col_start:col_stop])
+
+        rows, cols = self.block_shape
+        window = np.empty((row_stop - row_start, col_stop - col_start), dtype=self.meta['dtype'])
+        for block_row in range(row_start // rows, (row_stop - 1) // rows + 1):
+            for block_col in range(col_start // cols, (col_stop - 1) // cols + 1):
+                block = self.read_block(block_row, block_col, band)
+                # intersection of the window with this block, in raster coordinates
+                r0, r1 = max(row_start, block_row * rows), min(row_stop, (block_row + 1) * rows)
+                c0, c1 = max(col_start, block_col * cols), min(col_stop, (block_col + 1) * cols)
+                window[r0 - row_start:r1 - row_start, c0 - col_start:c1 - col_start] = \
+                    block[r0 - block_row * rows:r1 - block_row * rows, c0 - block_col * cols:c1 - block_col * cols]
+        return window
+
+    def _fill(self, fill_value, dtype):
+        """
+
+        Resolve the value padding out-of-extent cells, see `read_window`
+
+        :return: tuple of (fill value, dtype able to hold both it and values of `dtype`)
+
+        """
+        dtype = np.dtype(dtype)
+        if fill_value is None:
+            fill_value = self.no_data_value
+        if fill_value is None:
+            fill_value = np.nan if dtype.kind == 'f' else 0
+        with np.errstate(invalid='ignore'):
+            representable = (np.isnan(fill_value) and dtype.kind == 'f' or
+                             np.array(fill_value).astype(dtype) == fill_value)
+        return fill_value, dtype if representable else np.dtype(np.float64)
+
+    def _pad_window(self, read, shape, dtype, row_start, row_stop, col_start, col_stop, fill_value=None):
+        """
+
+        Read the part of a window lying within an array of the given shape, and pad the rest
+
+        :param read: function of (row_start, row_stop, col_start, col_stop) reading an in-extent window
+        :param shape: shape of the array the window is read from
+        :param dtype: dtype of the array the window is read from
+        :return: the padded window
+
+        """
+        fill_value, dtype = self._fill(fill_value, dtype)
+        window = np.full((max(row_stop - row_start, 0), max(col_stop - col_start, 0)), fill_value, dtype=dtype)
+        r0, r1 = max(row_start, 0), min(row_stop, shape[0])
+        c0, c1 = max(col_start, 0), min(col_stop, shape[1])
+        if r0 < r1 and c0 < c1:
+            window[r0 - row_start:r1 - row_start, c0 - col_start:c1 - col_start] = read(r0, r1, c0, c1)
+        return window
+
     def point(self):
         """
 
@@ -179,7 +758,7 @@ class Map(Space):
         :return: A named tuple with fields corresponding to x, y, and units for concrete implementation of Space
 
         """
-        return collections.namedtuple(self.name, [self.x, self.y, 'units'], verbose=False)
+        return self._point
 
     def get_point_elevation(self, coordinate, **kwargs):
         """
@@ -187,29 +766,217 @@ class Map(Space):
         Retrieve an elevation for a single Coordinate
 
         :param coordinate: Named tuple of type Coordinate containing a lat/lon pair
-        :optional give kwargs `px` and `py` to retrieve a pixel directly
+        :optional give kwargs `px` and `py` to retrieve a pixel directly, and `interpolation` as one of 'nearest'
+        (default), 'bilinear' or 'bicubic' to interpolate between pixel centres. Give kwarg `fill_value` to have it
+        returned, instead of a RetrievePointException raised, for coordinates off the raster (and, when
+        interpolating, for those touching no-data pixels).
 
         """
 
-        pixel = None
-        # @todo:figure out how to add exceptions in rasterio
-        # gdal.UseExceptions() #so it doesn't print to screen everytime point is outside grid
-
         px, py = kwargs.get('px', None), kwargs.get('py', None)
-        if (px, py) is not (None, None):
-            pass
+        if px is None or py is None:
+            px, py = self.lat_lon_to_pixel(coordinate)
+        fill_value = kwargs.get('fill_value', None)
+
+        interpolation = kwargs.get('interpolation', 'nearest')
+        if interpolation != 'nearest':
+            elevations, mask = self._interpolate(np.array([px], dtype=np.float64), np.array([py], dtype=np.float64),
+                                                 interpolation=interpolation)
+            if mask[0]:
+                if fill_value is not None:
+                    return fill_value
+                raise RetrievePointException("No elevation at pixel (%f, %f)" % (px, py))
+            return elevations[0]
+
+        col, row = int(math.floor(px)), int(math.floor(py))
+
+        if not (0 <= row < self.nrow and 0 <= col < self.ncol):  # in case raster isnt full extent
+            if fill_value is not None:
+                return fill_value
+            raise RetrievePointException("Pixel (%d, %d) is outside of raster extent" % (col, row))
+
+        if self.grid is not None:
+            return self.grid[row, col]
+        rows, cols = self.block_shape
+        block = self.read_block(row // rows, col // cols)
+        return block[row % rows, col % cols]
+
+    def get_point_elevations(self, lons, lats=None, band=1, interpolation='nearest', resolution=None, reduction=None,
+                             executor=None, shards=None):
+        """
+
+        Retrieve elevations for many coordinates at once. Coordinates are converted to pixels in a single vectorized
+        step and grouped by the raster block they fall in, so that each block is read (or fetched from the block cache)
+        once, however many of the coordinates it holds.
+
+        :param lons: array of longitudes, or, if `lats` is not given, an array of lon/lat pairs with shape (..., 2)
+        :param lats: array of latitudes with the same shape as `lons`
+        :param band: raster band to read
+        :param interpolation: 'nearest' returns the pixel containing each coordinate; 'bilinear' and 'bicubic'
+        interpolate between the 2x2 or 4x4 surrounding pixel centres, and return float64
+        :param resolution: sample the coarsest decimated level of the raster no coarser than this ground resolution,
+        in the units of the raster's CRS; see `select_overview` and `get_overview`
+        :param reduction: how decimated levels are built, see `get_overview`
+        :param executor: optional `concurrent.futures` executor. Points are sorted by raster block and split into
+        `shards` runs of whole blocks, which are sampled in parallel, and results are merged back in input order. The
+        workers of a ProcessPoolExecutor hold their own Map and open dataset; threads of a ThreadPoolExecutor share
+        this Map, each with its own dataset.
+        :param shards: number of shards to split the points into, by default four per CPU
+        :return: a masked array of elevations shaped like the input coordinates; coordinates outside of the raster or
+        on (or interpolated from) no-data pixels are masked
+
+        """
+        if lats is None:
+            coordinates = np.asarray(lons, dtype=np.float64)
+            lons, lats = coordinates[..., 0], coordinates[..., 1]
+        lons, lats = np.broadcast_arrays(np.asarray(lons, dtype=np.float64), np.asarray(lats, dtype=np.float64))
+
+        px, py = self.lat_lon_to_pixel_array(lons, lats)
+
+        if executor is not None:
+            kwargs = dict(band=band, interpolation=interpolation, resolution=resolution, reduction=reduction)
+            shards = shards or 4 * multiprocessing.cpu_count()
+            return self._sample_in_parallel(executor, shards, lons, lats, px, py, kwargs)
+
+        factor = self.select_overview(resolution=resolution) if resolution is not None else 1
+        level = self.get_overview(factor, reduction, band) if factor > 1 else None
+        elevations, mask = self._interpolate(px.ravel() / factor, py.ravel() / factor, band, interpolation, level)
+        return np.ma.array(elevations.reshape(lons.shape), mask=mask.reshape(lons.shape))
+
+    def _sample_in_parallel(self, executor, shards, lons, lats, px, py, kwargs):
+        """
+
+        Shard points by raster block across an executor, see `get_point_elevations`
+
+        """
+        block_rows, block_cols = self.block_shape
+        n_block_cols = (self.ncol + block_cols - 1) // block_cols
+        with np.errstate(invalid='ignore'):
+            block_ids = (np.floor(py.ravel()) // block_rows) * n_block_cols + np.floor(px.ravel()) // block_cols
+        order = np.argsort(block_ids, kind='mergesort')
+        block_ids = block_ids[order]
+
+        # cut the sorted points into roughly equal shards, moving each cut to the next change of block
+        cuts = np.searchsorted(block_ids, block_ids[np.linspace(0, len(order), shards + 1)[1:-1].astype(np.intp)],
+                               side='right') if len(order) else []
+        bounds = np.unique(np.concatenate(([0], cuts, [len(order)])))
+
+        flat_lons, flat_lats = lons.ravel(), lats.ravel()
+        if ThreadPoolExecutor is not None and isinstance(executor, ThreadPoolExecutor):
+            task, source = _sample_map, (self,)  # threads already get a dataset each from this Map
         else:
-            pixs = self.lat_lon_to_pixel(coordinate)
-            px = pixs.x
-            py = pixs.y
+            task, source = _sample_shard, (self.file_name, self.options)
+        futures = []
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            index = order[start:stop]
+            futures.append((index, executor.submit(task, *(source + (flat_lons[index], flat_lats[index], kwargs)))))
+
+        elevations, mask = None, np.ones(len(order), dtype=bool)
+        for index, future in futures:
+            values, shard_mask = future.result()
+            if elevations is None:
+                elevations = np.zeros(len(order), dtype=values.dtype)
+            elevations[index], mask[index] = values, shard_mask
+        if elevations is None:
+            elevations = np.zeros(0, dtype=self.meta['dtype'])
+        return np.ma.array(elevations.reshape(lons.shape), mask=mask.reshape(lons.shape))
+
+    def _interpolate(self, px, py, band=1, interpolation='nearest', level=None):
+        """
 
-        try:  # in case raster isnt full extent
-            # Window format is: ((row_start, row_stop), (col_start, col_stop))
-            pixel = self.img.read(1, window=((py, py + 1), (px, px + 1)))
-        except:
-            RetrievePointException("Pixel read exception")
+        Sample the raster at fractional pixel positions. Every pixel needed by every position is gathered in a single
+        `_sample_pixels` call; neighbours falling off the raster are clamped to its edge.
+
+        :param px: flat array of fractional pixel columns
+        :param py: flat array of fractional pixel rows
+        :param band: raster band to read
+        :param interpolation: one of 'nearest', 'bilinear' or 'bicubic'
+        :param level: optional decimated level to sample instead of the raster, see `_sample_pixels`
+        :return: tuple of (values, mask), where mask flags positions off the raster or touching no-data pixels
 
-        return pixel[0][0]
+        """
+        nrow, ncol = level.shape if level is not None else (self.nrow, self.ncol)
+        if interpolation == 'nearest':
+            values, valid = self._sample_pixels(np.floor(py), np.floor(px), band, level)
+            return values, ~valid | self._no_data(values)
+
+        # pixel centres sit at half-integer positions
+        x, y = px - .5, py - .5
+        x0, y0 = np.floor(x), np.floor(y)
+        if interpolation == 'bilinear':
+            offsets = np.arange(2)
+            wx, wy = np.array([1 - (x - x0), x - x0]), np.array([1 - (y - y0), y - y0])
+        elif interpolation == 'bicubic':
+            offsets = np.arange(-1, 3)
+            wx, wy = cubic_weights(x - x0), cubic_weights(y - y0)
+        else:
+            raise ArgumentError("Unknown interpolation '%s', expected 'nearest', 'bilinear' or 'bicubic'" %
+                                interpolation)
+
+        k, n = len(offsets), len(px)
+        rows = np.clip(y0 + offsets[:, None], 0, nrow - 1)[:, None, :]
+        cols = np.clip(x0 + offsets[:, None], 0, ncol - 1)[None, :, :]
+        rows, cols = np.broadcast_arrays(rows, cols)
+        samples, _ = self._sample_pixels(rows.ravel(), cols.ravel(), band, level)
+        samples = samples.reshape(k, k, n)
+
+        mask = (px < 0) | (px >= ncol) | (py < 0) | (py >= nrow) | np.isnan(px) | np.isnan(py)
+        mask |= self._no_data(samples).any(axis=(0, 1))
+        values = np.einsum('in,jn,ijn->n', wy, wx, samples.astype(np.float64))
+        return values, mask
+
+    def _no_data(self, values):
+        """
+
+        :return: boolean array flagging the no-data (or NaN) entries of `values`
+
+        """
+        mask = np.zeros(values.shape, dtype=bool)
+        if self.no_data_value is not None:
+            mask |= values == self.no_data_value
+        if values.dtype.kind == 'f':
+            mask |= np.isnan(values)
+        return mask
+
+    def _sample_pixels(self, rows, cols, band=1, level=None):
+        """
+
+        Gather the values of arbitrary pixels, reading every block they touch exactly once
+
+        :param rows: flat array of pixel rows
+        :param cols: flat array of pixel columns, the same length as `rows`
+        :param band: raster band to read
+        :param level: optional array (e.g. a decimated level from `get_overview`) to gather from instead of the raster
+        :return: tuple of (values, valid), where valid flags the pixels inside the raster; values of invalid pixels are
+        undefined
+
+        """
+        rows, cols = np.asarray(rows).astype(np.intp), np.asarray(cols).astype(np.intp)
+        if level is None and self.grid is not None and band == 1:
+            level = self.grid
+        nrow, ncol = level.shape if level is not None else (self.nrow, self.ncol)
+        values = np.zeros(rows.shape, dtype=level.dtype if level is not None else self.meta['dtype'])
+        valid = (rows >= 0) & (rows < nrow) & (cols >= 0) & (cols < ncol)
+        if level is not None:
+            values[valid] = level[rows[valid], cols[valid]]
+            return values, valid
+
+        block_rows, block_cols = self.block_shape
+        n_block_cols = (self.ncol + block_cols - 1) // block_cols
+        index = np.flatnonzero(valid)
+        block_ids = (rows[index] // block_rows) * n_block_cols + cols[index] // block_cols
+
+        # sort points by block, then walk the runs of points sharing a block
+        order = np.argsort(block_ids, kind='mergesort')
+        index, block_ids = index[order], block_ids[order]
+        ids, starts = np.unique(block_ids, return_index=True)
+        stops = np.append(starts[1:], len(block_ids))
+        for block_id, start, stop in zip(ids, starts, stops):
+            block_row, block_col = divmod(int(block_id), n_block_cols)
+            block = self.read_block(block_row, block_col, band)
+            run = index[start:stop]
+            values[run] = block[rows[run] - block_row * block_rows, cols[run] - block_col * block_cols]
+        return values, valid
 
     def get_distance_between(self, from_, to, *args, **kwargs):
         """
@@ -217,8 +984,8 @@ class Map(Space):
         :return: the distance between two
         """
         mode = kwargs.get('mode', 'fast')
-        if mode is 'fast':
-            return self.distance_on_unit_sphere(from_, to, units='km')
+        if mode == 'fast':
+            return self.distance_on_unit_sphere(from_, to)
         elif True:
             return self.vincenty_inverse(from_, to)
 
@@ -247,28 +1014,77 @@ class Map(Space):
         """
         Return a square matrix of size window w/ coordinate at center
 
+        Large areas can be read from a decimated level of the raster (see `get_overview`): give kwargs `resolution` to
+        read `window` pixels of the coarsest level no coarser than that ground resolution, or `max_window` to read the
+        area of a `window` pixels wide full-resolution window from the level at which it is at most `max_window`
+        pixels wide. `reduction` selects how decimated levels are built.
+
+        Windows reaching past the edge of the raster are padded with kwarg `fill_value`, by default the raster's
+        no-data value (see `read_window`); give kwarg `boundless=False` to have them raise a RetrievePointException
+        instead.
 
         :param window: dimension of the square window to be read based on start Coordinates obtained
-        :return: a square matrix with sides of length `window`
+        :return: a square matrix with sides of length `window`, or of the decimated window when `max_window` applies
         """
 
         px, py = kwargs.get('px', None), kwargs.get('py', None)
-        if (px, py) is not (None, None):
-            pass
-        else:
-            pixs = self.lat_lon_to_pixel(coordinate)
-            px = pixs.x
-            py = pixs.y
+        if px is None or py is None:
+            px, py = self.lat_lon_to_pixel(coordinate)
+
+        factor = 1
+        if kwargs.get('resolution', None) is not None:
+            factor = self.select_overview(resolution=kwargs['resolution'])
+        elif kwargs.get('max_window', None) is not None:
+            factor = self.select_overview(window=window, max_window=kwargs['max_window'])
+            window = -(-window // factor)
 
         # Determine window
-        topLeftX = px - math.floor(window / 2)
-        topLeftY = py - math.floor(window / 2)
-        try:  # in case raster isnt full extent
-            # todo: use negative windowing feature of rasterio read
-            elevations = self.img.read(1, window=((topLeftY, topLeftY + window), (topLeftX, topLeftX + window)))
-            return elevations
-        except:
-            raise Exception("Couldn't retrieve given window")
+        topLeftX = int(math.floor(px / factor)) - window // 2
+        topLeftY = int(math.floor(py / factor)) - window // 2
+        return self.read_overview_window(factor, topLeftY, topLeftY + window, topLeftX, topLeftX + window,
+                                         kwargs.get('reduction', None), boundless=kwargs.get('boundless', True),
+                                         fill_value=kwargs.get('fill_value', None))
+
+    def get_surrounding_elevations(self, lons, lats=None, window=4, band=1, resolution=None, reduction=None,
+                                   fill_value=None):
+        """
+
+        Batch version of `get_surrounding_elevation`: read a square window of pixels centred on each of many
+        coordinates. All pixels of all windows are gathered in a single block-grouped `_sample_pixels` call, and those
+        falling off the raster are padded rather than raising.
+
+        :param lons: array of longitudes, or, if `lats` is not given, an array of lon/lat pairs with shape (..., 2)
+        :param lats: array of latitudes with the same shape as `lons`
+        :param window: dimension of the square windows
+        :param band: raster band to read
+        :param resolution: read the windows from a decimated level of the raster, see `get_point_elevations`
+        :param reduction: how decimated levels are built, see `get_overview`
+        :param fill_value: value of cells off the raster, see `read_window`
+        :return: an array of shape lons.shape + (window, window)
+
+        """
+        if lats is None:
+            coordinates = np.asarray(lons, dtype=np.float64)
+            lons, lats = coordinates[..., 0], coordinates[..., 1]
+        lons, lats = np.broadcast_arrays(np.asarray(lons, dtype=np.float64), np.asarray(lats, dtype=np.float64))
+
+        factor = self.select_overview(resolution=resolution) if resolution is not None else 1
+        level = self.get_overview(factor, reduction, band) if factor > 1 else None
+
+        px, py = self.lat_lon_to_pixel_array(lons, lats)
+        px, py = px.ravel() / factor, py.ravel() / factor
+        offsets = np.arange(window) - window // 2
+        with np.errstate(invalid='ignore'):
+            top, left = np.floor(py), np.floor(px)
+        # NaN coordinates are sent off the raster, so that their windows are padded entirely
+        top, left = np.where(np.isnan(top), -2 * window, top), np.where(np.isnan(left), -2 * window, left)
+        rows, cols = np.broadcast_arrays((top[:, None] + offsets)[:, :, None], (left[:, None] + offsets)[:, None, :])
+        values, valid = self._sample_pixels(rows.ravel(), cols.ravel(), band, level)
+
+        fill_value, dtype = self._fill(fill_value, values.dtype)
+        values = values.astype(dtype, copy=False)
+        values[~valid] = fill_value
+        return values.reshape(lons.shape + (window, window))
 
     def lat_lon_to_pixel(self, coordinate):
         """
@@ -282,9 +1098,49 @@ class Map(Space):
 
         """
 
-        inv_affine = ~self.affine
-        px, py = inv_affine * (coordinate.lon, coordinate.lat)
-        return px, py
+        a, b, c, d, e, f = self.inverse_affine[:6]
+        return a * coordinate.lon + b * coordinate.lat + c, d * coordinate.lon + e * coordinate.lat + f
+
+    def lat_lon_to_pixel_array(self, lons, lats):
+        """
+
+        Array version of `lat_lon_to_pixel`, applying the inverse geotransform to any number of coordinates at once.
+        Inputs are broadcast against each other.
+
+        :param lons: array of longitudes
+        :param lats: array of latitudes
+        :return: tuple of (px, py) arrays of fractional pixel columns and rows
+
+        """
+        a, b, c, d, e, f = self.inverse_affine[:6]
+        lons, lats = np.asarray(lons, dtype=np.float64), np.asarray(lats, dtype=np.float64)
+        return a * lons + b * lats + c, d * lons + e * lats + f
+
+    def pixel_to_lat_lon_array(self, cols, rows):
+        """
+
+        Array version of `pixel_to_lat_lon`. Inputs are broadcast against each other.
+
+        :param cols: array of (fractional) pixel columns
+        :param rows: array of (fractional) pixel rows
+        :return: tuple of (lons, lats) arrays
+
+        """
+        a, b, c, d, e, f = self.affine[:6]
+        cols, rows = np.asarray(cols, dtype=np.float64), np.asarray(rows, dtype=np.float64)
+        return a * cols + b * rows + c, d * cols + e * rows + f
+
+    @property
+    def inverse_affine(self):
+        """
+
+        Inverse of the raster's geotransform, mapping coordinates to fractional pixels. It is computed once, and again
+        only if `affine` is replaced.
+
+        """
+        if self._inverse_affine is None or self._inverse_affine[0] is not self.affine:
+            self._inverse_affine = (self.affine, ~self.affine)
+        return self._inverse_affine[1]
 
     def pixel_to_lat_lon(self, col, row):
         """
@@ -300,8 +1156,8 @@ class Map(Space):
 
 
         """
-        lon, lat = self.affine * (col, row)
-        return self.point()(lon=lon, lat=lat, units=self.units)
+        a, b, c, d, e, f = self.affine[:6]
+        return self._point(a * col + b * row + c, d * col + e * row + f, self.units)
 
     def distance_on_unit_sphere(self, coord1, coord2, lat_lon=None):
         # todo: need to make this work with ellipsoid earth models for more accurate distance calculations
@@ -370,7 +1226,7 @@ class Map(Space):
         Note: The problem calculates forward and reverse azimuths as: coordinate_a -> coordinate_b
 
         """
-        f, a = self.map_file.flattening, self.map_file.semimajor
+        f, a = self.flattening, self.semimajor
 
         phi1 = math.radians(coordinate_a.lat)
         lambda1 = math.radians(coordinate_a.lon)
@@ -390,21 +1246,21 @@ class Map(Space):
 
         U1 = math.atan(tan_u1)
         U2 = math.atan(tan_u2)
+        sin_u1, cos_u1, sin_u2, cos_u2 = math.sin(U1), math.cos(U1), math.sin(U2), math.cos(U2)
 
         lambda_ = lambda2 - lambda1
         last_lambda = -4000000.0  # an impossibe value
         omega = lambda_
 
         while (last_lambda < -3000000.0 or lambda_ != 0 and abs((last_lambda - lambda_) / lambda_) > 1.0e-9):
-            sqr_sin_sigma = pow(math.cos(U2) * math.sin(lambda_), 2) + \
-                            pow((math.cos(U1) * math.sin(U2) -
-                                 math.sin(U1) * math.cos(U2) * math.cos(lambda_)), 2)
+            sin_lambda, cos_lambda = math.sin(lambda_), math.cos(lambda_)
+            sqr_sin_sigma = pow(cos_u2 * sin_lambda, 2) + pow((cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lambda), 2)
             Sin_sigma = math.sqrt(sqr_sin_sigma)
-            Cos_sigma = math.sin(U1) * math.sin(U2) + math.cos(U1) * math.cos(U2) * math.cos(lambda_)
+            Cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lambda
             sigma = math.atan2(Sin_sigma, Cos_sigma)
-            Sin_alpha = math.cos(U1) * math.cos(U2) * math.sin(lambda_) / math.sin(sigma)
+            Sin_alpha = cos_u1 * cos_u2 * sin_lambda / Sin_sigma
             alpha = math.asin(Sin_alpha)
-            Cos2sigma_m = math.cos(sigma) - (2 * math.sin(U1) * math.sin(U2) / pow(math.cos(alpha), 2))
+            Cos2sigma_m = math.cos(sigma) - (2 * sin_u1 * sin_u2 / pow(math.cos(alpha), 2))
             C = (f / 16) * pow(math.cos(alpha), 2) * (4 + f * (4 - 3 * pow(math.cos(alpha), 2)))
             last_lambda = lambda_
             lambda_ = omega + (1 - C) * f * math.sin(alpha) * (sigma + C * math.sin(sigma) * \
@@ -418,10 +1274,9 @@ class Map(Space):
                                                                 (-3 + 4 * pow(Cos2sigma_m, 2))))
 
         s = b * A * (sigma - delta_sigma)
-        alpha12 = math.atan2((math.cos(U2) * math.sin(lambda_)), \
-                             (math.cos(U1) * math.sin(U2) - math.sin(U1) * math.cos(U2) * math.cos(lambda_)))
-        alpha21 = math.atan2((math.cos(U1) * math.sin(lambda_)), \
-                             (-math.sin(U1) * math.cos(U2) + math.cos(U1) * math.sin(U2) * math.cos(lambda_)))
+        sin_lambda, cos_lambda = math.sin(lambda_), math.cos(lambda_)
+        alpha12 = math.atan2((cos_u2 * sin_lambda), (cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lambda))
+        alpha21 = math.atan2((cos_u1 * sin_lambda), (-sin_u1 * cos_u2 + cos_u1 * sin_u2 * cos_lambda))
 
         if (alpha12 < 0.0):
             alpha12 += two_pi
@@ -430,7 +1285,7 @@ class Map(Space):
 
         alpha21 += two_pi / 2.0
         if alpha21 < 0.0:
-            alpha21 += alpha21 + two_pi
+            alpha21 += two_pi
         if alpha21 > two_pi:
             alpha21 -= two_pi
 
@@ -449,7 +1304,7 @@ class Map(Space):
         :param s: arc length
 
         """
-        f, a = self.map_file.flattening, self.map_file.semimajor
+        f, a = self.flattening, self.semimajor
         phi1, lambda1 = coordinate_a.lat, coordinate_a.lon
         piD4 = math.atan(1.0)
         two_pi = piD4 * 8.0
@@ -518,32 +1373,66 @@ class Map(Space):
         phi2 = phi2 * 45.0 / piD4
         lambda2 = lambda2 * 45.0 / piD4
         alpha21 = alpha21 * 45.0 / piD4
-        return self.point(lat=phi2, lon=lambda2), alpha21
+        return self.point()(lat=phi2, lon=lambda2, units=self.units), alpha21
+
+    def distance_on_unit_sphere_array(self, lons1, lats1, lons2, lats2):
+        """
+
+        Array version of `distance_on_unit_sphere`: great-circle distances between any number of coordinate pairs, on
+        a sphere with the radius of the map's semi-major axis. Inputs are broadcast against each other.
+
+        :return: array of distances, in the units of the map's spheroid
+
+        """
+        return geodesy.haversine(lons1, lats1, lons2, lats2, self.semimajor)
+
+    def vincenty_inverse_array(self, lons1, lats1, lons2, lats2):
+        """
+
+        Array version of `vincenty_inverse` on the map's spheroid. Inputs are broadcast against each other, so that
+        e.g. pairwise separations of N points are given by passing lons[:, None], lats[:, None], lons, lats.
 
-    """ TODO: need to decide whether to use functions from the geodesic lib, or from vincenty """
+        :return: dictionary of 'distance', 'forward_azimuth' and 'reverse_azimuth' arrays; azimuths are in radians
+
+        """
+        distance, forward, reverse = geodesy.vincenty_inverse(lons1, lats1, lons2, lats2, self.semimajor,
+                                                              self.flattening)
+        return {"distance": distance, "forward_azimuth": forward, "reverse_azimuth": reverse}
+
+    def vincenty_direct_array(self, lons, lats, alpha12, s):
+        """
+
+        Array version of `vincenty_direct` on the map's spheroid
+
+        :param lons: start longitudes
+        :param lats: start latitudes
+        :param alpha12: headings, in degrees
+        :param s: arc lengths
+        :return: tuple of (longitudes, latitudes, reverse azimuths) arrays, all in degrees
+
+        """
+        return geodesy.vincenty_direct(lons, lats, alpha12, s, self.semimajor, self.flattening)
 
     def get_coordinates_in_segment(self, startCoord, endCoord, numSamples=10, returnStyle='array'):
         """
 
-        Get coordinates along the direct path between start and end coordinates
+        Get coordinates along the direct path between start and end coordinates, on the map's spheroid
 
         :param startCoord: a Coordinate containing lat and lon, the starting point of the path.
         :param endCoord: a Coordinate containing lat and lon, the end point of the path.
-        :param numSamples: Number of
-        :param returnStyle: Default return style is an array of Coordinates
-        :rtype : not sure yet, perhaps determine this with an optional arg
+        :param numSamples: Number of intervals the segment is divided into; numSamples + 1 coordinates are returned
+        :param returnStyle: Default return style 'array' is a list of Coordinates; 'numpy' returns a tuple of
+        (lons, lats) arrays
 
         """
-
-        # todo: this is bad form - need to actually check what datum we're using for the map instance
-        profile = []
-        p = Geodesic.WGS84.Inverse(startCoord.lat, startCoord.lon, endCoord.lat, endCoord.lon)
-        l = Geodesic.WGS84.Line(p['lat1'], p['lon1'], p['azi1'])
-
-        for i in range(numSamples + 1):
-            b = l.Position(i * p['s12'] / (numSamples))
-            profile.append(self.point(b['lat2'], b['lon2']))
-        return profile
+        inverse = self.vincenty_inverse_array(startCoord.lon, startCoord.lat, endCoord.lon, endCoord.lat)
+        distances = np.linspace(0, inverse['distance'], numSamples + 1)
+        lons, lats, _ = self.vincenty_direct_array(startCoord.lon, startCoord.lat,
+                                                   np.degrees(inverse['forward_azimuth']), distances)
+        if returnStyle == 'numpy':
+            return lons, lats
+        point = self.point()
+        return [point(lon=lon, lat=lat, units=self.units) for lon, lat in zip(lons, lats)]
 
     def get_elevation_along_segment(self, coordinateArray):
         """
@@ -551,56 +1440,74 @@ class Map(Space):
         A segment is an array of coordinates, or similar iterable structure of coords. This function returns a conjugate
         array of elevations corresponding to each coordinate element in the input array
 
-        :param coordinateArray:
-        :return:
+        :param coordinateArray: iterable of Coordinates
+        :return: a masked array of elevations, see `get_point_elevations`
 
         """
-        elevationArray = []
-        for coordinate in coordinateArray:
-            elevation = self.get_point_elevation(coordinate)
-            elevationArray.append(elevation)
-        return elevationArray
+        lons = np.array([coordinate.lon for coordinate in coordinateArray], dtype=np.float64)
+        lats = np.array([coordinate.lat for coordinate in coordinateArray], dtype=np.float64)
+        return self.get_point_elevations(lons, lats)
 
-    def get_coordinates_along_path(self, segmentPairs, **kwargs):
+    def get_coordinates_along_path(self, vertices, spacing=30.0, **kwargs):
         """
 
-        A path is a set of connected segments. Specifically, this function is to be called with an array of coordinates.
-        Iterating through this array pairwise, we call the get_coordinates_in_segment() function iteratively forming a
-        new, continuous array or coordinate connecting many segments.
+        A path is a set of connected segments, given by its vertices. The path is densified so that consecutive
+        samples are at most `spacing` metres apart along the geodesic of each segment, and sampled for elevation.
 
-        :param segmentPairs: An array of coordinates representing the 'vertices' of the path to be traversed; depending
-        on readMode, this can be either an array or a .csv file.
-        :param kwargs: Optional arguments for the get_coordinates_in_segment() function
-        :return: A continuous set of coordinate along a path, which is a set of connected linear segments
+        :param vertices: the 'vertices' of the path to be traversed, as an (N, 2) array of lon/lat pairs or an iterable
+        of Coordinates
+        :param spacing: maximum distance between consecutive samples, in the units of the map's spheroid
+        :param kwargs: `interpolation` and `executor` are passed on to `get_point_elevations`; give `elevation=False` to
+        skip sampling elevations
+        :return: dictionary of contiguous 'lon', 'lat', 'distance' (along the path from its first vertex) and
+        'elevation' arrays
 
         """
-        coordinateArray = kwargs.get('coordinateArray', None)
-        mode = kwargs.get('mode', None)
-        numSamples = kwargs.get('numSamples', None)
-        profile = []
+        chunks = list(self.iter_coordinates_along_path(vertices, spacing, chunk_size=None, **kwargs))
+        return dict((key, np.ma.concatenate([chunk[key] for chunk in chunks]) if key == 'elevation' else
+                     np.concatenate([chunk[key] for chunk in chunks])) for key in chunks[0])
 
-        if mode is 'file':
-            # try to open the csv, raise exception if fail
-
-            # after .csv is inspected, check if there are at least 2 entries
-            # read in csv file as array of Coords
-            pass
-        elif mode is 'segments':
-            if len(segmentPairs) < 2:
-                # todo:raise an exception
-                pass
-        else:
-            # todo: raise an exception if illegal mode provided
-            pass
+    def iter_coordinates_along_path(self, vertices, spacing=30.0, chunk_size=65536, **kwargs):
+        """
 
-        if mode is 'coordinateTrace':
-            for start, end in coordinateArray:
-                profile.append(self.get_coordinates_in_segment(start, end, numSamples=15))
+        Streaming version of `get_coordinates_along_path` for very long routes: yields the densified path in
+        consecutive chunks of at most `chunk_size` samples, with the same keys as `get_coordinates_along_path`.
+        Only the per-segment geodesics are held for the whole path.
 
-        # else:
-        #    raise TypeError("Invalid mode of operation specified for retrieving elevation by segment")
+        :param chunk_size: number of samples per chunk, or None for a single chunk
 
-        return profile
+        """
+        if spacing <= 0:
+            raise ArgumentError("Sample spacing must be positive")
+        if not isinstance(vertices, np.ndarray):
+            vertices = list(vertices)  # so that peeking at the first vertex does not consume it from an iterator
+            if vertices and hasattr(vertices[0], 'lon'):
+                vertices = [(vertex.lon, vertex.lat) for vertex in vertices]
+        vertices = np.asarray(vertices, dtype=np.float64)
+        if vertices.ndim != 2 or len(vertices) < 2:
+            raise ArgumentError("A path needs at least two vertices")
+
+        inverse = self.vincenty_inverse_array(vertices[:-1, 0], vertices[:-1, 1], vertices[1:, 0], vertices[1:, 1])
+        lengths, azimuths = inverse['distance'], np.degrees(inverse['forward_azimuth'])
+        counts = np.ceil(lengths / spacing).astype(np.intp)  # samples per segment, excluding its end vertex
+        first_sample = np.concatenate(([0], np.cumsum(counts)))
+        path_offsets = np.concatenate(([0.], np.cumsum(lengths)))
+        total = first_sample[-1] + 1  # the final vertex closes the path
+        chunk_size = chunk_size or total
+
+        for start in range(0, total, chunk_size):
+            sample = np.arange(start, min(start + chunk_size, total))
+            segment = np.minimum(np.searchsorted(first_sample, sample, side='right') - 1, len(counts) - 1)
+            step = lengths[segment] / np.maximum(counts[segment], 1)
+            along = (sample - first_sample[segment]) * step
+            lons, lats, _ = self.vincenty_direct_array(vertices[segment, 0], vertices[segment, 1], azimuths[segment],
+                                                       along)
+            chunk = {'lon': lons, 'lat': lats, 'distance': path_offsets[segment] + along}
+            if kwargs.get('elevation', True):
+                chunk['elevation'] = self.get_point_elevations(lons, lats,
+                                                               interpolation=kwargs.get('interpolation', 'nearest'),
+                                                               executor=kwargs.get('executor', None))
+            yield chunk
 
     '''
     def plot(self, **window):
@@ -0,0 +1,477 @@
+"""
+
+Many raster tiles behind a single Map. The extents of the tiles are read once and kept in a bucket-grid index, so that
+point queries find the tiles covering them without any GDAL call; the tiles themselves are opened as Maps on first use,
+and at most a fixed number of them are kept open at once.
+
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import math
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import rasterio
+
+from tower.map.cache import BlockCache, DEFAULT_CACHE_BYTES
+from tower.map.map import Map, ReadException, RasterioEnv, RetrievePointException
+
+RASTER_EXTENSIONS = ('.tif', '.tiff', '.img', '.dem', '.hgt', '.asc', '.vrt')
+DEFAULT_MAX_OPEN = 16
+MOSAIC_OPTIONS = ('cache_bytes', 'max_open', 'extensions')  # options of the mosaic itself, not passed to its tiles
+
+
+class TileIndex(object):
+    """
+
+    Spatial index of tile extents. The plane is cut into buckets the size of a typical tile, and every tile is
+    registered in each bucket its extent overlaps, in the order the tiles were given; the bucket lists are stored
+    flat, bucket after bucket, with `starts` marking where each one begins.
+
+    """
+
+    def __init__(self, west, south, east, north):
+        """
+
+        :param west: array of the western edges of the tiles
+        :param south: array of the southern edges of the tiles
+        :param east: array of the eastern edges of the tiles
+        :param north: array of the northern edges of the tiles
+
+        """
+        self.west, self.south, self.east, self.north = [np.asarray(a, dtype=np.float64)
+                                                        for a in (west, south, east, north)]
+        self.x0, self.y0 = self.west.min(), self.north.max()
+        self.bucket_width = float(np.median(self.east - self.west))
+        self.bucket_height = float(np.median(self.north - self.south))
+        self.columns = max(int(math.ceil((self.east.max() - self.x0) / self.bucket_width)), 1)
+        self.rows = max(int(math.ceil((self.y0 - self.south.min()) / self.bucket_height)), 1)
+
+        first_col, last_col = self._bucket_range(self.west - self.x0, self.east - self.x0, self.bucket_width,
+                                                 self.columns)
+        first_row, last_row = self._bucket_range(self.y0 - self.north, self.y0 - self.south, self.bucket_height,
+                                                 self.rows)
+        buckets, tiles = [], []
+        for tile in range(len(self.west)):
+            rows, cols = np.meshgrid(np.arange(first_row[tile], last_row[tile] + 1),
+                                     np.arange(first_col[tile], last_col[tile] + 1), indexing='ij')
+            buckets.append((rows * self.columns + cols).ravel())
+            tiles.append(np.full(rows.size, tile, dtype=np.intp))
+        buckets, tiles = np.concatenate(buckets), np.concatenate(tiles)
+        order = np.lexsort((tiles, buckets))
+        self.tiles = tiles[order]
+        self.starts = np.searchsorted(buckets[order], np.arange(self.rows * self.columns + 1))
+
+    @staticmethod
+    def _bucket_range(low, high, size, count):
+        """
+
+        :return: tuple of (first, last) arrays of the buckets overlapped by the intervals [low, high)
+
+        """
+        first = np.clip(np.floor(low / size), 0, count - 1).astype(np.intp)
+        last = np.clip(np.ceil(high / size) - 1, 0, count - 1).astype(np.intp)
+        return first, np.maximum(first, last)
+
+    def overlapping(self, west, south, east, north):
+        """
+
+        Pair boxes, e.g. the bounding boxes of segments, with the tiles whose extent they overlap, looked up in the
+        buckets each box covers
+
+        :param west: array of the western edges of the boxes
+        :param south: array of the southern edges of the boxes
+        :param east: array of the eastern edges of the boxes
+        :param north: array of the northern edges of the boxes
+        :return: tuple of (index, tiles) arrays, giving boxes by position and the tiles they overlap, ordered by tile
+
+        """
+        west, south, east, north = [np.asarray(a, dtype=np.float64) for a in (west, south, east, north)]
+        # buckets holding the edges of the boxes, edges included: a box ending on a tile's edge may touch its pixels
+        with np.errstate(invalid='ignore'):
+            first_col = np.clip(np.floor((west - self.x0) / self.bucket_width), 0, self.columns - 1).astype(np.intp)
+            last_col = np.clip(np.floor((east - self.x0) / self.bucket_width), 0, self.columns - 1).astype(np.intp)
+            first_row = np.clip(np.floor((self.y0 - north) / self.bucket_height), 0, self.rows - 1).astype(np.intp)
+            last_row = np.clip(np.floor((self.y0 - south) / self.bucket_height), 0, self.rows - 1).astype(np.intp)
+        cols, rows = last_col - first_col + 1, last_row - first_row + 1
+        box = np.repeat(np.arange(len(west)), cols * rows)
+        offset = np.arange(len(box)) - np.repeat(np.cumsum(cols * rows) - cols * rows, cols * rows)
+        bucket = (first_row[box] + offset // cols[box]) * self.columns + first_col[box] + offset % cols[box]
+
+        count = self.starts[bucket + 1] - self.starts[bucket]
+        box = np.repeat(box, count)
+        position = np.repeat(self.starts[bucket], count) + np.arange(len(box)) - np.repeat(np.cumsum(count) - count,
+                                                                                          count)
+        pairs = np.unique(self.tiles[position] * len(west) + box)  # a tile spanning several buckets is listed in each
+        tiles, box = np.divmod(pairs, max(len(west), 1))
+        overlap = (self.west[tiles] <= east[box]) & (west[box] <= self.east[tiles]) & \
+                  (self.south[tiles] <= north[box]) & (south[box] <= self.north[tiles])
+        return box[overlap], tiles[overlap]
+
+    def candidates(self, lons, lats):
+        """
+
+        Iterate over the tiles covering each coordinate, in priority order: the k-th step yields, for every coordinate
+        with at least k + 1 covering tiles, its k-th one
+
+        :param lons: flat array of longitudes
+        :param lats: flat array of latitudes
+        :return: generator of (index, tiles) array pairs, giving coordinates by position and the tiles covering them
+
+        """
+        with np.errstate(invalid='ignore'):
+            cols = np.floor((lons - self.x0) / self.bucket_width)
+            rows = np.floor((self.y0 - lats) / self.bucket_height)
+            inside = (cols >= 0) & (cols < self.columns) & (rows >= 0) & (rows < self.rows)
+        index = np.flatnonzero(inside)
+        bucket = rows[index].astype(np.intp) * self.columns + cols[index].astype(np.intp)
+        start, count = self.starts[bucket], self.starts[bucket + 1] - self.starts[bucket]
+        for k in range(count.max() if len(count) else 0):
+            remaining = count > k
+            index, start, count = index[remaining], start[remaining], count[remaining]
+            tiles = self.tiles[start + k]
+            # pixels cover [west, east) x (south, north] of a north-up raster
+            covered = (self.west[tiles] <= lons[index]) & (lons[index] < self.east[tiles]) & \
+                      (self.south[tiles] < lats[index]) & (lats[index] <= self.north[tiles])
+            yield index[covered], tiles[covered]
+
+
+def _tile_only(name):
+    """
+
+    :return: method of a Mosaic standing in for a pixel-level Map method or property, which only tiles can answer
+
+    """
+    def method(self, *args, **kwargs):
+        raise TypeError("%s is not available on a Mosaic, whose tiles have their own pixel grids: use it on a tile, "
+                        "see Mosaic.tile and Mosaic.tile_at" % name)
+    method.__name__ = str(name)
+    return method
+
+
+class Mosaic(Map):
+    """
+
+    A Map backed by many rasters sharing a CRS, typically the tiles of a large coverage, queried as one without
+    building a VRT. Point and batch queries are routed through a `TileIndex` to the tiles covering them; where tiles
+    overlap, the first tile (in the order given, or by file name for a directory) holding data at a point wins.
+
+    Each tile is a Map, opened on first use and kept in a least-recently-used set of at most `max_open` open tiles.
+    The tiles share a single block cache, so that blocks outlive the eviction of their tile. Window reads go to the
+    tile holding the centre of the window and are padded past its edge, and terrain queries (`get_slopes`,
+    `get_aspects`, `get_max_elevations`) go to the first tile covering each coordinate. Terrain is derived per tile,
+    without reading across seams: slopes and aspects on a tile's outermost pixels replicate its edge, and max
+    elevation cells start at each tile's corner, so both can differ there from the same data read as one raster.
+    Lines of sight are clipped to every tile they cross. Pixel-level operations (`lat_lon_to_pixel`, `read_window`,
+    overviews, `terrain`, `build_graph`) belong to the tiles and raise TypeError on the mosaic, see `tile` and
+    `tile_at`.
+
+    """
+
+    def __init__(self, filename=None, verbose=False, **kwargs):
+        """
+
+        :param filename: a directory holding the rasters, or a list of raster paths
+        :param verbose: print the mosaic's CRS and tile count on load
+        :param kwargs: `max_open` bounds the number of tiles open at once, 16 by default. `cache_bytes` sets the memory
+        cap of the block cache shared by the tiles. `extensions` lists the file extensions picked up from a directory,
+        see RASTER_EXTENSIONS. Other options are passed on to the tiles, see `Map`.
+
+        """
+        self.file_name = filename
+        self.options = kwargs
+        self.tile_options = dict((k, v) for k, v in kwargs.items() if k not in MOSAIC_OPTIONS)
+        self.max_open = kwargs.get('max_open', DEFAULT_MAX_OPEN)
+
+        if isinstance(filename, (list, tuple)):
+            self.file_names = list(filename)
+        else:
+            extensions = tuple(kwargs.get('extensions', RASTER_EXTENSIONS))
+            self.file_names = sorted(os.path.join(filename, name) for name in os.listdir(filename)
+                                     if name.lower().endswith(extensions))
+        if not self.file_names:
+            raise ReadException("No rasters found in %s" % (filename,))
+
+        bounds, dtypes = [], []
+        try:
+            with RasterioEnv():
+                for file_name in self.file_names:
+                    with rasterio.open(file_name, 'r') as ds:
+                        bounds.append(tuple(ds.bounds))
+                        dtypes.append(ds.meta['dtype'])
+                        if len(bounds) == 1:
+                            self.crs = ds.crs
+                            self.crs_wkt = getattr(ds, 'crs_wkt', None) or ds.crs.wkt
+                            self.meta = ds.meta
+                            self.no_data_value = ds.meta['nodata']
+                        elif ds.crs != self.crs:
+                            raise ReadException("%s is not in the CRS of %s" % (file_name, self.file_names[0]))
+        except ReadException:
+            raise
+        except Exception:
+            raise ReadException("Error opening file with Rasterio")
+        if verbose is True:
+            print(self.crs)
+            print("Tiles: %d" % len(self.file_names))
+
+        self.dtype = np.result_type(*dtypes)
+        self.index = TileIndex(*np.array(bounds, dtype=np.float64).T)
+        self.block_cache = BlockCache(max_bytes=kwargs.get('cache_bytes', DEFAULT_CACHE_BYTES))
+        self._tiles = OrderedDict()
+        self._tiles_lock = threading.Lock()
+        self._init_space()
+
+    def __len__(self):
+        return len(self.file_names)
+
+    def tile(self, i):
+        """
+
+        The Map of a tile, opened if it is not among the open tiles. Opening a tile beyond `max_open` evicts the least
+        recently used one; evicted tiles are only dropped, not closed, so that readers still holding one can finish,
+        and their datasets are closed once the last reference goes.
+
+        :param i: position of the tile in `file_names`
+        :return: the tile's Map
+
+        """
+        with self._tiles_lock:
+            tile = self._tiles.pop(i, None)
+            if tile is None:
+                tile = Map(self.file_names[i], **self.tile_options)
+                tile.block_cache, tile.cache_prefix = self.block_cache, (i,)
+            self._tiles[i] = tile
+            while len(self._tiles) > self.max_open:
+                self._tiles.popitem(last=False)
+            return tile
+
+    def tile_at(self, coordinate):
+        """
+
+        :param coordinate: lon/lat pair
+        :return: position in `file_names` of the first tile covering the coordinate, or None
+
+        """
+        for index, tiles in self.index.candidates(np.array([coordinate[0]], dtype=np.float64),
+                                                  np.array([coordinate[1]], dtype=np.float64)):
+            if len(tiles):
+                return int(tiles[0])
+        return None
+
+    @property
+    def open_tiles(self):
+        """
+
+        Positions of the open tiles, from least to most recently used
+
+        """
+        with self._tiles_lock:
+            return list(self._tiles)
+
+    def close(self):
+        """
+
+        Close every open tile and empty the block cache
+
+        """
+        with self._tiles_lock:
+            tiles, self._tiles = list(self._tiles.values()), OrderedDict()
+        for tile in tiles:
+            tile.close()
+        self.block_cache.clear()
+
+    def get_point_elevation(self, coordinate, **kwargs):
+        """
+
+        Retrieve an elevation for a single Coordinate from the first tile holding data at it. Like a single raster,
+        the no-data value is returned if the tiles covering the coordinate only hold no-data there.
+
+        :param coordinate: Named tuple of type Coordinate containing a lat/lon pair
+        :optional kwargs are passed on to the tile, see `Map.get_point_elevation`
+
+        """
+        no_data = None
+        for index, tiles in self.index.candidates(np.array([coordinate[0]], dtype=np.float64),
+                                                  np.array([coordinate[1]], dtype=np.float64)):
+            if len(tiles):
+                tile = self.tile(int(tiles[0]))
+                try:
+                    elevation = tile.get_point_elevation(coordinate, **kwargs)
+                except RetrievePointException:
+                    continue
+                if not tile._no_data(np.asarray(elevation)):
+                    return elevation
+                no_data = elevation
+        if no_data is not None:
+            return no_data
+        if kwargs.get('fill_value', None) is not None:
+            return kwargs['fill_value']
+        raise RetrievePointException("No tile holds an elevation at %s" % (tuple(coordinate[:2]),))
+
+    def get_point_elevations(self, lons, lats=None, **kwargs):
+        """
+
+        Retrieve elevations for many coordinates at once. Coordinates are grouped by the tile covering them, and each
+        tile is queried once with all of its coordinates; coordinates masked by a tile (no-data) move on to the next
+        tile covering them, if any.
+
+        :param lons: array of longitudes, or, if `lats` is not given, an array of lon/lat pairs with shape (..., 2)
+        :param lats: array of latitudes with the same shape as `lons`
+        :optional kwargs are passed on to the tiles, see `Map.get_point_elevations`
+        :return: a masked array of elevations shaped like the input coordinates; coordinates no tile holds data at are
+        masked
+
+        """
+        if lats is None:
+            coordinates = np.asarray(lons, dtype=np.float64)
+            lons, lats = coordinates[..., 0], coordinates[..., 1]
+        lons, lats = np.broadcast_arrays(np.asarray(lons, dtype=np.float64), np.asarray(lats, dtype=np.float64))
+        flat_lons, flat_lats = lons.ravel(), lats.ravel()
+
+        dtype = self.dtype if kwargs.get('interpolation', 'nearest') == 'nearest' else np.float64
+        elevations = np.zeros(flat_lons.shape, dtype=dtype)
+        mask = np.ones(flat_lons.shape, dtype=bool)
+        for index, tiles in self.index.candidates(flat_lons, flat_lats):
+            unresolved = mask[index]
+            index, tiles = index[unresolved], tiles[unresolved]
+            order = np.argsort(tiles, kind='mergesort')
+            index, tiles = index[order], tiles[order]
+            ids, starts = np.unique(tiles, return_index=True)
+            for tile, run in zip(ids, np.split(index, starts[1:])):
+                values = self.tile(int(tile)).get_point_elevations(flat_lons[run], flat_lats[run], **kwargs)
+                elevations[run], mask[run] = values.data, np.ma.getmaskarray(values)
+        return np.ma.array(elevations.reshape(lons.shape), mask=mask.reshape(lons.shape))
+
+    def get_surrounding_elevation(self, coordinate, window=4, *args, **kwargs):
+        """
+
+        Return a square matrix of size window w/ coordinate at center, read from the tile holding the coordinate and
+        padded past its edge, see `Map.get_surrounding_elevation`
+
+        """
+        tile = self.tile_at(coordinate)
+        if tile is None:
+            raise RetrievePointException("No tile covers %s" % (tuple(coordinate[:2]),))
+        return self.tile(tile).get_surrounding_elevation(coordinate, window, *args, **kwargs)
+
+    def get_surrounding_elevations(self, lons, lats=None, window=4, **kwargs):
+        """
+
+        Batch version of `get_surrounding_elevation`, see `Map.get_surrounding_elevations`. Windows around coordinates
+        no tile covers are filled entirely.
+
+        """
+        if lats is None:
+            coordinates = np.asarray(lons, dtype=np.float64)
+            lons, lats = coordinates[..., 0], coordinates[..., 1]
+        lons, lats = np.broadcast_arrays(np.asarray(lons, dtype=np.float64), np.asarray(lats, dtype=np.float64))
+        flat_lons, flat_lats = lons.ravel(), lats.ravel()
+
+        owner = self._owners(flat_lons, flat_lats)
+        fill_value, dtype = self._fill(kwargs.get('fill_value', None), self.dtype)
+        windows = np.full(flat_lons.shape + (window, window), fill_value, dtype=dtype)
+        for tile in np.unique(owner[owner >= 0]):
+            run = np.flatnonzero(owner == tile)
+            windows[run] = self.tile(int(tile)).get_surrounding_elevations(flat_lons[run], flat_lats[run], window,
+                                                                          **kwargs)
+        return windows.reshape(lons.shape + (window, window))
+
+    def _owners(self, lons, lats):
+        """
+
+        :param lons: flat array of longitudes
+        :param lats: flat array of latitudes
+        :return: array of the first tile covering each coordinate, -1 for coordinates no tile covers
+
+        """
+        owner = np.full(lons.shape, -1, dtype=np.intp)
+        for index, tiles in self.index.candidates(lons, lats):
+            unassigned = owner[index] < 0
+            owner[index[unassigned]] = tiles[unassigned]
+        return owner
+
+    def _terrain_lookup(self, grid, lons, lats=None):
+        """
+
+        Terrain queries of `get_slopes`, `get_aspects` and `get_max_elevations`, answered by the first tile covering
+        each coordinate; coordinates no tile covers are masked
+
+        """
+        if lats is None:
+            coordinates = np.asarray(lons, dtype=np.float64)
+            lons, lats = coordinates[..., 0], coordinates[..., 1]
+        lons, lats = np.broadcast_arrays(np.asarray(lons, dtype=np.float64), np.asarray(lats, dtype=np.float64))
+        flat_lons, flat_lats = lons.ravel(), lats.ravel()
+
+        owner = self._owners(flat_lons, flat_lats)
+        values = np.ma.masked_all(flat_lons.shape, dtype=np.float64)
+        for tile in np.unique(owner[owner >= 0]):
+            run = np.flatnonzero(owner == tile)
+            values[run] = self.tile(int(tile))._terrain_lookup(grid, flat_lons[run], flat_lats[run])
+        return values.reshape(lons.shape)
+
+    def get_lines_of_sight(self, starts, ends, clearance=0., prune=True):
+        """
+
+        Line of sight and terrain clearance of many straight segments, see `Map.get_lines_of_sight`. Each segment is
+        clipped to the extent of every tile it crosses, and each tile checks its part; where tiles overlap, the terrain
+        of all of them is checked.
+
+        """
+        starts = np.atleast_2d(np.asarray(starts, dtype=np.float64))
+        ends = np.atleast_2d(np.asarray(ends, dtype=np.float64))
+        n, deltas = len(starts), ends - starts
+        min_clearance, first_t = np.full(n, np.inf), np.full(n, np.inf)
+        first_violation = np.full((n, 3), np.nan)
+
+        index = self.index
+        low, high = np.minimum(starts[:, :2], ends[:, :2]), np.maximum(starts[:, :2], ends[:, :2])
+        boxes, tiles = index.overlapping(low[:, 0], low[:, 1], high[:, 0], high[:, 1])
+        ids, first = np.unique(tiles, return_index=True)
+        for tile, nearby in zip(ids, np.split(boxes, first[1:])):
+            # clip the segments to the tile's extent (Liang-Barsky)
+            ta, tb = np.zeros(len(nearby)), np.ones(len(nearby))
+            for axis, (lower, upper) in enumerate(((index.west[tile], index.east[tile]),
+                                                   (index.south[tile], index.north[tile]))):
+                origin, delta = starts[nearby, axis], deltas[nearby, axis]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    t0, t1 = (lower - origin) / delta, (upper - origin) / delta
+                flat = delta == 0
+                inside = (lower <= origin) & (origin <= upper)
+                ta = np.maximum(ta, np.where(flat, np.where(inside, 0., np.inf), np.minimum(t0, t1)))
+                tb = np.minimum(tb, np.where(flat, np.where(inside, 1., -np.inf), np.maximum(t0, t1)))
+            crossing = ta <= tb
+            nearby, ta, tb = nearby[crossing], ta[crossing], tb[crossing]
+            if not len(nearby):
+                continue
+            result = self.tile(int(tile)).get_lines_of_sight(starts[nearby] + deltas[nearby] * ta[:, None],
+                                                        starts[nearby] + deltas[nearby] * tb[:, None],
+                                                        clearance, prune)
+            np.minimum.at(min_clearance, nearby, result['min_clearance'])
+            violating = ~result['clear']
+            segment, point = nearby[violating], result['first_violation'][violating]
+            # parameter of each violation along its whole segment, to keep the first one over all tiles
+            length = np.einsum('ij,ij->i', deltas[segment], deltas[segment])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t = np.where(length > 0, np.einsum('ij,ij->i', point - starts[segment], deltas[segment]) / length, 0.)
+            earlier = t < first_t[segment]
+            first_t[segment[earlier]] = t[earlier]
+            first_violation[segment[earlier]] = point[earlier]
+
+        return {'clear': np.isinf(first_t), 'min_clearance': min_clearance, 'first_violation': first_violation}
+
+    dataset = img = property(_tile_only('dataset'))
+    terrain = property(_tile_only('terrain'))
+    inverse_affine = property(_tile_only('inverse_affine'))
+    load_grid = _tile_only('load_grid')
+    build_graph = _tile_only('build_graph')
+    lat_lon_to_pixel = _tile_only('lat_lon_to_pixel')
+    lat_lon_to_pixel_array = _tile_only('lat_lon_to_pixel_array')
+    pixel_to_lat_lon = _tile_only('pixel_to_lat_lon')
+    pixel_to_lat_lon_array = _tile_only('pixel_to_lat_lon_array')
+    select_overview = _tile_only('select_overview')
+    get_overview = _tile_only('get_overview')
+    read_overview_window = _tile_only('read_overview_window')
+    read_block = _tile_only('read_block')
+    read_window = _tile_only('read_window')
@@ -0,0 +1,174 @@
+"""
+
+Multi-agent path planning on a CompactGraph, e.g. for a swarm sharing a capture volume. Time advances in steps: at
+each step every vehicle either moves along one edge or waits where it is. Cooperative A* plans the vehicles one after
+the other, in order of priority, each with a space-time A* that avoids the vertices and edges reserved by the vehicles
+planned before it. The resulting paths are free of vertex conflicts (two vehicles at one vertex at the same step) and
+edge conflicts (two vehicles swapping vertices during one step).
+
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import heapq
+
+import numpy as np
+
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python 2
+    from collections import Mapping
+
+INF = float('inf')
+
+
+class ReservationTable(object):
+    """
+
+    Space-time reservations of the vertices and edges used by planned paths, as hash sets of (vertex, step) and
+    (from, to, step) tuples. A vehicle that has reached its goal stays there: its goal is reserved from its arrival on.
+
+    """
+
+    def __init__(self):
+        self.vertices = set()
+        self.edges = set()
+        self.parked = {}  # goal vertex -> step from which it is occupied for good
+        self.latest = {}  # vertex -> last step at which it is reserved, before any parking
+
+    def is_free(self, vertex, step):
+        """
+
+        :return: True if no reservation holds the vertex at the given step
+
+        """
+        if (vertex, step) in self.vertices:
+            return False
+        parked = self.parked.get(vertex)
+        return parked is None or step < parked
+
+    def can_move(self, frm, to, step):
+        """
+
+        :return: True if moving along the edge between `step` and `step + 1` neither reaches a reserved vertex nor
+        swaps places with a vehicle moving the other way
+
+        """
+        return self.is_free(to, step + 1) and (to, frm, step) not in self.edges
+
+    def reserve(self, path):
+        """
+
+        :param path: list of vertices, the one occupied at each step, the last of which is kept from then on
+
+        """
+        for step, vertex in enumerate(path):
+            self.vertices.add((vertex, step))
+            if self.latest.get(vertex, -1) < step:
+                self.latest[vertex] = step
+        for step in range(len(path) - 1):
+            self.edges.add((path[step], path[step + 1], step))
+        self.parked[path[-1]] = len(path) - 1
+
+
+def conflicts(paths):
+    """
+
+    :param paths: sequence of time-indexed paths, each vehicle staying at its last vertex once it has arrived
+    :return: list of (i, j, step, kind) tuples, kind 'vertex' if vehicles i and j are at the same vertex at the step,
+    and 'edge' if they swap vertices between the step and the next
+
+    """
+    found = []
+    steps = max(len(path) for path in paths) if paths else 0
+    at = [[path[min(step, len(path) - 1)] for step in range(steps)] for path in paths]
+    for i in range(len(paths)):
+        for j in range(i + 1, len(paths)):
+            for step in range(steps):
+                if at[i][step] == at[j][step]:
+                    found.append((i, j, step, 'vertex'))
+                elif step + 1 < steps and at[i][step] == at[j][step + 1] and at[i][step + 1] == at[j][step]:
+                    found.append((i, j, step, 'edge'))
+    return found
+
+
+def _space_time_a_star(graph, source, target, table, wait_cost, max_steps):
+    """
+
+    A* over (vertex, step) states, avoiding the reservations of the table and guided by the distances to the target
+    in the graph without other vehicles
+
+    :return: list of the positions of the vertices occupied at each step, or None if there is no path within
+    `max_steps`
+
+    """
+    indptr, indices, weights = graph.adjacency_lists()
+    to_target = graph.search_tree(target, reverse=True).distances.tolist()
+    if to_target[source] == INF or not table.is_free(source, 0):
+        return None
+    arrival = table.latest.get(target, -1) + 1  # staying at the target must not block vehicles planned earlier
+    g, parents, closed = {(source, 0): 0.}, {}, set()
+    heap = [(to_target[source], 0, source)]
+    while heap:
+        _, step, u = heapq.heappop(heap)
+        state = (u, step)
+        if state in closed:
+            continue
+        closed.add(state)
+        if u == target and step >= arrival:
+            path = [u]
+            while state in parents:
+                state = parents[state]
+                path.append(state[0])
+            return path[::-1]
+        if step >= max_steps:
+            continue
+        cost = g[state]
+        moves = [(u, cost + wait_cost)] if table.is_free(u, step + 1) else []
+        for k in range(indptr[u], indptr[u + 1]):
+            v = indices[k]
+            if to_target[v] < INF and table.can_move(u, v, step):
+                moves.append((v, cost + weights[k]))
+        for v, cost_v in moves:
+            next_state = (v, step + 1)
+            if cost_v < g.get(next_state, INF):
+                g[next_state], parents[next_state] = cost_v, state
+                heapq.heappush(heap, (cost_v + to_target[v], step + 1, v))
+    return None
+
+
+def cooperative_a_star(graph, agents, wait_cost=None, max_steps=None):
+    """
+
+    Plan conflict-free, time-indexed paths for several vehicles with Cooperative A*: vehicles are planned in the
+    order given, which sets their priority, each around the reservations of those before it. Prioritized planning is
+    not complete: when a vehicle finds no path, e.g. because one planned before it crosses its start before it can
+    leave, try another order.
+
+        paths = cooperative_a_star(graph, dict((name, (start, goal)) for name, start, goal in vehicles))
+
+    :param graph: a CompactGraph, e.g. a grid over the capture volume
+    :param agents: sequence of (start, goal) pairs of vertex ids, or dictionary of vehicles to such pairs
+    :param wait_cost: cost of staying at a vertex for one step, by default that of the shortest edge
+    :param max_steps: longest path considered, in steps, by default the number of vertices plus the number of steps
+    reserved by the vehicles planned before
+    :return: list (or dictionary, like `agents`) of the paths, each the list of the ids of the vertices occupied at
+    each step, from step 0 until the vehicle is at its goal for good; ValueError if a vehicle finds no path
+
+    """
+    names = list(agents) if isinstance(agents, Mapping) else None
+    pairs = [agents[name] for name in names] if names is not None else list(agents)
+    positions = [(graph.position_of(start), graph.position_of(goal)) for start, goal in pairs]
+    if wait_cost is None:
+        finite = graph.weights[np.isfinite(graph.weights) & (graph.weights > 0)]
+        wait_cost = float(finite.min()) if len(finite) else 1.
+    for kind, vertices in (('start', [source for source, _ in positions]), ('goal', [goal for _, goal in positions])):
+        if len(set(vertices)) < len(vertices):
+            raise ValueError("Vehicles cannot share a %s vertex" % kind)
+    table, paths = ReservationTable(), []
+    for i, (source, target) in enumerate(positions):
+        limit = max_steps if max_steps is not None else graph.num_vertices + max(table.latest.values() or [0])
+        path = _space_time_a_star(graph, source, target, table, wait_cost, limit)
+        if path is None:
+            raise ValueError("No conflict-free path for vehicle %s" % (names[i] if names is not None else i))
+        table.reserve(path)
+        paths.append([graph.id_of(v) for v in path])
+    return dict(zip(names, paths)) if names is not None else paths
@@ -0,0 +1,231 @@
+"""
+
+Incremental replanning on a CompactGraph with D* Lite (Koenig and Likhachev, 2002). The search runs backwards from the
+goal and keeps its state between queries: when edges change, e.g. when a no-fly zone closes a corridor, only the
+vertices whose distance to the goal is affected are expanded again, and the start can move along the path, as a vehicle
+does in flight, without restarting the search.
+
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import collections
+import heapq
+import math
+
+import numpy as np
+
+INF = float('inf')
+
+
+class DStarLite(object):
+    """
+
+    Shortest path from a moving start to a fixed goal, repaired incrementally as the graph's edge lengths change.
+    Changes are picked up from the graph's change log (`CompactGraph.changes_since`); when they are no longer known,
+    e.g. after `add_edges`, the search starts over.
+
+        planner = DStarLite(graph, start, goal)
+        path = planner.plan()
+        graph.remove_edge(*path[3:5])
+        path = planner.plan()  # repairs the search around the closed edge
+
+    """
+
+    def __init__(self, graph, start, goal, heuristic=None):
+        """
+
+        :param graph: a CompactGraph
+        :param start: id of the start vertex
+        :param goal: id of the goal vertex
+        :param heuristic: function of (vertex id, vertex id) returning a lower bound on the length of a path between
+        them, in either direction, and obeying the triangle inequality; by default the great-circle distance if the
+        graph has coordinates, and none otherwise
+
+        """
+        self.graph = graph
+        self.start = graph.position_of(start)
+        self.goal = graph.position_of(goal)
+        self.heuristic = heuristic
+        self.expanded = 0  # vertices expanded by the last call of `plan`
+        self._reset()
+
+    def _reset(self):
+        """
+
+        Discard the search state and index the in-edges of the graph's current structure
+
+        """
+        graph, n = self.graph, self.graph.num_vertices
+        sources, targets, _ = graph.edge_arrays()
+        order = np.argsort(targets, kind='mergesort')
+        in_indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(targets, minlength=n), out=in_indptr[1:])
+        # in-edges of each vertex, as their sources and their positions in the out-edge arrays, whose weights change
+        self._in_edges = (in_indptr.tolist(), sources[order].tolist(), order.tolist())
+        self.version = graph.version
+        self.g, self.rhs = [INF] * n, [INF] * n
+        self.rhs[self.goal] = 0.
+        self.km = 0.
+        self._last = self.start
+        self._h = self._bound_from(self.start)
+        self._keys, self._queue = [None] * n, []
+        self._enqueue(self.goal)
+
+    def _bound_from(self, start):
+        """
+
+        :return: function of a vertex position returning a lower bound on its distance from `start`
+
+        """
+        graph = self.graph
+        if self.heuristic is not None:
+            heuristic, origin = self.heuristic, graph.id_of(start)
+            return lambda u: heuristic(origin, graph.id_of(u))
+        if graph.lons is not None:
+            return graph.great_circle_heuristic(start)
+        return lambda u: 0.
+
+    def _key(self, u):
+        m = min(self.g[u], self.rhs[u])
+        return (m + self._h(u) + self.km, m)
+
+    def _enqueue(self, u):
+        """
+
+        Queue an inconsistent vertex under its current key, or drop a consistent one from the queue (lazily: its heap
+        entries are skipped once its key no longer matches)
+
+        """
+        if self.g[u] != self.rhs[u]:
+            key = self._keys[u] = self._key(u)
+            heapq.heappush(self._queue, (key, u))
+        else:
+            self._keys[u] = None
+
+    def _update(self, u, indptr, indices, weights):
+        """
+
+        Recompute the one-step lookahead distance of a vertex from its out-edges
+
+        """
+        if u != self.goal:
+            g, best = self.g, INF
+            for k in range(indptr[u], indptr[u + 1]):
+                d = weights[k] + g[indices[k]]
+                if d < best:
+                    best = d
+            self.rhs[u] = best
+        self._enqueue(u)
+
+    def move_to(self, start):
+        """
+
+        Move the start, e.g. to the vehicle's current vertex; the next `plan` accounts for it
+
+        :param start: id of the new start vertex
+
+        """
+        self.start = self.graph.position_of(start)
+
+    def plan(self):
+        """
+
+        Bring the search up to date with the start's position and the graph's changes, and return the path
+
+        :return: list of the ids of the vertices along a shortest path from the start to the goal; KeyError if the goal
+        cannot be reached
+
+        """
+        graph = self.graph
+        changes = graph.changes_since(self.version)
+        if changes is None:
+            self._reset()
+            changes = []
+        if self.start != self._last:
+            self.km += self._bound_from(self._last)(self.start)
+            self._last = self.start
+            self._h = self._bound_from(self.start)
+        indptr, indices, weights = graph.adjacency_lists()
+        for source in set(source for source, _ in changes):
+            self._update(source, indptr, indices, weights)
+        self.version = graph.version
+        self._compute(indptr, indices, weights)
+        return self.path()
+
+    def _compute(self, indptr, indices, weights):
+        in_indptr, in_sources, in_positions = self._in_edges
+        g, rhs, keys, queue = self.g, self.rhs, self._keys, self._queue
+        start, pop, push = self.start, heapq.heappop, heapq.heappush
+        self.expanded = 0
+        while queue:
+            key, u = queue[0]
+            if keys[u] != key:  # stale entry
+                pop(queue)
+                continue
+            if key >= self._key(start) and rhs[start] == g[start]:
+                break
+            pop(queue)
+            new_key = self._key(u)
+            if key < new_key:
+                keys[u] = new_key
+                push(queue, (new_key, u))
+                continue
+            self.expanded += 1
+            if g[u] > rhs[u]:  # the vertex got closer to the goal: its predecessors may now lead through it
+                g[u] = rhs[u]
+                keys[u] = None
+                for k in range(in_indptr[u], in_indptr[u + 1]):
+                    s = in_sources[k]
+                    d = weights[in_positions[k]] + g[u]
+                    if d < rhs[s] and s != self.goal:
+                        rhs[s] = d
+                        self._enqueue(s)
+            else:  # the vertex got farther: it and the predecessors that led through it look for other routes
+                g[u] = INF
+                self._update(u, indptr, indices, weights)
+                for k in range(in_indptr[u], in_indptr[u + 1]):
+                    self._update(in_sources[k], indptr, indices, weights)
+
+    @property
+    def distance(self):
+        """
+
+        Length of the shortest path from the start to the goal, as of the last `plan`
+
+        """
+        return self.g[self.start]
+
+    def path(self):
+        """
+
+        :return: list of the ids of the vertices along the shortest path found by the last `plan`, following from the
+        start the successors through which each vertex's distance is shortest; where several tie, e.g. across edges of
+        zero length, the first path found breadth-first among them
+
+        """
+        if math.isinf(self.g[self.start]):
+            raise KeyError(self.graph.id_of(self.goal))
+        indptr, indices, weights = self.graph.adjacency_lists()
+        g, goal = self.g, self.goal
+        parents, frontier = {self.start: None}, collections.deque([self.start])
+        while frontier:
+            u = frontier.popleft()
+            if u == goal:
+                break
+            best, successors = INF, []
+            for k in range(indptr[u], indptr[u + 1]):
+                d = weights[k] + g[indices[k]]
+                if d < best:
+                    best, successors = d, [indices[k]]
+                elif d == best and d < INF:
+                    successors.append(indices[k])
+            for v in successors:
+                if v not in parents:
+                    parents[v] = u
+                    frontier.append(v)
+        else:  # only if the graph changed since the last `plan`
+            raise KeyError(self.graph.id_of(goal))
+        path, u = [], goal
+        while u is not None:
+            path.append(u)
+            u = parents[u]
+        return [self.graph.id_of(v) for v in reversed(path)]
@@ -0,0 +1,216 @@
+"""
+
+Terrain derivative grids (slope, aspect and maximum elevation) of a Map's raster. Derivatives are computed lazily, one
+tile at a time, the first time a query touches the tile, and kept in memory-mapped files next to the raster, so that
+later runs on the same raster find them already computed.
+
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import hashlib
+import os
+import shutil
+
+import numpy as np
+
+FINGERPRINT_SAMPLE_BYTES = 1 << 20
+
+
+def fingerprint(file_name, sample_bytes=FINGERPRINT_SAMPLE_BYTES):
+    """
+
+    Hash identifying the contents of a raster file. Files up to twice `sample_bytes` long are hashed whole; for
+    larger ones, the size and the first and last `sample_bytes` are hashed, so that large rasters are not read in full.
+
+    :param file_name: path of the file
+    :return: hexadecimal digest
+
+    """
+    size = os.path.getsize(file_name)
+    sha = hashlib.sha1(str(size).encode('ascii'))
+    with open(file_name, 'rb') as f:
+        if size <= 2 * sample_bytes:
+            sha.update(f.read())
+        else:
+            sha.update(f.read(sample_bytes))
+            f.seek(size - sample_bytes)
+            sha.update(f.read(sample_bytes))
+    return sha.hexdigest()[:20]
+
+
+class Terrain(object):
+    """
+
+    Lazily computed terrain derivatives of band 1 of a Map's raster:
+
+        - slope: steepest slope at each pixel, in degrees, by Horn's method
+        - aspect: direction of steepest descent at each pixel, in degrees clockwise from north (NaN on flat ground)
+        - max elevation: highest valid elevation within each `cell_size` square cell of pixels
+
+    The raster is processed in `tile_size` square tiles. Once a tile has been computed, lookups in it are plain indexing
+    into the memory-mapped grids. Pixels whose 3x3 neighbourhood holds no-data have NaN slope and aspect.
+
+    """
+
+    def __init__(self, map_, tile_size=256, cell_size=16, cache_dir=None):
+        """
+
+        :param map_: the Map whose raster is processed
+        :param tile_size: width in pixels of the tiles computed at once; a multiple of `cell_size`
+        :param cell_size: width in pixels of the cells of the max elevation grid
+        :param cache_dir: directory holding the grids, by default the raster's path with '.terrain' appended
+
+        """
+        if tile_size % cell_size:
+            raise ValueError("tile_size must be a multiple of cell_size")
+        self.map = map_
+        self.tile_size, self.cell_size = tile_size, cell_size
+        self.tile_rows = -(-map_.nrow // tile_size)
+        self.tile_cols = -(-map_.ncol // tile_size)
+
+        cache_dir = cache_dir or map_.file_name + '.terrain'
+        self.directory = os.path.join(cache_dir, '%s-t%dc%d' % (fingerprint(map_.file_name), tile_size, cell_size))
+        if not os.path.isdir(self.directory):
+            self._create(cache_dir)
+        self.slope = np.load(os.path.join(self.directory, 'slope.npy'), mmap_mode='r+')
+        self.aspect = np.load(os.path.join(self.directory, 'aspect.npy'), mmap_mode='r+')
+        self.max_elevation = np.load(os.path.join(self.directory, 'max.npy'), mmap_mode='r+')
+        self.computed = np.load(os.path.join(self.directory, 'computed.npy'), mmap_mode='r+')
+
+    def _create(self, cache_dir):
+        """
+
+        Lay out empty grids in a private directory and move it into place; if another process got there first, its
+        grids are used instead
+
+        """
+        partial = os.path.join(cache_dir, 'partial-%d' % os.getpid())
+        if not os.path.isdir(partial):
+            os.makedirs(partial)
+        cells = (-(-self.map.nrow // self.cell_size), -(-self.map.ncol // self.cell_size))
+        for name, dtype, shape in (('slope', np.float32, (self.map.nrow, self.map.ncol)),
+                                   ('aspect', np.float32, (self.map.nrow, self.map.ncol)),
+                                   ('max', np.float64, cells),
+                                   ('computed', np.bool_, (self.tile_rows, self.tile_cols))):
+            np.lib.format.open_memmap(os.path.join(partial, name + '.npy'), mode='w+', dtype=dtype, shape=shape).flush()
+        try:
+            os.rename(partial, self.directory)
+        except OSError:
+            shutil.rmtree(partial, ignore_errors=True)
+
+    def ensure(self, rows, cols):
+        """
+
+        Compute every tile holding one of the given pixels that has not been computed yet
+
+        :param rows: array of pixel rows
+        :param cols: array of pixel columns
+
+        """
+        tiles = np.unique(np.ravel(rows) // self.tile_size * self.tile_cols + np.ravel(cols) // self.tile_size)
+        for tile in tiles:
+            tile_row, tile_col = divmod(int(tile), self.tile_cols)
+            if not self.computed[tile_row, tile_col]:
+                self.compute_tile(tile_row, tile_col)
+
+    def ensure_cells(self, cell_rows, cell_cols):
+        """
+
+        Like `ensure`, for cells of the max elevation grid
+
+        """
+        self.ensure(np.asarray(cell_rows) * self.cell_size, np.asarray(cell_cols) * self.cell_size)
+
+    def compute_tile(self, tile_row, tile_col):
+        """
+
+        Compute slope, aspect and cell maxima for one tile and persist them
+
+        """
+        map_, size = self.map, self.tile_size
+        r0, c0 = tile_row * size, tile_col * size
+        r1, c1 = min(r0 + size, map_.nrow), min(c0 + size, map_.ncol)
+
+        # read the tile with a one pixel halo, replicating the raster's edge where the halo falls off it
+        h0, h1, w0, w1 = max(r0 - 1, 0), min(r1 + 1, map_.nrow), max(c0 - 1, 0), min(c1 + 1, map_.ncol)
+        data = map_.read_window(h0, h1, w0, w1).astype(np.float64)
+        data[map_._no_data(data)] = np.nan
+        z = np.pad(data, ((int(r0 == h0), int(r1 == h1)), (int(c0 == w0), int(c1 == w1))), mode='edge')
+
+        dx, dy = self.pixel_size(np.arange(r0, r1))
+        dz_dx = ((z[:-2, 2:] + 2 * z[1:-1, 2:] + z[2:, 2:]) - (z[:-2, :-2] + 2 * z[1:-1, :-2] + z[2:, :-2])) / \
+            (8 * dx[:, None])
+        dz_dy = ((z[:-2, :-2] + 2 * z[:-2, 1:-1] + z[:-2, 2:]) - (z[2:, :-2] + 2 * z[2:, 1:-1] + z[2:, 2:])) / (8 * dy)
+        self.slope[r0:r1, c0:c1] = np.degrees(np.arctan(np.hypot(dz_dx, dz_dy)))
+        aspect = np.mod(np.degrees(np.arctan2(-dz_dx, -dz_dy)), 360)
+        aspect[(dz_dx == 0) & (dz_dy == 0)] = np.nan
+        self.aspect[r0:r1, c0:c1] = aspect
+
+        cell = self.cell_size
+        tile = z[1:-1, 1:-1]
+        padded = np.full((-(-(r1 - r0) // cell) * cell, -(-(c1 - c0) // cell) * cell), np.nan)
+        padded[:r1 - r0, :c1 - c0] = tile
+        blocks = padded.reshape(padded.shape[0] // cell, cell, padded.shape[1] // cell, cell)
+        maxima = np.where(np.isnan(blocks), -np.inf, blocks).max(axis=(1, 3))  # -inf for cells without valid data
+        self.max_elevation[r0 // cell:r0 // cell + maxima.shape[0], c0 // cell:c0 // cell + maxima.shape[1]] = maxima
+
+        for grid in (self.slope, self.aspect, self.max_elevation):
+            grid.flush()
+        self.computed[tile_row, tile_col] = True
+        self.computed.flush()
+
+    def pixel_size(self, rows):
+        """
+
+        Ground size of the pixels of the given rows, in the units of the map's spheroid for geographic rasters and in
+        those of the CRS otherwise
+
+        :param rows: array of pixel rows
+        :return: tuple of (widths, height), where widths has one entry per row
+
+        """
+        map_ = self.map
+        if 'PROJCS' in map_.crs_wkt:
+            return np.full(len(rows), abs(map_.pixelWidth)), abs(map_.pixelHeight)
+        lats = np.radians(map_.originY + (rows + .5) * map_.pixelHeight)
+        radians_per_pixel = np.radians(abs(map_.pixelWidth)), np.radians(abs(map_.pixelHeight))
+        return map_.semimajor * radians_per_pixel[0] * np.cos(lats), map_.semimajor * radians_per_pixel[1]
+
+
+def traverse_grid(x0, y0, dx, dy, ta, tb, unit=1):
+    """
+
+    Exact traversal of a square grid by many straight segments. Segment i runs through (x0 + t * dx, y0 + t * dy) for
+    t in [ta, tb], in pixel coordinates; it is cut wherever it crosses a grid line, into intervals lying within a single
+    cell of the grid.
+
+    :param x0: array of segment origins, in pixel columns
+    :param y0: array of segment origins, in pixel rows
+    :param dx: array of segment extents along columns
+    :param dy: array of segment extents along rows
+    :param ta: array of parameters at which the traversal of each segment starts
+    :param tb: array of parameters at which the traversal of each segment ends
+    :param unit: width of the grid's cells, in pixels
+    :return: tuple of (segment, t_start, t_end, row, col) arrays, one entry per interval, ordered by segment then t
+
+    """
+    x0, y0, dx, dy, ta, tb = [np.asarray(a, dtype=np.float64) for a in (x0, y0, dx, dy, ta, tb)]
+    items = np.arange(len(x0))
+    segments, ts = [items, items], [ta, tb]
+    for origin, delta in ((x0, dx), (y0, dy)):
+        a, b = (origin + delta * ta) / unit, (origin + delta * tb) / unit
+        first, last = np.ceil(np.minimum(a, b)), np.floor(np.maximum(a, b))
+        counts = np.where(delta != 0, np.maximum(last - first + 1, 0), 0).astype(np.intp)
+        item = np.repeat(items, counts)
+        line = first[item] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        segments.append(item)
+        ts.append((line * unit - origin[item]) / delta[item])
+
+    segment, t = np.concatenate(segments), np.concatenate(ts)
+    order = np.lexsort((t, segment))
+    segment, t = segment[order], t[order]
+    keep = (segment[1:] == segment[:-1]) & (t[1:] > t[:-1])
+    segment, t_start, t_end = segment[:-1][keep], t[:-1][keep], t[1:][keep]
+    middle = (t_start + t_end) / 2
+    rows = np.floor((y0[segment] + dy[segment] * middle) / unit).astype(np.intp)
+    cols = np.floor((x0[segment] + dx[segment] * middle) / unit).astype(np.intp)
+    return segment, t_start, t_end, rows, cols
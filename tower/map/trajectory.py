@@ -0,0 +1,420 @@
+"""
+
+Trajectories held in contiguous arrays. A Path stores the longitude, latitude, altitude and, optionally, time of each
+of its vertices, with the geodesic length of every segment and the cumulative arc length precomputed. The position at
+a given distance along the path, or at a given time, is then a binary search over the vertices followed by a single
+geodesic step along one segment, for one query or for a whole array of them at once, which is what followers and
+simulators stepping along a route need.
+
+"""
+from __future__ import (absolute_import, division, print_function, unicode_literals)
+import collections
+
+import numpy as np
+
+from tower.map import geodesy
+
+WGS84_SEMIMAJOR = 6378137.
+WGS84_FLATTENING = 1 / 298.257223563
+
+Waypoint = collections.namedtuple('Waypoint', ['lon', 'lat', 'alt', 'time'])
+
+
+def _columns(vertices):
+    """
+
+    :param vertices: sequence of coordinates with `lon` and `lat` (and optionally `alt`) attributes, or of (lon, lat[,
+    alt[, time]]) rows
+    :return: tuple of (lons, lats, alts, times) lists, alts and times None when the vertices carry none
+
+    """
+    vertices = list(vertices)
+    if vertices and hasattr(vertices[0], 'lon'):
+        alts = [getattr(v, 'alt', 0.) for v in vertices] if hasattr(vertices[0], 'alt') else None
+        return [v.lon for v in vertices], [v.lat for v in vertices], alts, None
+    rows = np.asarray(vertices, dtype=np.float64).reshape(len(vertices), -1)
+    if rows.shape[1] < 2:
+        raise ValueError("Vertices need at least a longitude and a latitude")
+    return rows[:, 0], rows[:, 1], rows[:, 2] if rows.shape[1] > 2 else None, rows[:, 3] if rows.shape[1] > 3 else None
+
+
+class Path(object):
+    """
+
+    Formally, can be understood to represent a simply connected, directed graph: a sequence of vertices joined by
+    geodesic segments on an ellipsoid. Distances are measured along the ground, in the units of the semi-major axis;
+    altitudes are interpolated linearly along each segment, and so are times, so that the speed is constant along a
+    segment.
+
+    The vertices can also be walked one at a time, with `next` and `previous`.
+
+    """
+
+    def __init__(self, lons, lats=None, alts=None, times=None, semimajor=WGS84_SEMIMAJOR, flattening=WGS84_FLATTENING):
+        """
+
+        :param lons: array of vertex longitudes, in degrees; or, without `lats`, a sequence of vertices, either
+        coordinates with `lon` and `lat` (and optionally `alt`) attributes, or (lon, lat[, alt[, time]]) rows
+        :param lats: array of vertex latitudes, in degrees
+        :param alts: optional array of vertex altitudes, 0 by default
+        :param times: optional non-decreasing array of the times at which the vertices are reached, enabling `at_time`
+        :param semimajor: semi-major axis of the ellipsoid
+        :param flattening: flattening of the ellipsoid
+
+        """
+        if lats is None:
+            lons, lats, vertex_alts, vertex_times = _columns(lons)
+            alts = vertex_alts if alts is None else alts
+            times = vertex_times if times is None else times
+        self.semimajor, self.flattening = semimajor, flattening
+        self._set_vertices(lons, lats, alts, times)
+        self.idx = -1
+
+    def _set_vertices(self, lons, lats, alts=None, times=None):
+        lons, lats = np.array(lons, dtype=np.float64).ravel(), np.array(lats, dtype=np.float64).ravel()
+        alts = np.zeros(len(lons)) if alts is None else np.array(alts, dtype=np.float64).ravel()
+        times = None if times is None else np.array(times, dtype=np.float64).ravel()
+        if len(lons) == 0:
+            raise ValueError("A path needs at least one vertex")
+        if len(lats) != len(lons) or len(alts) != len(lons) or (times is not None and len(times) != len(lons)):
+            raise ValueError("Every vertex needs a longitude, a latitude, and an altitude and time if any has one")
+        if times is not None and np.any(np.diff(times) < 0):
+            raise ValueError("Times must not decrease along the path")
+        self.lons, self.lats, self.alts, self.times = lons, lats, alts, times
+        self._measure()
+
+    def _measure(self):
+        """
+
+        Compute the length and forward azimuth of every segment, and the cumulative arc length at every vertex
+
+        """
+        lengths, azimuths, _ = geodesy.vincenty_inverse(self.lons[:-1], self.lats[:-1], self.lons[1:], self.lats[1:],
+                                                        self.semimajor, self.flattening)
+        self.lengths, self.azimuths = lengths, np.degrees(azimuths)
+        self.distances = np.zeros(len(self.lons))
+        np.cumsum(lengths, out=self.distances[1:])
+
+    def _copy(self, lons, lats, alts, times):
+        """
+
+        :return: a path of the same type and ellipsoid over the given vertices
+
+        """
+        return type(self)(lons, lats, alts, times, self.semimajor, self.flattening)
+
+    @property
+    def num_vertices(self):
+        return len(self.lons)
+
+    @property
+    def length(self):
+        """
+
+        Total length of the path
+
+        """
+        return float(self.distances[-1])
+
+    @property
+    def duration(self):
+        """
+
+        Time taken to travel the path, None if it is not timed
+
+        """
+        return None if self.times is None else float(self.times[-1] - self.times[0])
+
+    @property
+    def origin(self):
+        return self.waypoint(0)
+
+    @property
+    def destination(self):
+        return self.waypoint(-1)
+
+    @property
+    def vertices(self):
+        return [self.waypoint(i) for i in range(self.num_vertices)]
+
+    def waypoint(self, i):
+        """
+
+        :return: the Waypoint of the vertex at index i
+
+        """
+        return Waypoint(float(self.lons[i]), float(self.lats[i]), float(self.alts[i]),
+                        None if self.times is None else float(self.times[i]))
+
+    def __len__(self):
+        return self.num_vertices
+
+    def __getitem__(self, i):
+        """
+
+        A Waypoint, or for a slice of vertices a new (open) Path over them; contiguous slices reuse the measured
+        segments
+
+        """
+        if not isinstance(i, slice):
+            return self.waypoint(i)
+        times = None if self.times is None else self.times[i]
+        if i.step not in (None, 1):
+            return Path(self.lons[i], self.lats[i], self.alts[i], times, self.semimajor, self.flattening)
+        start, stop, _ = i.indices(self.num_vertices)
+        if stop <= start:
+            raise ValueError("A path needs at least one vertex")
+        path = Path.__new__(Path)
+        path.semimajor, path.flattening, path.idx = self.semimajor, self.flattening, -1
+        path.lons, path.lats, path.alts = self.lons[i].copy(), self.lats[i].copy(), self.alts[i].copy()
+        path.times = None if times is None else times.copy()
+        path.lengths, path.azimuths = self.lengths[start:stop - 1].copy(), self.azimuths[start:stop - 1].copy()
+        path.distances = self.distances[i] - self.distances[start]
+        return path
+
+    def __iter__(self):
+        return (self.waypoint(i) for i in range(self.num_vertices))
+
+    def _segments(self, distances):
+        """
+
+        :return: array of the indices of the segments holding the given distances along the path
+
+        """
+        return np.clip(np.searchsorted(self.distances, distances, side='right') - 1, 0, max(self.num_vertices - 2, 0))
+
+    def _positions(self, segments, offsets, fractions):
+        """
+
+        :param segments: array of segment indices
+        :param offsets: array of distances along the segments
+        :param fractions: array of fractions of the segments, for the altitudes
+        :return: tuple of (lons, lats, alts) arrays
+
+        """
+        if self.num_vertices == 1:
+            shape = np.shape(offsets)
+            return np.full(shape, self.lons[0]), np.full(shape, self.lats[0]), np.full(shape, self.alts[0])
+        lons, lats, _ = geodesy.vincenty_direct(self.lons[segments], self.lats[segments], self.azimuths[segments],
+                                                offsets, self.semimajor, self.flattening)
+        alts = self.alts[segments] + fractions * (self.alts[segments + 1] - self.alts[segments])
+        return lons, lats, alts
+
+    def _wrap_distances(self, distances):
+        return np.clip(distances, 0., self.length)
+
+    def _wrap_times(self, times):
+        return np.clip(times, self.times[0], self.times[-1])
+
+    def at_distance(self, distances):
+        """
+
+        Position at a given distance along the path, from the start; distances beyond either end are clamped to it
+
+        :param distances: distance, or array of distances
+        :return: tuple of (lon, lat, alt), each an array like `distances`
+
+        """
+        distances = self._wrap_distances(np.asarray(distances, dtype=np.float64))
+        segments = self._segments(distances)
+        offsets = distances - self.distances[segments]
+        if self.num_vertices == 1:
+            return self._positions(segments, offsets, offsets)
+        lengths = self.lengths[segments]
+        fractions = np.divide(offsets, lengths, out=np.zeros_like(offsets), where=lengths > 0)
+        return self._positions(segments, offsets, fractions)
+
+    def distance_at_time(self, times):
+        """
+
+        :param times: time, or array of times
+        :return: the distance (or array of distances) along the path reached at the given times
+
+        """
+        if self.times is None:
+            raise ValueError("The path is not timed, see `retime`")
+        times = self._wrap_times(np.asarray(times, dtype=np.float64))
+        return np.interp(times, self.times, self.distances)
+
+    def at_time(self, times):
+        """
+
+        Position at a given time; times before the start or after the end are clamped to them
+
+        :param times: time, or array of times
+        :return: tuple of (lon, lat, alt), each an array like `times`
+
+        """
+        return self.at_distance(self.distance_at_time(times))
+
+    def between(self, start, stop):
+        """
+
+        :param start: distance along the path at which the sub-path starts
+        :param stop: distance at which it stops
+        :return: the part of the path between two distances, with vertices interpolated at its ends
+
+        """
+        start, stop = sorted((float(np.clip(start, 0., self.length)), float(np.clip(stop, 0., self.length))))
+        inside = np.flatnonzero((self.distances > start) & (self.distances < stop))
+        distances = np.concatenate(([start], self.distances[inside], [stop]))
+        return self._resampled(distances)
+
+    def _resampled(self, distances):
+        lons, lats, alts = self.at_distance(distances)
+        times = None if self.times is None else np.interp(distances, self.distances, self.times)
+        return Path(lons, lats, alts, times, self.semimajor, self.flattening)
+
+    def resample(self, spacing=None, count=None, interval=None):
+        """
+
+        New path with vertices evenly spaced along this one, in distance or in time. The ends are kept.
+
+        :param spacing: distance between successive vertices
+        :param count: number of vertices, instead of `spacing`
+        :param interval: time between successive vertices, instead of `spacing`; the path must be timed
+        :return: a Path
+
+        """
+        if interval is not None:
+            if self.times is None:
+                raise ValueError("The path is not timed, see `retime`")
+            times = np.append(np.arange(self.times[0], self.times[-1], interval), self.times[-1])
+            return self._resampled(self.distance_at_time(times))
+        if spacing is not None:
+            distances = np.append(np.arange(0., self.length, spacing), self.length)
+        elif count is not None:
+            distances = np.linspace(0., self.length, count)
+        else:
+            raise ValueError("One of spacing, count or interval is required")
+        return self._resampled(distances)
+
+    def retime(self, speed, start_time=0.):
+        """
+
+        :param speed: constant ground speed, in units of distance per unit of time
+        :param start_time: time at which the first vertex is reached
+        :return: a copy of the path timed for travel at a constant speed
+
+        """
+        return self._copy(self.lons, self.lats, self.alts, start_time + self.distances / speed)
+
+    def insert(self, index, lon, lat, alt=0., time=None):
+        """
+
+        Insert a vertex before the vertex at the given index
+
+        """
+        if (time is None) != (self.times is None):
+            raise ValueError("Vertices of a timed path need a time, and those of an untimed path none")
+        times = None if self.times is None else np.insert(self.times, index, time)
+        self._set_vertices(np.insert(self.lons, index, lon), np.insert(self.lats, index, lat),
+                           np.insert(self.alts, index, alt), times)
+
+    def remove(self, index):
+        """
+
+        Remove the vertex at the given index
+
+        """
+        if self.num_vertices == 1:
+            raise ValueError("A path needs at least one vertex")
+        times = None if self.times is None else np.delete(self.times, index)
+        self._set_vertices(np.delete(self.lons, index), np.delete(self.lats, index), np.delete(self.alts, index),
+                           times)
+
+    def __next__(self):
+        return self.next()
+
+    def next(self):
+        """
+
+        Get the next Waypoint in path
+
+        """
+        if self.idx < self.num_vertices - 1:
+            self.idx += 1
+            return self.waypoint(self.idx)
+        else:
+            self.idx = self.num_vertices
+            raise StopIteration
+
+    def has_next(self):
+        """
+
+        Return true if there are more vertices after the current one
+
+        """
+        return self.idx < self.num_vertices - 1
+
+    def previous(self):
+        """
+
+        Get the previous Waypoint in path
+
+        """
+        if self.idx > 0:
+            self.idx -= 1
+            return self.waypoint(self.idx)
+        else:
+            raise StopIteration
+
+    def has_previous(self):
+        """
+
+        Return true if there are vertices before the current one
+
+        """
+        return self.idx > 0
+
+
+class Cycle(Path):
+    """
+
+    Cycle is a connected path that can be traversed continuously: its last vertex is joined back to its first (which is
+    repeated at the end if it is not already), and distances and times wrap around, e.g. for a loiter or patrol circuit.
+    A timed cycle needs the time of the return to its first vertex.
+
+    """
+
+    def _set_vertices(self, lons, lats, alts=None, times=None):
+        lons, lats = np.array(lons, dtype=np.float64).ravel(), np.array(lats, dtype=np.float64).ravel()
+        alts = np.zeros(len(lons)) if alts is None else np.array(alts, dtype=np.float64).ravel()
+        if len(lons) > 1 and (lons[0], lats[0], alts[0]) != (lons[-1], lats[-1], alts[-1]):
+            if times is not None and len(times) == len(lons):
+                raise ValueError("A timed cycle needs the time of the return to its first vertex")
+            lons, lats, alts = np.append(lons, lons[0]), np.append(lats, lats[0]), np.append(alts, alts[0])
+        super(Cycle, self)._set_vertices(lons, lats, alts, times)
+
+    def _wrap_distances(self, distances):
+        return np.mod(distances, self.length) if self.length > 0 else np.zeros_like(distances)
+
+    def distance_at_time(self, times):
+        """
+
+        :param times: time, or array of times
+        :return: the distance (or array of distances) travelled at the given times, counting the laps completed
+
+        """
+        if self.times is None:
+            raise ValueError("The cycle is not timed, see `retime`")
+        times = np.asarray(times, dtype=np.float64)
+        period = self.duration
+        if period <= 0:
+            return np.zeros_like(times)
+        laps, phase = np.divmod(times - self.times[0], period)
+        return np.interp(self.times[0] + phase, self.times, self.distances) + laps * self.length
+
+    def next(self):
+        """
+
+        Get the next Waypoint in the cycle, starting over after the last vertex
+
+        """
+        if self.idx >= self.num_vertices - 2:
+            self.idx = -1
+        self.idx += 1
+        return self.waypoint(self.idx)
+
+    def has_next(self):
+        return True